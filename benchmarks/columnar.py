@@ -0,0 +1,59 @@
+"""Row-by-row against columnar execution of numeric operations.
+
+Run as `python -m compgraph.benchmarks.columnar`.
+"""
+import random
+import timeit
+import typing as tp
+
+from compgraph.lib import operations as ops
+
+ROWS = 200000
+REPEAT = 3
+
+
+def make_rows(count: int, seed: int = 0) -> tp.List[ops.TRow]:
+    rng = random.Random(seed)
+    return [{'word': i // 20, 'tf': rng.random(), 'count': rng.randrange(1, 10), 'docs': rng.randrange(1, 100),
+             'total': 100, 'idf': rng.random()} for i in range(count)]
+
+
+def best_time(operation: ops.Operation, rows: tp.List[ops.TRow]) -> float:
+    return min(timeit.repeat(lambda: sum(1 for _ in operation(row.copy() for row in rows)), number=1, repeat=REPEAT))
+
+
+def report(name: str, row_time: float, batch_time: float) -> None:
+    print('{:<28} rows {:8.4f}s  columnar {:8.4f}s  speedup {:5.2f}x'.format(name, row_time, batch_time,
+                                                                             row_time / batch_time))
+
+
+def main() -> None:
+    rows = make_rows(ROWS)
+    mappers: tp.List[ops.BatchMapper] = [ops.InverseDocumentFrequency('total', 'docs'), ops.TFIDF('tf', 'idf'),
+                                         ops.PMI('tf', 'idf', 'pmi'), ops.Product(['count', 'docs'])]
+
+    for mapper in mappers:
+        report(type(mapper).__name__, best_time(ops.Map(mapper), rows), best_time(ops.BatchMap([mapper]), rows))
+
+    def chain(rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+        for mapper in mappers:
+            rows = ops.Map(mapper)(rows)
+        yield from rows
+
+    chain_time = min(timeit.repeat(lambda: sum(1 for _ in chain(row.copy() for row in rows)), number=1,
+                                   repeat=REPEAT))
+    report('chain of all mappers', chain_time, best_time(ops.BatchMap(mappers), rows))
+
+    edges = [{'start': [37.5 + row['tf'] / 10, 55.7 - row['idf'] / 10], 'end': [37.5 - row['idf'] / 10, 55.7],
+              'edge_id': row['word']} for row in rows]
+    street_length = ops.StreetLength('start', 'end', 'length')
+    report('StreetLength', best_time(ops.Map(street_length), edges),
+           best_time(ops.Map(street_length, vectorized=True), edges))
+
+    for reducer in [ops.Sum('count'), ops.MeanSpeed('tf', 'docs', 'speed', 'count')]:
+        report('Reduce ' + type(reducer).__name__, best_time(ops.Reduce(reducer, ['word']), rows),
+               best_time(ops.BatchReduce(reducer, ['word']), rows))
+
+
+if __name__ == '__main__':
+    main()
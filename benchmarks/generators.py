@@ -0,0 +1,92 @@
+"""Seeded synthetic inputs for the bundled graphs, see benchmarks.graphs.
+
+Every generator is deterministic for a given seed, so runs on different commits process the same rows.
+"""
+import bisect
+import itertools
+import random
+import string
+import typing as tp
+
+from datetime import datetime, timedelta
+
+from compgraph.lib.rows import TRow, TRowsGenerator
+
+MOSCOW_CENTER = (37.62, 55.75)
+ROAD_SPREAD = 0.25  # degrees around the center
+LOG_START = datetime(2017, 10, 9)
+LOG_DAYS = 21
+DATE_FORMAT = '%Y%m%dT%H%M%S.%f'
+PUNCTUATION = ['', '', '', '', ',', '.', '!', '?']
+
+
+def make_word(index: int) -> str:
+    """Distinct lowercase word for every index, 3 to 10 letters long"""
+    length = 3 + index % 8
+    letters = []
+    while True:
+        index, letter = divmod(index, 26)
+        letters.append(string.ascii_lowercase[letter])
+        if not index:
+            break
+    return ''.join(reversed(letters)).rjust(length, 'a')
+
+
+def zipf_weights(vocabulary: int, exponent: float = 1.0) -> tp.List[float]:
+    """Cumulative weights of ranks 1..vocabulary under Zipf's law with given exponent"""
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, vocabulary + 1)))
+
+
+def text_corpus(docs: int, words_per_doc: int = 100, vocabulary: int = 20000, exponent: float = 1.0,
+                seed: int = 0) -> TRowsGenerator:
+    """
+    Documents {'doc_id', 'text'} with Zipf distributed words.
+
+    @param docs: number of documents
+    @param words_per_doc: mean number of words in a document, actual lengths are uniform in [1, 2 * mean)
+    @param vocabulary: number of distinct words
+    @param exponent: exponent of Zipf's law, larger makes frequent words more frequent
+    @param seed: seed of the generator
+    """
+    rng = random.Random(seed)
+    weights = zipf_weights(vocabulary, exponent)
+    words = [make_word(index) for index in range(vocabulary)]
+    total = weights[-1]
+    for doc_id in range(docs):
+        text = []
+        for _ in range(rng.randrange(1, 2 * words_per_doc)):
+            word = words[bisect.bisect(weights, rng.random() * total)]
+            if rng.random() < 0.1:
+                word = word.capitalize()
+            text.append(word + rng.choice(PUNCTUATION))
+        yield {'doc_id': doc_id, 'text': ' '.join(text)}
+
+
+def road_graph(edges: int, seed: int = 0) -> TRowsGenerator:
+    """Road edges {'edge_id', 'start', 'end'}, 10 to 500 meter long segments around Moscow center"""
+    rng = random.Random(seed)
+    for _ in range(edges):
+        lon = MOSCOW_CENTER[0] + rng.uniform(-ROAD_SPREAD, ROAD_SPREAD)
+        lat = MOSCOW_CENTER[1] + rng.uniform(-ROAD_SPREAD, ROAD_SPREAD)
+        step = rng.uniform(0.0001, 0.005)
+        direction = rng.uniform(-1, 1), rng.uniform(-1, 1)
+        yield {'edge_id': rng.randrange(2 ** 63), 'start': [lon, lat],
+               'end': [lon + step * direction[0], lat + step * direction[1] / 2]}
+
+
+def travel_times(rows: int, edges: int, seed: int = 0) -> TRowsGenerator:
+    """
+    Travel log {'edge_id', 'enter_time', 'leave_time'} over edges of road_graph(edges, seed).
+
+    Edges are picked with Zipf distributed popularity, enter times are spread over LOG_DAYS days with more
+    traffic in the day than in the night, travel takes 1 to 60 seconds.
+    """
+    edge_ids = [edge['edge_id'] for edge in road_graph(edges, seed)]
+    rng = random.Random(seed + 1)
+    weights = zipf_weights(edges)
+    total = weights[-1]
+    for _ in range(rows):
+        enter_time = LOG_START + timedelta(days=rng.randrange(LOG_DAYS), hours=min(23.99, rng.triangular(0, 24, 14)))
+        leave_time = enter_time + timedelta(seconds=rng.uniform(1, 60))
+        yield {'edge_id': edge_ids[bisect.bisect(weights, rng.random() * total)],
+               'enter_time': enter_time.strftime(DATE_FORMAT), 'leave_time': leave_time.strftime(DATE_FORMAT)}
@@ -0,0 +1,149 @@
+"""Throughput and memory of the bundled graphs on seeded synthetic data.
+
+Run as `python -m compgraph.benchmarks.graphs [--scale 1] [--output results.json] [--compare old.json]`.
+Every graph runs in a fresh process: first timed (best of --repeat runs), with peak RSS of the process and its
+children sampled by MemoryGovernor, then once more with a Profiler for per-stage timings. Inputs are generated in
+memory before the timed runs, RSS at that point is reported as baseline. Results are printed and, with --output,
+saved as JSON; --compare prints the change against results saved on another commit.
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import time
+import typing as tp
+
+from pathlib import Path
+
+from compgraph import graphs
+from compgraph.benchmarks import generators
+from compgraph.lib.graph import Graph
+from compgraph.lib.memory_governor import MemoryGovernor
+from compgraph.lib.profiling import Profiler
+
+MiB = 1024 ** 2
+DOCS = 5000
+EDGES = 20000
+TRAVEL_TIMES = 200000
+REPEAT = 3
+
+
+class Case(tp.NamedTuple):
+    name: str
+    make_graph: tp.Callable[[], Graph]
+    make_sources: tp.Callable[[float, int], tp.Dict[str, tp.Callable[[], generators.TRowsGenerator]]]
+
+
+def text_sources(scale: float, seed: int) -> tp.Dict[str, tp.Callable[[], generators.TRowsGenerator]]:
+    return {'docs': lambda: generators.text_corpus(int(DOCS * scale), seed=seed)}
+
+
+def maps_sources(scale: float, seed: int) -> tp.Dict[str, tp.Callable[[], generators.TRowsGenerator]]:
+    edges = int(EDGES * scale)
+    return {'travel_time': lambda: generators.travel_times(int(TRAVEL_TIMES * scale), edges, seed),
+            'edge_length': lambda: generators.road_graph(edges, seed)}
+
+
+CASES = [
+    Case('word_count', lambda: graphs.word_count_graph('docs'), text_sources),
+    Case('inverted_index', lambda: graphs.inverted_index_graph('docs'), text_sources),
+    Case('pmi', lambda: graphs.pmi_graph('docs'), text_sources),
+    Case('yandex_maps', lambda: graphs.yandex_maps_graph('travel_time', 'edge_length'), maps_sources),
+]
+
+
+def run_case(case: Case, scale: float, seed: int, repeat: int, options: tp.Dict[str, tp.Any],
+             results: 'multiprocessing.Queue[tp.Dict[str, tp.Any]]') -> None:
+    # inputs are generated before timing, so that the run is not charged for the generators
+    inputs = {name: list(make_rows()) for name, make_rows in case.make_sources(scale, seed).items()}
+    # mappers may change rows in place, so every run reads its own copies
+    sources = {name: (lambda rows=rows: (dict(row) for row in rows)) for name, rows in inputs.items()}
+    rows_in = sum(map(len, inputs.values()))
+
+    watchdog = MemoryGovernor(limit=1 << 62)
+    watchdog.start()
+    # the first sample is taken synchronously by start, before any run
+    baseline_rss = watchdog.usage
+    elapsed = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows_out = sum(1 for _ in case.make_graph().with_options(**options).run_iter(**sources))  # type: ignore
+        elapsed = min(elapsed, time.perf_counter() - start)
+    watchdog.stop()
+    watchdog.join()
+
+    profiler = Profiler()
+    sum(1 for _ in case.make_graph().with_options(profiler=profiler, **options).run_iter(**sources))  # type: ignore
+    results.put({'graph': case.name, 'rows_in': rows_in, 'rows_out': rows_out, 'seconds': elapsed,
+                 'rows_per_second': rows_in / elapsed, 'baseline_rss': baseline_rss,
+                 'peak_rss': watchdog.maximum_memory_usage, 'stages': profiler.trace()})
+
+
+def commit() -> tp.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(run: tp.Dict[str, tp.Any], filename: str) -> None:
+    with open(filename) as file:
+        previous_run = json.load(file)
+    for key in ['scale', 'seed', 'repeat', 'options']:
+        if run[key] != previous_run[key]:
+            print('warning: {} differs: {} against {}'.format(key, run[key], previous_run[key]))
+    previous = {result['graph']: result for result in previous_run['results']}
+    for result in run['results']:
+        old = previous.get(result['graph'])
+        if old is not None:
+            print('{:<16} rows/s {:+7.1%}  peak RSS {:+7.1%}  (against {})'.format(
+                result['graph'], result['rows_per_second'] / old['rows_per_second'] - 1,
+                result['peak_rss'] / old['peak_rss'] - 1, previous_run['commit'] or filename))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of input sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--graphs', nargs='+', choices=[case.name for case in CASES],
+                        default=[case.name for case in CASES])
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='timed runs of every graph, the best one counts')
+    parser.add_argument('--sort-workers', type=int, default=1, help="'sort_workers' run option")
+    parser.add_argument('--compact-rows', action='store_true', help="'compact_rows' run option")
+    parser.add_argument('--stages', type=int, default=3, help='number of slowest stages to print for every graph')
+    parser.add_argument('--output', help='file to save results to, as JSON')
+    parser.add_argument('--compare', help='results of another run, saved with --output')
+    args = parser.parse_args()
+
+    options = {'sort_workers': args.sort_workers, 'compact_rows': args.compact_rows}
+    results: tp.List[tp.Dict[str, tp.Any]] = []
+    queue: 'multiprocessing.Queue[tp.Dict[str, tp.Any]]' = multiprocessing.Queue()
+    for case in CASES:
+        if case.name not in args.graphs:
+            continue
+        process = multiprocessing.Process(target=run_case, args=(case, args.scale, args.seed, args.repeat,
+                                                                      options, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+        print('{:<16} {:8.3f}s {:>9} rows in {:>9} rows out {:10.0f} rows/s  peak RSS {:8.1f} MiB '
+              '(before run {:.1f} MiB)'.format(result['graph'], result['seconds'], result['rows_in'],
+                                               result['rows_out'], result['rows_per_second'],
+                                               result['peak_rss'] / MiB, result['baseline_rss'] / MiB))
+        for stage in sorted(result['stages'], key=lambda stage: -stage['wall_time'])[:args.stages]:
+            print('    {:<48} {:8.3f}s'.format(stage['node'], stage['wall_time']))
+
+    run = {'commit': commit(), 'python': platform.python_version(), 'scale': args.scale, 'seed': args.seed,
+           'repeat': args.repeat, 'options': options, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(run, file, indent=1)
+    if args.compare:
+        compare(run, args.compare)
+
+
+if __name__ == '__main__':
+    main()
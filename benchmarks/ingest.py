@@ -0,0 +1,89 @@
+"""Reading inputs of graph_from_file: JSON lines read line by line or in chunks, and binary row files.
+graph_from_file can decode JSON with orjson when asked to and can parse shards of files in worker processes.
+Gzip compressed input is read directly, decompressing in a background thread, and by decompressing to disk first.
+
+Run as `python -m compgraph.benchmarks.ingest`.
+"""
+import gzip
+import json
+import random
+import shutil
+import tempfile
+import timeit
+import typing as tp
+
+from pathlib import Path
+
+from compgraph.lib import files
+from compgraph.lib import operations as ops
+from compgraph.lib.graph import Graph
+
+ROWS = 200000
+REPEAT = 3
+WORKERS = 4
+
+
+def make_travel_times(count: int, seed: int = 0) -> tp.Generator[tp.Dict[str, tp.Any], None, None]:
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield {'leave_time': '20171020T1122{:02}.{:06}'.format(rng.randrange(60), rng.randrange(10 ** 6)),
+               'enter_time': '20171020T1122{:02}.{:06}'.format(rng.randrange(60), rng.randrange(10 ** 6)),
+               'edge_id': rng.randrange(2 ** 63)}
+
+
+def best_time(run: tp.Callable[[], tp.Iterable[tp.Any]]) -> float:
+    return min(timeit.repeat(lambda: sum(1 for _ in run()), number=1, repeat=REPEAT))
+
+
+def report(name: str, elapsed: float, baseline: float) -> None:
+    print('{:<34} {:8.4f}s  {:8.0f} rows/s  speedup {:5.2f}x'.format(name, elapsed, ROWS / elapsed,
+                                                                     baseline / elapsed))
+
+
+def read_lines_one_by_one(filename: str) -> tp.Generator[tp.Dict[str, tp.Any], None, None]:
+    """graph_from_file reader as it was: text mode, json.loads per line through ReadFromFile"""
+    reader = ops.ReadFromFile(json.loads)
+    with open(filename, 'r') as file:
+        for line in file:
+            yield from reader(line)
+
+
+def decompress_and_read(filename: str, directory: str) -> tp.List[tp.Dict[str, tp.Any]]:
+    """Workflow without compressed input: decompress file to disk, then read it"""
+    plain_file = str(Path(directory) / 'decompressed.txt')
+    with gzip.open(filename, 'rb') as source, open(plain_file, 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+    return Graph.graph_from_file(plain_file).run()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        text_file, row_file = str(Path(directory) / 'rows.txt'), str(Path(directory) / 'rows.bin')
+        with open(text_file, 'w') as file:
+            file.writelines(json.dumps(row) + '\n' for row in make_travel_times(ROWS))
+        files.convert_json_lines(text_file, row_file)
+        gzip_file = text_file + '.gz'
+        files.write_text_rows(gzip_file, files.read_text_rows(text_file))
+
+        baseline = best_time(lambda: read_lines_one_by_one(text_file))
+        report('json lines, line by line', baseline, baseline)
+        decode = json.JSONDecoder().decode
+        report('json lines, chunked json', best_time(lambda: files.read_text_rows(text_file, decode)), baseline)
+        report('json lines, graph_from_file', best_time(Graph.graph_from_file(text_file).run), baseline)
+        try:
+            import orjson
+        except ImportError:
+            pass
+        else:
+            report('json lines, orjson', best_time(Graph.graph_from_file(text_file, orjson.loads).run), baseline)
+        report('binary row file', best_time(Graph.graph_from_file(row_file, format='rows').run), baseline)
+        report('gzip, decompressed to disk', best_time(lambda: decompress_and_read(gzip_file, directory)), baseline)
+        report('gzip, graph_from_file', best_time(Graph.graph_from_file(gzip_file).run), baseline)
+        for ordered in [True, False]:
+            graph = Graph.graph_from_file(text_file, workers=WORKERS, ordered=ordered)
+            report('json lines, {} workers{}'.format(WORKERS, '' if ordered else ', unordered'),
+                   best_time(graph.run), baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Peak memory of graphs with large in-memory buffers, with and without 'memory_limit' run option.
+
+Run as `python -m compgraph.benchmarks.memory_governor`. Every case runs in a fresh process, peak RSS of the
+process and its children is sampled by MemoryGovernor.
+"""
+import multiprocessing
+import time
+import typing as tp
+
+from compgraph.lib import operations as ops
+from compgraph.lib.graph import Graph
+from compgraph.lib.memory_governor import MemoryGovernor
+
+ROWS = 600000
+MiB = 1024 ** 2
+MEMORY_LIMIT = 96 * MiB
+
+
+def make_rows(count: int) -> ops.TRowsGenerator:
+    for i in range(count):
+        yield {'key': i, 'value': i % 7, 'text': 'row {}'.format(i)}
+
+
+def hash_reduce_graph() -> Graph:
+    """Every row is its own group, so hash reduce keeps the whole input in memory unless it spills"""
+    return Graph.graph_from_iter('rows').reduce(ops.FirstReducer(), ['key'], strategy='hash', max_groups=10 ** 7)
+
+
+def tee_graph() -> Graph:
+    """Two consumers of one stream drifting apart: the first one is consumed entirely before the second"""
+    rows = Graph.graph_from_iter('rows')
+    values = Graph.graph_from_graph(rows).reduce(ops.Sum('value'), [], strategy='hash')
+    return Graph.graph_from_graph(rows).join(ops.InnerJoiner(), values, [], strategy='broadcast')
+
+
+def run_case(make_graph: tp.Callable[[], Graph], options: tp.Dict[str, tp.Any],
+             results: 'multiprocessing.Queue[tp.Tuple[float, int, int]]') -> None:
+    watchdog = MemoryGovernor(limit=1 << 62)
+    watchdog.start()
+    start = time.perf_counter()
+    graph = make_graph().with_options(tee_buffer_size=10 ** 7, **options)
+    row_count = sum(1 for _ in graph.run_iter(rows=lambda: make_rows(ROWS)))
+    elapsed = time.perf_counter() - start
+    watchdog.stop()
+    watchdog.join()
+    results.put((elapsed, row_count, watchdog.maximum_memory_usage))
+
+
+def main() -> None:
+    results: 'multiprocessing.Queue[tp.Tuple[float, int, int]]' = multiprocessing.Queue()
+    for name, make_graph in [('hash reduce', hash_reduce_graph), ('tee', tee_graph)]:
+        for options in [{}, {'memory_limit': MEMORY_LIMIT}]:
+            process = multiprocessing.Process(target=run_case, args=(make_graph, options, results))
+            process.start()
+            elapsed, row_count, peak = results.get()
+            process.join()
+            label = '{}, {}'.format(name, 'memory_limit {} MiB'.format(MEMORY_LIMIT // MiB) if options else 'no limit')
+            print('{:<36} {:8.3f}s {:>10} rows  peak RSS {:8.1f} MiB'.format(label, elapsed, row_count, peak / MiB))
+
+
+if __name__ == '__main__':
+    main()
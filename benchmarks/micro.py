@@ -0,0 +1,100 @@
+"""Microbenchmarks of operation hot loops.
+
+Run as `python -m compgraph.benchmarks.micro`.
+"""
+import itertools
+import random
+import timeit
+import typing as tp
+
+from compgraph.lib import operations as ops
+
+ROWS = 100000
+REPEAT = 5
+
+
+def make_rows(count: int, groups: int, seed: int = 0) -> tp.List[ops.TRow]:
+    rng = random.Random(seed)
+    rows = [{'a': rng.randrange(groups), 'b': rng.randrange(4), 'value': i} for i in range(count)]
+    rows.sort(key=lambda row: (row['a'], row['b']))
+    return rows
+
+
+def old_reduce(rows: ops.TRowsIterable, keys: tp.Sequence[str]) -> ops.TRowsGenerator:
+    """Reduce grouping as it was: list of key values per row and key dict per result row"""
+    for group_values, group in itertools.groupby(rows, key=lambda x: [x[key] for key in keys]):
+        for row in ops.FirstReducer()(group):
+            row.update(dict(zip(keys, group_values)))
+            yield row
+
+
+def old_merge_join(left: ops.TRowsIterable, right: ops.TRowsIterable,
+                   keys: tp.Sequence[str]) -> ops.TRowsGenerator:
+    """Inner merge join as it was: dict key per row, lists of values per comparison
+    (groups are read into lists, which the old joiner needed to see every pair)"""
+    joiner = ops.InnerJoiner()
+    left_grouper = itertools.groupby(left, key=lambda x: {key: x[key] for key in keys})
+    right_grouper = itertools.groupby(right, key=lambda x: {key: x[key] for key in keys})
+    left_key, left_group = next(left_grouper, (None, None))
+    right_key, right_group = next(right_grouper, (None, None))
+    while left_key is not None and right_key is not None:
+        left_values, right_values = list(left_key.values()), list(right_key.values())
+        if left_values < right_values:
+            left_key, left_group = next(left_grouper, (None, None))
+        elif left_values == right_values:
+            yield from joiner(keys, list(left_group), list(right_group))
+            left_key, left_group = next(left_grouper, (None, None))
+            right_key, right_group = next(right_grouper, (None, None))
+        else:
+            right_key, right_group = next(right_grouper, (None, None))
+
+
+def old_map_chain(mappers: tp.Sequence[ops.Mapper], rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+    """Chain of Map nodes as it was: a generator per Map resumed for every row, and one per mapper call"""
+    def map_rows(mapper: ops.Mapper, rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+        for row in rows:
+            yield from mapper(row)
+
+    for mapper in mappers:
+        rows = map_rows(mapper, rows)
+    yield from rows
+
+
+def best_time(function: tp.Callable[[], tp.Any]) -> float:
+    return min(timeit.repeat(function, number=1, repeat=REPEAT))
+
+
+def report(name: str, old: float, new: float) -> None:
+    print('{:<24} old {:8.4f}s  new {:8.4f}s  speedup {:5.2f}x'.format(name, old, new, old / new))
+
+
+def main() -> None:
+    for keys in (['a'], ['a', 'b']):
+        rows = make_rows(ROWS, ROWS // 10)
+        other = make_rows(ROWS, ROWS // 10, seed=1)
+        suffix = '[{}]'.format(','.join(keys))
+
+        old = best_time(lambda: sum(1 for _ in itertools.groupby(rows, key=lambda x: [x[k] for k in keys])))
+        new = best_time(lambda: sum(1 for _ in itertools.groupby(rows, key=ops.key_getter(keys))))
+        report('groupby ' + suffix, old, new)
+
+        reduce = ops.Reduce(ops.FirstReducer(), keys)
+        old = best_time(lambda: sum(1 for _ in old_reduce((row.copy() for row in rows), keys)))
+        new = best_time(lambda: sum(1 for _ in reduce(row.copy() for row in rows)))
+        report('reduce ' + suffix, old, new)
+
+        join = ops.Join(ops.InnerJoiner(), keys, strategy='merge')
+        old = best_time(lambda: sum(1 for _ in old_merge_join(rows, other, keys)))
+        new = best_time(lambda: sum(1 for _ in join(iter(rows), iter(other))))
+        report('merge join ' + suffix, old, new)
+
+    rows = make_rows(ROWS, ROWS // 10)
+    mappers = [ops.AddField('c', 1), ops.Filter(lambda row: row['b'] != 0), ops.RemoveField('value'),
+               ops.Project(['a', 'b', 'c'])]
+    old = best_time(lambda: sum(1 for _ in old_map_chain(mappers, (row.copy() for row in rows))))
+    new = best_time(lambda: sum(1 for _ in ops.FusedMap(mappers)(row.copy() for row in rows)))
+    report('map chain', old, new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Merge join on highly skewed keys.
+
+Run as `python -m compgraph.benchmarks.skewed_join`. For every case prints time, number of output rows and peak
+traced memory of joining streams in which one hot key owns most of the rows.
+"""
+import itertools
+import random
+import time
+import tracemalloc
+import typing as tp
+
+from compgraph.lib import operations as ops
+
+ROWS = 20000
+
+
+def skewed_rows(count: int, keys: int, hot_share: float, column: str, seed: int) -> tp.List[ops.TRow]:
+    """Rows sorted by 'key', hot_share of them have key 0, the rest are spread uniformly"""
+    rng = random.Random(seed)
+    rows = [{'key': 0 if rng.random() < hot_share else rng.randrange(1, keys), column: i} for i in range(count)]
+    rows.sort(key=ops.key_getter(['key']))
+    return rows
+
+
+def naive_join(rows_a: ops.TRowsIterable, rows_b: ops.TRowsIterable) -> ops.TRowsGenerator:
+    """Merge join materializing both sides of every key group"""
+    right_groups = {key: list(group) for key, group in itertools.groupby(rows_b, key=ops.key_getter(['key']))}
+    joiner = ops.InnerJoiner()
+    for key, group in itertools.groupby(rows_a, key=ops.key_getter(['key'])):
+        yield from joiner.common_join(list(group), right_groups.get(key, []), ['key'])
+
+
+def measure(name: str, run: tp.Callable[[], ops.TRowsIterable]) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    row_count = sum(1 for _ in run())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<36} {:8.3f}s {:>10} rows  peak {:8.1f} KiB'.format(name, elapsed, row_count, peak / 1024))
+
+
+def main() -> None:
+    # the left table has few hot rows, the right one is dominated by the hot key; max_rows=4 spills hot groups
+    left = skewed_rows(ROWS // 100, ROWS // 100, 0.05, 'left', seed=0)
+    right = skewed_rows(ROWS, ROWS // 100, 0.9, 'right', seed=1)
+
+    measure('naive', lambda: naive_join(iter(left), iter(right)))
+    for max_rows in [ops.DEFAULT_JOIN_ROWS, 4]:
+        join = ops.Join(ops.InnerJoiner(), keys=['key'], max_rows=max_rows)
+        measure('merge, max_rows={}'.format(max_rows), lambda: join(iter(left), iter(right)))
+        measure('merge swapped, max_rows={}'.format(max_rows), lambda: join(iter(right), iter(left)))
+
+
+if __name__ == '__main__':
+    main()
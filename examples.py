@@ -12,9 +12,7 @@ def yandex_maps_from_file_heavy() -> None:
         weekday_result_column='weekday', hour_result_column='hour', speed_result_column='speed'
     )
 
-    result = graph.run()
-
-    for row in result:
+    for row in graph.run_iter():
         print(row)
 
 
@@ -25,7 +23,5 @@ def word_count_from_file_heavy() -> None:
 
     graph = graphs.word_count_graph_from_file('./resource/text_corpus.txt')
 
-    result = graph.run()
-
-    for row in result:
+    for row in graph.run_iter():
         print(row)
@@ -62,7 +62,8 @@ def pmi_graph(input_stream_name: str, doc_column: str = 'doc_id', text_column: s
         .map(operations.Split(text_column)) \
         .sort([doc_column, text_column]) \
         .reduce(operations.Count("count_in_doc"), [text_column, doc_column]) \
-        .map(operations.Filter(lambda x: len(x[text_column]) > 4 and x["count_in_doc"] >= 2))
+        .map(operations.Filter(lambda x: len(x[text_column]) > 4, columns=[text_column])) \
+        .map(operations.Filter(lambda x: x["count_in_doc"] >= 2, columns=["count_in_doc"]))
 
     graph2 = Graph.graph_from_graph(graph1) \
         .map(operations.AddField("tmp", 1)) \
@@ -92,7 +93,7 @@ def yandex_maps_graph(input_stream_name_time: str, input_stream_name_length: str
     """Constructs graph which measures average speed in km/h depending on the weekday and hour"""
 
     graph1 = Graph.graph_from_iter(input_stream_name_length) \
-        .map(operations.StreetLength(start_coord_column, end_coord_column, "length")) \
+        .map(operations.StreetLength(start_coord_column, end_coord_column, "length"), vectorized=True) \
         .map(operations.Project([edge_id_column, "length"])) \
         .sort([edge_id_column])
 
@@ -104,9 +105,9 @@ def yandex_maps_graph(input_stream_name_time: str, input_stream_name_length: str
         .reduce(operations.Count("count"), [edge_id_column, weekday_result_column, hour_result_column, "duration"]) \
         .join(operations.InnerJoiner(), graph1, [edge_id_column]) \
         .map(operations.RemoveField(edge_id_column)) \
-        .sort([weekday_result_column, hour_result_column]) \
         .reduce(operations.MeanSpeed("duration", "length", speed_result_column, "count"),
-                [weekday_result_column, hour_result_column])
+                [weekday_result_column, hour_result_column], strategy='hash') \
+        .sort([weekday_result_column, hour_result_column])
 
     return graph2
 
@@ -121,7 +122,7 @@ def yandex_maps_graph_from_file(input_filename_name_time: str, input_filename_na
     Reads data from file"""
 
     graph1 = Graph.graph_from_file(input_filename_name_length) \
-        .map(operations.StreetLength(start_coord_column, end_coord_column, "length")) \
+        .map(operations.StreetLength(start_coord_column, end_coord_column, "length"), vectorized=True) \
         .map(operations.Project([edge_id_column, "length"])) \
         .sort([edge_id_column])
 
@@ -133,9 +134,9 @@ def yandex_maps_graph_from_file(input_filename_name_time: str, input_filename_na
         .reduce(operations.Count("count"), [edge_id_column, weekday_result_column, hour_result_column, "duration"]) \
         .join(operations.InnerJoiner(), graph1, [edge_id_column]) \
         .map(operations.RemoveField(edge_id_column)) \
-        .sort([weekday_result_column, hour_result_column]) \
         .reduce(operations.MeanSpeed("duration", "length", speed_result_column, "count"),
-                [weekday_result_column, hour_result_column])
+                [weekday_result_column, hour_result_column], strategy='hash') \
+        .sort([weekday_result_column, hour_result_column])
 
     return graph2
 
@@ -0,0 +1,71 @@
+import importlib.util
+import typing as tp
+
+from functools import lru_cache
+
+from .rows import TRow
+
+BATCH_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def available() -> bool:
+    """Whether NumPy is installed; columnar mode is optional, without NumPy graphs run row by row"""
+    return importlib.util.find_spec('numpy') is not None
+
+
+def numpy() -> tp.Any:
+    """NumPy module, imported on first use, so that row by row runs do not pay for it"""
+    import numpy
+    return numpy
+
+
+class RowBatch:
+    """Batch of rows with columns as NumPy arrays.
+
+    Array of a column is built from rows on first access. Columns set by vectorized operations are kept as arrays,
+    so the next operations of the batch read them without conversion, and are written back into rows by `to_rows`.
+    """
+
+    def __init__(self, rows: tp.List[TRow]) -> None:
+        """
+        @param rows: rows of the batch, `to_rows` updates them in place
+        """
+        self.rows = rows
+        self._columns: tp.Dict[str, tp.Any] = {}
+        self._changed: tp.Dict[str, None] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def column(self, name: str) -> tp.Any:
+        """Array of values of column"""
+        array = self._columns.get(name)
+        if array is None:
+            array = self._columns[name] = numpy().array([row[name] for row in self.rows])
+        return array
+
+    def set_column(self, name: str, values: tp.Any) -> None:
+        """Set column to array of len(self) values"""
+        self._columns[name] = values
+        self._changed[name] = None
+
+    def to_rows(self) -> tp.List[TRow]:
+        """Rows of the batch with changed columns written back as Python values"""
+        for name in self._changed:
+            for row, value in zip(self.rows, self._columns[name].tolist()):
+                row[name] = value
+        self._changed.clear()
+        return self.rows
+
+
+def run_starts(columns: tp.Sequence[tp.Any], length: int) -> tp.Any:
+    """Indices where runs of equal values of columns begin, as for itertools.groupby over rows"""
+    np = numpy()
+    changed = np.zeros(max(length - 1, 0), dtype=bool)
+    for column in columns:
+        different = column[1:] != column[:-1]
+        if different.ndim > 1:
+            different = different.reshape(len(different), -1).any(axis=1)
+        changed |= different
+    return np.concatenate(([0], np.flatnonzero(changed) + 1)) if length else np.zeros(0, dtype=np.intp)
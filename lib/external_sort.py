@@ -1,22 +1,174 @@
+import heapq
+import itertools
+import sys
+import tempfile
 import typing as tp
 
 from multiprocessing import Pipe, Process, connection
 from operator import itemgetter
 
 from . import operations as ops
+from . import records
+from . import spill
 
+DEFAULT_MEMORY_LIMIT = 64 * 1024 ** 2
+IN_PROCESS_MEMORY_LIMIT = 8 * 1024 ** 2
+MAX_MERGE_FAN_IN = 64
 
-def do_sort(endpoint: connection.Connection, keys: tp.Tuple[str, ...]) -> None:
-    rows = []
+
+def estimate_row_size(row: ops.TRow) -> int:
+    """Rough estimation of memory occupied by row, in bytes"""
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
+
+def merge_runs(runs: tp.List[tp.Iterable[tp.Any]], key: tp.Optional[tp.Callable[[tp.Any], tp.Any]],
+               directory: str) -> tp.Iterable[tp.Any]:
+    """Merge sorted runs into one sorted stream.
+    heapq.merge breaks ties by run index, so merging runs written in input order keeps the sort stable.
+    If there are too many runs to keep open at once, they are merged into bigger runs first.
+    """
+    while len(runs) > MAX_MERGE_FAN_IN:
+        merged_runs: tp.List[tp.Iterable[tp.Any]] = []
+        for i in range(0, len(runs), MAX_MERGE_FAN_IN):
+            merged = spill.SpillFile(directory)
+            merged.extend(heapq.merge(*runs[i:i + MAX_MERGE_FAN_IN], key=key))
+            merged.close()
+            merged_runs.append(merged)
+        runs = merged_runs
+    return heapq.merge(*runs, key=key)
+
+
+def sort_items(items: tp.Iterable[tp.Any], key: tp.Optional[tp.Callable[[tp.Any], tp.Any]],
+               size: tp.Callable[[tp.Any], int], memory_limit: int,
+               tmp_dir: tp.Optional[str], governor: tp.Any = None,
+               spilled: tp.Optional[tp.Callable[[tp.Any], tp.Any]] = None) -> tp.Generator[tp.Any, None, None]:
+    """External merge sort. Items are collected into runs of at most memory_limit bytes (estimated with size),
+    each run is sorted and spilled to a temporary file, then runs are merged while streaming.
+    Under pressure of memory governor (see spill.should_spill) runs are spilled earlier.
+    Result is the same as sorted(items, key=key), up to spilled, which converts items written to spill files.
+    """
+    run: tp.List[tp.Any] = []
+    run_size = 0
+    runs: tp.List[tp.Iterable[tp.Any]] = []
+    with tempfile.TemporaryDirectory(prefix='compgraph-sort-', dir=tmp_dir) as directory:
+        for item in items:
+            run.append(item)
+            run_size += size(item)
+            if run_size >= memory_limit or (len(run) % spill.PRESSURE_MIN_ROWS == 0
+                                            and spill.should_spill(governor, len(run), 'sort')):
+                run.sort(key=key)
+                run_file = spill.SpillFile(directory)
+                run_file.extend(run if spilled is None else map(spilled, run))
+                run_file.close()
+                runs.append(run_file)
+                run, run_size = [], 0
+        run.sort(key=key)
+        if not runs:
+            yield from run
+            return
+        runs.append(run)
+        yield from merge_runs(runs, key, directory)
+
+
+def sort_rows(rows: ops.TRowsIterable, keys: tp.Sequence[str], memory_limit: int = DEFAULT_MEMORY_LIMIT,
+              tmp_dir: tp.Optional[str] = None, governor: tp.Any = None,
+              compact: bool = False) -> ops.TRowsGenerator:
+    """External merge sort of rows, same result as sorted(rows, key=itemgetter(*keys)).
+
+    @param rows: rows to sort
+    @param keys: sorting keys
+    @param memory_limit: memory budget for one in-memory run, in bytes
+    @param tmp_dir: directory for spilled runs, system default if None
+    @param governor: memory governor of the run, see spill.should_spill
+    @param compact: keep rows of in-memory runs as records (see records.Record), so more of them fit into a run;
+    spilled runs are written and sorted rows come out as dicts
+    """
+    if not compact:
+        yield from sort_items(rows, itemgetter(*keys), estimate_row_size, memory_limit, tmp_dir, governor)
+        return
+    yield from map(records.to_dict, sort_items(map(records.compact, rows), itemgetter(*keys), estimate_row_size,
+                                               memory_limit, tmp_dir, governor, records.to_dict))
+
+
+def send_rows(endpoint: connection.Connection, rows: tp.Iterable[tp.Any], chunk_size: int,
+              profiler: tp.Any = None) -> int:
+    """Send rows through the pipe in pickled chunks of chunk_size rows.
+    Every chunk is one length-prefixed message (see Connection.send_bytes), an empty message marks the end.
+
+    @param profiler: profiler of the run, counts bytes sent (see profiling.Profiler)
+    @return: number of rows sent
+    """
+    row_count = 0
+    for chunk in spill.iter_chunks(rows, chunk_size):
+        payload = spill.dump_chunk(chunk)
+        endpoint.send_bytes(payload)
+        row_count += len(chunk)
+        if profiler is not None:
+            profiler.add('pipe_bytes_sent', len(payload))
+    endpoint.send_bytes(b'')
+    return row_count
+
+
+def receive_chunks(endpoint: connection.Connection,
+                   profiler: tp.Any = None) -> tp.Generator[tp.List[tp.Any], None, None]:
+    """Receive chunks sent with send_rows until the end mark, profiler counts bytes received"""
     while True:
-        row = endpoint.recv()
-        if row is None:
+        payload = endpoint.recv_bytes()
+        if not payload:
             break
-        rows.append(row)
-    rows.sort(key=itemgetter(*keys))
-    for row in rows:
-        endpoint.send(row)
-    endpoint.send(None)
+        if profiler is not None:
+            profiler.add('pipe_bytes_received', len(payload))
+        yield spill.load_chunk(payload)
+
+
+def receive_rows(endpoint: connection.Connection, profiler: tp.Any = None) -> ops.TRowsGenerator:
+    """Receive rows sent with send_rows until the end mark"""
+    for chunk in receive_chunks(endpoint, profiler):
+        yield from chunk
+
+
+def stop_processes(processes: tp.List[Process], endpoints: tp.List[connection.Connection]) -> None:
+    """Close pipes of sorting processes and terminate the ones which did not finish: when input of the sort
+    raised or its output was not read to the end, they would wait for rows forever and block exit of interpreter"""
+    for endpoint in endpoints:
+        endpoint.close()
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def do_sort(endpoint: connection.Connection, keys: tp.Tuple[str, ...], memory_limit: int,
+            tmp_dir: tp.Optional[str], chunk_size: int, compact: bool = False) -> None:
+    send_rows(endpoint, sort_rows(receive_rows(endpoint), keys, memory_limit, tmp_dir, compact=compact), chunk_size)
+
+
+def do_partial_sort(endpoint: connection.Connection, keys: tp.Tuple[str, ...], memory_limit: int,
+                    tmp_dir: tp.Optional[str], chunk_size: int, worker: int, workers: int,
+                    compact: bool = False) -> None:
+    """Sort one partition of rows for parallel ExternalSort.
+    The worker receives every workers-th chunk starting from chunk number worker and sends back
+    (key, sequence number, row) triples; the sequence number restores input order of equal keys during merge.
+    """
+    getter = itemgetter(*keys)
+
+    def tagged_rows() -> tp.Generator[tp.Tuple[tp.Any, int, ops.TRow], None, None]:
+        for chunk_index, chunk in enumerate(receive_chunks(endpoint)):
+            first = (worker + chunk_index * workers) * chunk_size
+            for position, row in enumerate(chunk):
+                yield getter(row), first + position, records.compact(row) if compact else row
+
+    def size(item: tp.Tuple[tp.Any, int, ops.TRow]) -> int:
+        return estimate_row_size(item[2])
+
+    def expand(item: tp.Tuple[tp.Any, int, ops.TRow]) -> tp.Tuple[tp.Any, int, ops.TRow]:
+        return item[0], item[1], records.to_dict(item[2])
+
+    if not compact:
+        send_rows(endpoint, sort_items(tagged_rows(), None, size, memory_limit, tmp_dir), chunk_size)
+        return
+    send_rows(endpoint, map(expand, sort_items(tagged_rows(), None, size, memory_limit, tmp_dir, spilled=expand)),
+              chunk_size)
 
 
 class ExternalSort(ops.Operation):
@@ -24,26 +176,129 @@ class ExternalSort(ops.Operation):
     In order to not account materialization during sorting in main process memory consumption, we delegate
     sorting to a separate process.
     This class illustrates cross-process streaming.
+    The child process keeps at most memory_limit bytes of rows in memory, the rest is spilled to tmp_dir.
+    Rows cross the pipe in chunks of chunk_size rows, so the child sorts runs while the parent still produces rows.
+    With several workers chunks are dealt round-robin to worker processes, each of them sorts its part
+    and the sorted parts are merged in the main process.
+    Under memory governor of the run the sorting processes share a budget taken from the headroom left
+    at the start of the sort (see MemoryGovernor.budget), if it is less than memory_limit per process.
+    With 'compact_rows' run option sorting processes keep rows as records (see sort_rows).
     """
 
-    def __init__(self, keys: tp.Sequence[str]):
+    def __init__(self, keys: tp.Sequence[str], memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                 tmp_dir: tp.Optional[str] = None, chunk_size: int = spill.CHUNK_SIZE,
+                 workers: tp.Optional[int] = None):
+        """
+        @param keys: sorting keys
+        @param memory_limit: memory budget of sorting process for one sorted run, in bytes
+        @param tmp_dir: directory for spilled runs, system default if None
+        @param chunk_size: number of rows sent through the pipe at once
+        @param workers: number of sorting processes; if None, 'sort_workers' run option is used (1 by default)
+        """
         self.keys = keys
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def output_order(self, *input_orders: ops.TOrder) -> ops.TOrder:
+        """The sort is stable, so rows with equal keys stay in input order"""
+        return tuple(self.keys) + tuple(column for column in input_orders[0] if column not in self.keys)
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def input_columns(self, columns: ops.TColumns) -> ops.TColumns:
+        return ops.union_columns(columns, frozenset(self.keys))
 
     def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        workers = self.workers or kwargs.get('sort_workers') or 1
+        compact = kwargs.get('compact_rows', False)
+        memory_limit = self.memory_limit
+        governor = kwargs.get('governor')
+        if governor is not None:
+            memory_limit = governor.budget(memory_limit * workers) // workers
+        if workers > 1:
+            yield from self._parallel_sort(rows, workers, memory_limit, compact, kwargs.get('profiler'))
+            return
         local_endpoint, remote_endpoint = Pipe()
-        process = Process(target=do_sort, args=(remote_endpoint, self.keys))
+        process = Process(target=do_sort,
+                          args=(remote_endpoint, self.keys, memory_limit, self.tmp_dir, self.chunk_size, compact))
         process.start()
-        row_count_before = 0
-        for row in rows:
-            local_endpoint.send(row)
-            row_count_before += 1
-        local_endpoint.send(None)
-        row_count_after = 0
-        while True:
-            local_endpoint_row = local_endpoint.recv()
-            if local_endpoint_row is None:
-                break
-            yield local_endpoint_row
-            row_count_after += 1
-        assert row_count_before == row_count_after
-        process.join()
+        profiler = kwargs.get('profiler')
+        try:
+            row_count_before = send_rows(local_endpoint, rows, self.chunk_size, profiler)
+            row_count_after = 0
+            for row in receive_rows(local_endpoint, profiler):
+                yield row
+                row_count_after += 1
+            assert row_count_before == row_count_after
+        finally:
+            stop_processes([process], [local_endpoint])
+
+    def _parallel_sort(self, rows: ops.TRowsIterable, workers: int, memory_limit: int, compact: bool,
+                       profiler: tp.Any) -> ops.TRowsGenerator:
+        endpoints = []
+        processes = []
+        for worker in range(workers):
+            local_endpoint, remote_endpoint = Pipe()
+            process = Process(target=do_partial_sort,
+                              args=(remote_endpoint, self.keys, memory_limit, self.tmp_dir, self.chunk_size,
+                                    worker, workers, compact))
+            process.start()
+            endpoints.append(local_endpoint)
+            processes.append(process)
+        try:
+            row_count_before = 0
+            for chunk_index, chunk in enumerate(spill.iter_chunks(rows, self.chunk_size)):
+                payload = spill.dump_chunk(chunk)
+                endpoints[chunk_index % workers].send_bytes(payload)
+                row_count_before += len(chunk)
+                if profiler is not None:
+                    profiler.add('pipe_bytes_sent', len(payload))
+            for endpoint in endpoints:
+                endpoint.send_bytes(b'')
+            row_count_after = 0
+            # sequence numbers are unique, so rows themselves are never compared
+            for _, _, row in heapq.merge(*[receive_rows(endpoint, profiler) for endpoint in endpoints]):
+                yield row
+                row_count_after += 1
+            assert row_count_before == row_count_after
+        finally:
+            stop_processes(processes, endpoints)
+
+
+class PartialSort(ops.Operation):
+    """Sort of rows already sorted by a prefix of sorting keys.
+    Every group of rows with equal prefix is sorted separately in the main process (spilling to disk if the group
+    is larger than memory_limit or under memory pressure), which gives the same result as the full stable sort.
+    """
+
+    def __init__(self, prefix: tp.Sequence[str], keys: tp.Sequence[str],
+                 memory_limit: int = IN_PROCESS_MEMORY_LIMIT, tmp_dir: tp.Optional[str] = None) -> None:
+        """
+        @param prefix: keys the input is already sorted by, a prefix of keys
+        @param keys: sorting keys
+        @param memory_limit: memory budget for one in-memory run, in bytes
+        @param tmp_dir: directory for spilled runs, system default if None
+        """
+        assert tuple(keys[:len(prefix)]) == tuple(prefix)
+        self.prefix = prefix
+        self.keys = keys
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+
+    def output_order(self, *input_orders: ops.TOrder) -> ops.TOrder:
+        return tuple(self.keys) + tuple(column for column in input_orders[0] if column not in self.keys)
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def input_columns(self, columns: ops.TColumns) -> ops.TColumns:
+        return ops.union_columns(columns, frozenset(self.keys))
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        suffix = self.keys[len(self.prefix):]
+        governor, compact = kwargs.get('governor'), kwargs.get('compact_rows', False)
+        for _, group in itertools.groupby(rows, key=itemgetter(*self.prefix)):
+            yield from sort_rows(group, suffix, self.memory_limit, self.tmp_dir, governor, compact)
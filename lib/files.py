@@ -0,0 +1,450 @@
+import glob
+import json
+import marshal
+import os
+import re
+import sys
+import typing as tp
+
+from functools import partial
+
+from . import operations as ops
+from . import parallel
+from . import spill
+
+# Binary row file: magic header, then chunks of rows encoded with marshal, length-prefixed as frames of spill files.
+# Unlike pickle, marshal only builds values, so reading a file never runs code. Values may be of JSON types,
+# tuples, sets and bytes. Row files are read only when asked for (format 'rows' of read_files), never by header.
+ROW_FILE_MAGIC = b'CGROWS\x00\x02'
+ROW_FILE_CHUNK_SIZE = 4096
+READ_BLOCK_SIZE = 1 << 20
+SHARD_SIZE = 1 << 22
+
+# Compressed files are recognized by header (a pattern matched at the start of file), output compression is chosen
+# by suffix of filename. bz2 header includes block size digit and magic of the first block (or of the end of an empty
+# stream), as 'BZh' alone may start a text file. zstd needs zstandard package, the rest are in the standard library.
+COMPRESSION_MAGIC = {'gzip': re.compile(rb'\x1f\x8b'), 'bz2': re.compile(rb'BZh[1-9](?:1AY&SY|\x17rE8P\x90)'),
+                     'xz': re.compile(rb'\xfd7zXZ\x00'), 'zstd': re.compile(rb'\x28\xb5\x2f\xfd')}
+COMPRESSION_HEADER_SIZE = 10
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zstd'}
+# Levels used for writing. Default xz preset needs about 94 MiB for compression, preset 1 about 9 MiB.
+COMPRESSION_LEVELS = {'gzip': 6, 'bz2': 9, 'xz': 1, 'zstd': 3}
+
+# 'text' - one row per line, parsed by parser; 'rows' - binary row file
+FILE_FORMATS = ('text', 'rows')
+
+# (filename, start offset, end offset or None for the end of file, whether the file is a row file)
+TShard = tp.Tuple[str, int, tp.Optional[int], bool]
+
+if sys.version_info >= (3, 13):
+    _load_row_chunk = partial(marshal.loads, allow_code=False)
+else:
+    _load_row_chunk = marshal.loads
+
+
+def detect_compression(filename: str) -> tp.Optional[str]:
+    """Compression of file recognized by header (a key of COMPRESSION_MAGIC), None for uncompressed file"""
+    with open(filename, 'rb') as file:
+        header = file.read(COMPRESSION_HEADER_SIZE)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if magic.match(header):
+            return compression
+    return None
+
+
+def open_compressed(filename: str, compression: str, mode: str) -> tp.BinaryIO:
+    """Open compressed file as binary stream of uncompressed data
+
+    @param filename: file to open
+    @param compression: a key of COMPRESSION_MAGIC
+    @param mode: 'rb' or 'wb'
+    """
+    level = COMPRESSION_LEVELS.get(compression)
+    if compression == 'gzip':
+        import gzip
+        return tp.cast(tp.BinaryIO, gzip.open(filename, mode, compresslevel=level))
+    if compression == 'bz2':
+        import bz2
+        return tp.cast(tp.BinaryIO, bz2.open(filename, mode, compresslevel=level))
+    if compression == 'xz':
+        import lzma
+        return tp.cast(tp.BinaryIO, lzma.open(filename, mode, preset=None if mode == 'rb' else level))
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd compression of {} needs zstandard package'.format(filename)) from None
+        file = open(filename, mode)
+        if mode == 'rb':
+            return zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True, closefd=True)
+        return zstandard.ZstdCompressor(level=level).stream_writer(file, closefd=True)
+    raise ValueError('Unknown compression {!r}'.format(compression))
+
+
+def open_input(filename: str) -> tp.BinaryIO:
+    """Open file for binary reading, compressed files are decompressed on the fly"""
+    compression = detect_compression(filename)
+    return open(filename, 'rb') if compression is None else open_compressed(filename, compression, 'rb')
+
+
+def open_output(filename: str, compression: tp.Optional[str] = 'infer') -> tp.BinaryIO:
+    """Create file for binary writing
+
+    @param filename: file to create
+    @param compression: a key of COMPRESSION_MAGIC, None for no compression,
+        'infer' to choose it by suffix of filename (see COMPRESSION_SUFFIXES)
+    """
+    if compression == 'infer':
+        compression = COMPRESSION_SUFFIXES.get(os.path.splitext(filename)[1])
+    return open(filename, 'wb') if compression is None else open_compressed(filename, compression, 'wb')
+
+
+def is_row_file(filename: str) -> bool:
+    """Whether file (decompressed, if compressed) starts with ROW_FILE_MAGIC. Readers do not use it to choose
+    the format of a file, see FILE_FORMATS."""
+    with open_input(filename) as file:
+        return file.read(len(ROW_FILE_MAGIC)) == ROW_FILE_MAGIC
+
+
+class RowFileWriter:
+    """Writer of binary row files, rows are buffered and written in chunks of chunk_size rows"""
+
+    def __init__(self, filename: str, chunk_size: int = ROW_FILE_CHUNK_SIZE,
+                 compression: tp.Optional[str] = 'infer') -> None:
+        """
+        @param filename: file to create
+        @param chunk_size: number of rows encoded together
+        @param compression: compression of file, see open_output
+        """
+        self._file = open_output(filename, compression)
+        self._file.write(ROW_FILE_MAGIC)
+        self._chunk: tp.List[ops.TRow] = []
+        self.chunk_size = chunk_size
+        self.row_count = 0
+
+    def write(self, row: ops.TRow) -> None:
+        self._chunk.append(row)
+        self.row_count += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._flush()
+
+    def extend(self, rows: ops.TRowsIterable) -> None:
+        for chunk in spill.iter_chunks(rows, self.chunk_size):
+            self._chunk.extend(chunk)
+            self.row_count += len(chunk)
+            if len(self._chunk) >= self.chunk_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self._chunk:
+            spill.write_frame(self._file, marshal.dumps(self._chunk))
+            self._chunk = []
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._flush()
+            self._file.close()
+
+    def __enter__(self) -> 'RowFileWriter':
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
+
+
+def write_row_file(filename: str, rows: ops.TRowsIterable, chunk_size: int = ROW_FILE_CHUNK_SIZE,
+                   compression: tp.Optional[str] = 'infer') -> int:
+    """Write rows to binary row file, compressed according to compression (see open_output).
+    Values of other types than listed at ROW_FILE_MAGIC raise ValueError.
+
+    @return: number of rows written
+    """
+    with RowFileWriter(filename, chunk_size, compression) as writer:
+        writer.extend(rows)
+    return writer.row_count
+
+
+def read_row_chunks(filename: str, start: int = 0,
+                    end: tp.Optional[int] = None) -> tp.Generator[tp.List[ops.TRow], None, None]:
+    """Read chunks of rows from binary row file
+
+    @param filename: file to read
+    @param start: offset of the first chunk to read, 0 for the first one (see frame_aligned_shards)
+    @param end: offset after the last chunk to read, None for the end of file
+    """
+    compression = detect_compression(filename)
+    with open_input(filename) as file:
+        if file.read(len(ROW_FILE_MAGIC)) != ROW_FILE_MAGIC:
+            raise ValueError('{} is not a row file'.format(filename))
+        if compression is not None:
+            if start != 0 or end is not None:
+                raise ValueError('Compressed file {} can not be read by byte ranges'.format(filename))
+            for payload in parallel.prefetch(spill.read_frames(file)):
+                yield _load_row_chunk(payload)
+            return
+        file.seek(max(start, len(ROW_FILE_MAGIC)))
+        for payload in spill.read_frames(file):
+            yield _load_row_chunk(payload)
+            if end is not None and file.tell() >= end:
+                return
+
+
+def read_row_file(filename: str, start: int = 0, end: tp.Optional[int] = None) -> ops.TRowsGenerator:
+    """Read rows from binary row file, see read_row_chunks"""
+    for chunk in read_row_chunks(filename, start, end):
+        yield from chunk
+
+
+def frame_aligned_shards(filename: str, shard_size: int = SHARD_SIZE) -> tp.List[tp.Tuple[int, int]]:
+    """Split uncompressed binary row file into byte ranges of whole chunks, about shard_size bytes each.
+    Only frame headers are read.
+
+    @return: list of (start, end) offsets, for read_row_chunks
+    """
+    bounds = [len(ROW_FILE_MAGIC)]
+    with open(filename, 'rb') as file:
+        file.seek(len(ROW_FILE_MAGIC))
+        while True:
+            header = file.read(spill.FRAME_HEADER.size)
+            if not header:
+                break
+            (length,) = spill.FRAME_HEADER.unpack(header)
+            position = file.seek(length, os.SEEK_CUR)
+            if position - bounds[-1] >= shard_size:
+                bounds.append(position)
+        if file.tell() > bounds[-1]:
+            bounds.append(file.tell())
+    return list(zip(bounds, bounds[1:]))
+
+
+def convert_json_lines(source: str, destination: str, parser: tp.Callable[[str], ops.TRow] = json.loads,
+                       chunk_size: int = ROW_FILE_CHUNK_SIZE) -> int:
+    """Convert text file with one row per line to binary row file, so repeated runs skip parsing
+
+    @param source: text file to read
+    @param destination: row file to create
+    @param parser: parser from line to row
+    @param chunk_size: number of rows encoded together
+    @return: number of rows converted
+    """
+    return write_row_file(destination, read_text_rows(source, parser), chunk_size)
+
+
+class TextFileWriter:
+    """Writer of text files with one row per line, rows are buffered, formatted and written in chunks
+    of chunk_size rows"""
+
+    def __init__(self, filename: str, formatter: tp.Callable[[ops.TRow], str] = json.dumps,
+                 compression: tp.Optional[str] = 'infer', chunk_size: int = ROW_FILE_CHUNK_SIZE) -> None:
+        """
+        @param filename: file to create
+        @param formatter: formatter from row to line without line end
+        @param compression: compression of file, see open_output
+        @param chunk_size: number of rows written at once
+        """
+        self._file = open_output(filename, compression)
+        self._chunk: tp.List[ops.TRow] = []
+        self.formatter = formatter
+        self.chunk_size = chunk_size
+        self.row_count = 0
+
+    def write(self, row: ops.TRow) -> None:
+        self._chunk.append(row)
+        self.row_count += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._flush()
+
+    def extend(self, rows: ops.TRowsIterable) -> None:
+        for chunk in spill.iter_chunks(rows, self.chunk_size):
+            self._chunk.extend(chunk)
+            self.row_count += len(chunk)
+            if len(self._chunk) >= self.chunk_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self._chunk:
+            formatter = self.formatter
+            self._file.write(''.join([formatter(row) + '\n' for row in self._chunk]).encode())
+            self._chunk = []
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._flush()
+            self._file.close()
+
+    def __enter__(self) -> 'TextFileWriter':
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
+
+
+def write_text_rows(filename: str, rows: ops.TRowsIterable, formatter: tp.Callable[[ops.TRow], str] = json.dumps,
+                    compression: tp.Optional[str] = 'infer', chunk_size: int = ROW_FILE_CHUNK_SIZE) -> int:
+    """Write rows to text file, one row per line (see TextFileWriter)
+
+    @return: number of rows written
+    """
+    with TextFileWriter(filename, formatter, compression, chunk_size) as writer:
+        writer.extend(rows)
+    return writer.row_count
+
+
+def read_line_batches(filename: str, start: int = 0, end: tp.Optional[int] = None,
+                      block_size: int = READ_BLOCK_SIZE) -> tp.Generator[tp.List[bytes], None, None]:
+    """Read lines of file in batches: file is read in binary blocks of block_size bytes, every block is split
+    into lines at once. Empty lines are skipped, line ends ('\n' or '\r\n') are not included.
+    Compressed files are decompressed in a background thread, so decompression overlaps with processing of lines;
+    they can be read only as a whole.
+
+    @param filename: file to read
+    @param start: offset of the first byte to read, has to be a start of a line (see line_aligned_shards)
+    @param end: offset after the last byte to read, a start of a line or the end of file; None for the end of file
+    @param block_size: number of bytes read at once
+    """
+    compression = detect_compression(filename)
+    if compression is not None:
+        if start != 0 or end is not None:
+            raise ValueError('Compressed file {} can not be read by byte ranges'.format(filename))
+        with open_compressed(filename, compression, 'rb') as file:
+            yield from split_lines(parallel.prefetch(iter(partial(file.read, block_size), b'')))
+        return
+    with open(filename, 'rb') as file:
+        yield from split_lines(read_blocks(file, start, end, block_size))
+
+
+def read_blocks(file: tp.BinaryIO, start: int, end: tp.Optional[int],
+                block_size: int) -> tp.Generator[bytes, None, None]:
+    """Read bytes from start to end (None for the end of file) of file in blocks of block_size bytes"""
+    file.seek(start)
+    remaining = (os.fstat(file.fileno()).st_size if end is None else end) - start
+    while remaining > 0:
+        block = file.read(min(block_size, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+
+
+def split_lines(blocks: tp.Iterable[bytes]) -> tp.Generator[tp.List[bytes], None, None]:
+    """Split stream of blocks into batches of non-empty lines without line ends ('\n' or '\r\n')"""
+    tail = b''
+    for block in blocks:
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        yield strip_line_ends(lines)
+    lines = strip_line_ends([tail])
+    if lines:
+        yield lines
+
+
+def strip_line_ends(lines: tp.List[bytes]) -> tp.List[bytes]:
+    """Drop '\r' left at the ends of lines split at '\n', and empty lines"""
+    if any(line.endswith(b'\r') for line in lines):
+        lines = [line[:-1] if line.endswith(b'\r') else line for line in lines]
+    return [line for line in lines if line]
+
+
+def line_aligned_shards(filename: str, shards: int) -> tp.List[tp.Tuple[int, int]]:
+    """Split file into at most shards byte ranges of about equal size, each of them starting at a start of a line
+
+    @return: list of (start, end) offsets, for read_line_batches
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as file:
+        for shard in range(1, shards):
+            position = max(size * shard // shards, bounds[-1])
+            file.seek(position)
+            if position > 0:
+                file.seek(position - 1)
+                file.readline()
+            bounds.append(min(file.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_text_rows(filename: str, parser: tp.Callable[[str], ops.TRow] = json.loads, start: int = 0,
+                   end: tp.Optional[int] = None) -> ops.TRowsGenerator:
+    """Read rows from text file with one row per line, parsing lines batch by batch
+
+    @param filename: file to read
+    @param parser: parser from decoded line (without line end) to row, e.g. json.loads or, to opt in to a faster
+        parser, orjson.loads (it differs from json.loads: rejects NaN and Infinity, reads big integers as floats)
+    @param start: see read_line_batches
+    @param end: see read_line_batches
+    """
+    for lines in read_line_batches(filename, start, end):
+        yield from map(parser, map(bytes.decode, lines))
+
+
+def read_rows(filename: str, parser: tp.Callable[[str], ops.TRow] = json.loads, start: int = 0,
+              end: tp.Optional[int] = None, format: str = 'text') -> ops.TRowsGenerator:
+    """Read rows from text file or binary row file, format is one of FILE_FORMATS"""
+    if format == 'rows':
+        yield from read_row_file(filename, start, end)
+    else:
+        yield from read_text_rows(filename, parser, start, end)
+
+
+def expand_pattern(pattern: str) -> tp.List[str]:
+    """Files matching glob pattern in sorted order, or the file itself if pattern has no wildcards"""
+    return sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+
+
+def file_shards(filenames: tp.Sequence[str], shard_size: int = SHARD_SIZE, format: str = 'text') -> tp.List[TShard]:
+    """Split files of format (one of FILE_FORMATS) into shards of about shard_size bytes: text files at line
+    starts, row files at chunks. Compressed files are not split."""
+    shards: tp.List[TShard] = []
+    for filename in filenames:
+        if detect_compression(filename) is not None:
+            shards.append((filename, 0, None, format == 'rows'))
+        elif format == 'rows':
+            shards.extend((filename, start, end, True) for start, end in frame_aligned_shards(filename, shard_size))
+        else:
+            count = -(-os.path.getsize(filename) // shard_size)
+            shards.extend((filename, start, end, False) for start, end in line_aligned_shards(filename, count))
+    return shards
+
+
+def read_shards(parser: tp.Callable[[str], ops.TRow], shards: tp.List[TShard],
+                columns: tp.Optional[tp.Collection[str]] = None) -> tp.List[ops.TRow]:
+    """Read rows of shards, used by worker processes of read_files; with columns rows keep only them"""
+    rows: tp.List[ops.TRow] = []
+    for filename, start, end, is_binary in shards:
+        if is_binary:
+            shard_rows = read_row_file(filename, start, end)
+        else:
+            shard_rows = read_text_rows(filename, parser, start, end)
+        rows.extend(shard_rows if columns is None else map(partial(ops.select_columns, columns), shard_rows))
+    return rows
+
+
+def read_files(pattern: str, parser: tp.Callable[[str], ops.TRow] = json.loads, workers: int = 1,
+               ordered: bool = True, shard_size: int = SHARD_SIZE,
+               columns: tp.Optional[tp.Collection[str]] = None, format: str = 'text') -> ops.TRowsGenerator:
+    """Read rows from file or glob of files.
+
+    With workers > 1 files are split into shards of about shard_size bytes which are parsed in a pool
+    of worker processes (parser has to be picklable); at most 2 * workers shards are in flight.
+    With columns rows keep only those of them they have, projected right after parsing (by the workers, if any).
+
+    @param pattern: filename or glob pattern
+    @param parser: parser from line to row for text files
+    @param workers: number of worker processes
+    @param ordered: keep order of rows with several workers, otherwise shards come as soon as they are parsed
+    @param shard_size: size of shard in bytes
+    @param columns: columns to keep, all if None
+    @param format: format of files, one of FILE_FORMATS; parser is not used for binary row files
+    """
+    if format not in FILE_FORMATS:
+        raise ValueError('Unknown file format: {}'.format(format))
+    filenames = expand_pattern(pattern)
+    if workers <= 1:
+        for filename in filenames:
+            rows = read_rows(filename, parser, format=format)
+            yield from rows if columns is None else map(partial(ops.select_columns, columns), rows)
+        return
+    shards = ([shard] for shard in file_shards(filenames, shard_size, format))
+    for rows in parallel.map_batches(partial(read_shards, parser, columns=columns), shards, workers, ordered):
+        yield from rows
@@ -4,17 +4,36 @@ import typing as tp
 from abc import abstractmethod, ABC
 from . import operations as ops
 from . import external_sort as exts
+from . import files
+from . import parallel
+from . import planner
+from . import sinks
+from . import spill
 from .operations import TRow, TRowsIterable, TRowsGenerator
 
 
-TNode = tp.Union['Node', 'NodeFromFile', 'NodeFromIter']
+TNode = tp.Union['Node', 'NodeFromFile', 'NodeFromIter', 'TeeBranchNode']
 
 
 class AbstractNode(ABC):
+    parents: tp.List[TNode] = []
+    sorted_by: ops.TOrder = ()
+    size_hint: tp.Optional[int] = None
+
+    def source_key(self) -> tp.Optional[tp.Hashable]:
+        """Key identifying data source of input node; input nodes with equal keys read the same data"""
+        return None
+
     @abstractmethod
-    def __call__(self, sources: tp.Dict[str, tp.Any]) -> tp.Generator[tp.Dict[str, tp.Any], None, None]:
+    def __call__(self, sources: tp.Dict[str, tp.Any],
+                 **options: tp.Any) -> tp.Generator[tp.Dict[str, tp.Any], None, None]:
         pass
 
+    def _output(self, rows: TRowsIterable, options: tp.Dict[str, tp.Any]) -> TRowsIterable:
+        """Output rows of node, measured by profiler if 'profiler' run option is set (see profiling.Profiler)"""
+        profiler = options.get('profiler')
+        return rows if profiler is None else profiler.track(self, rows)
+
 
 class Node(AbstractNode):
     """ Node of computational graph.
@@ -25,100 +44,248 @@ class Node(AbstractNode):
     def __init__(self, operation: ops.Operation, parents: tp.List[TNode]) -> None:
         self.operation = operation
         self.parents = parents
+        self.sorted_by = operation.output_order(*[parent.sorted_by for parent in parents])
+        self.size_hint = operation.output_size(*[parent.size_hint for parent in parents])
 
-    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]]) -> TRowsGenerator:
-        """ Starts computation in node, calling parent nodes if necessary."""
-        yield from self.operation(*[parent(sources) for parent in self.parents])
+    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]],
+                 **options: tp.Any) -> TRowsGenerator:
+        """ Starts computation in node, calling parent nodes if necessary.
+        Run options are passed to every operation as keyword arguments."""
+        rows = self.operation(*[parent(sources, **options) for parent in self.parents], **options)
+        yield from self._output(rows, options)
 
 
 class NodeFromFile(AbstractNode):
-    """Input node of computational graph which reads from file"""
-    def __init__(self, filename: str, parser: tp.Callable[[str], ops.TRow] = json.loads):
+    """Input node of computational graph which reads from file.
+    Text files are read in large blocks and split into lines, which are passed to parser without line ends.
+    Binary row files (format 'rows', see files.convert_json_lines) are decoded in chunks, parser is not used
+    for them; the format is never guessed from contents of files. Files compressed with gzip, bz2, xz or zstd
+    are recognized by header and decompressed in a background thread. Filename may be a glob pattern, matching files are read in sorted order.
+    With several workers files are split into shards parsed in worker processes (see files.read_files).
+    Columns, if set, are the only ones kept in rows; the planner sets them to the columns the graph uses
+    (see planner.prune_columns).
+    """
+    def __init__(self, filename: str, parser: tp.Callable[[str], ops.TRow] = json.loads,
+                 size_hint: tp.Optional[int] = None, workers: int = 1, ordered: bool = True,
+                 columns: tp.Optional[tp.FrozenSet[str]] = None, format: str = 'text'):
+        if format not in files.FILE_FORMATS:
+            raise ValueError('Unknown file format: {}'.format(format))
         self.filename = filename
-        self.operation = ops.ReadFromFile(parser)
+        self.parser = parser
+        self.size_hint = size_hint
+        self.workers = workers
+        self.ordered = ordered
+        self.columns = columns
+        self.format = format
+
+    def source_key(self) -> tp.Optional[tp.Hashable]:
+        # unordered parallel reading gives rows in another order, it is not shared with ordered reading
+        return 'file', self.filename, self.parser, self.workers > 1 and not self.ordered, self.columns, self.format
 
-    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]]) -> TRowsGenerator:
-        with open(self.filename, 'r') as file:
-            for line in file:
-                yield from self.operation(line)
+    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]],
+                 **options: tp.Any) -> TRowsGenerator:
+        yield from self._output(files.read_files(self.filename, self.parser, self.workers, self.ordered,
+                                                 columns=self.columns, format=self.format), options)
 
 
 class NodeFromIter(AbstractNode):
     """Input node of computational graph which reads from iterator"""
-    def __init__(self, iterator_name: str) -> None:
+    def __init__(self, iterator_name: str, size_hint: tp.Optional[int] = None) -> None:
         self.iterator_name = iterator_name
+        self.size_hint = size_hint
+
+    def source_key(self) -> tp.Optional[tp.Hashable]:
+        return 'iter', self.iterator_name
+
+    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]],
+                 **options: tp.Any) -> TRowsGenerator:
+        yield from self._output(sources[self.iterator_name](), options)  # type: ignore
+
+
+class TeeNode:
+    """Node shared by several consumers in a run plan: it is computed once and its output is fanned out
+    to the branches through spill.Tee"""
+    def __init__(self, node: TNode, consumers: int) -> None:
+        self.node = node
+        self.consumers = consumers
+        self.tee: tp.Optional[spill.Tee] = None
+        self.branch_count = 0
+
+    def branch(self) -> 'TeeBranchNode':
+        assert self.branch_count < self.consumers
+        self.branch_count += 1
+        return TeeBranchNode(self, self.branch_count - 1)
 
-    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]]) -> TRowsGenerator:
-        yield from sources[self.iterator_name]()  # type: ignore
+    def stream(self, index: int, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]],
+               **options: tp.Any) -> TRowsGenerator:
+        if self.tee is None:
+            self.tee = spill.Tee(self.node(sources, **options), self.consumers,
+                                 options.get('tee_buffer_size', spill.TEE_BUFFER_SIZE), options.get('tmp_dir'),
+                                 options.get('governor'), options.get('profiler'))
+        return self.tee.branch(index)
+
+
+class TeeBranchNode(AbstractNode):
+    """One consumer's view of TeeNode"""
+    def __init__(self, tee: TeeNode, index: int) -> None:
+        self.tee = tee
+        self.index = index
+        self.parents = [tee.node]
+        self.sorted_by = tee.node.sorted_by
+        self.size_hint = tee.node.size_hint
+
+    def __call__(self, sources: tp.Dict[str, tp.Callable[[TRow], TRowsIterable]],
+                 **options: tp.Any) -> TRowsGenerator:
+        yield from self._output(self.tee.stream(self.index, sources, **options), options)
 
 
 class Graph:
     """Computational graph implementation"""
 
-    def __init__(self, tail: TNode) -> None:
+    def __init__(self, tail: TNode, options: tp.Optional[tp.Dict[str, tp.Any]] = None) -> None:
         """ Граф вычислений состоит из объектов класса Graph соединенных ссылками через поля prevs и heads.
 
         @param tail: последний узел в графе, его output направляется пользователю
+        @param options: опции запуска графа, передаются всем операциям (например, sort_workers)
         """
         self.tail = tail
+        self.options = dict(options or {})
+
+    def with_options(self, **options: tp.Any) -> 'Graph':
+        """Construct new graph with the same nodes and updated run options, e.g.
+        graph.with_options(sort_workers=4).run(docs=...)
+        :param options: run options to override
+        """
+        return Graph(tail=self.tail, options={**self.options, **options})
 
     @staticmethod
-    def graph_from_iter(iterator: tp.Any) -> 'Graph':
+    def graph_from_iter(iterator: tp.Any, size_hint: tp.Optional[int] = None) -> 'Graph':
         """Construct new graph which reads data from row iterator (in form of sequence of Rows
         from 'kwargs' passed to 'run' method) or from another graph into graph data-flow
         :param iterator: name of kwarg to use as data source or Graph object
+        :param size_hint: expected number of rows, lets planner choose join strategy
         """
-        node = NodeFromIter(iterator)
+        node = NodeFromIter(iterator, size_hint)
         return Graph(tail=node)
 
     @staticmethod
-    def graph_from_file(filename: str, parser: tp.Callable[[str], ops.TRow] = json.loads) -> 'Graph':
+    def graph_from_file(filename: str, parser: tp.Callable[[str], ops.TRow] = json.loads,
+                        size_hint: tp.Optional[int] = None, workers: int = 1, ordered: bool = True,
+                        format: str = 'text') -> 'Graph':
         """Construct new graph extended with operation for reading rows from file
-        :param filename: filename to read from
-        :param parser: parser from string to Row
+        :param filename: filename or glob pattern to read from, possibly compressed (see files.COMPRESSION_MAGIC)
+        :param parser: parser from string to Row, not used for binary row files; has to be picklable with workers.
+            Text files are read in blocks and parser gets every non-empty line without its line end ('\n' or '\r\n'),
+            empty lines are skipped. json.loads is used as is; pass orjson.loads to opt in to faster parsing
+            (it rejects NaN and Infinity and reads integers beyond 64 bits as floats)
+        :param size_hint: expected number of rows, lets planner choose join strategy
+        :param workers: number of processes parsing shards of files
+        :param ordered: keep order of rows when reading with several workers
+        :param format: 'text' for files with one row per line, 'rows' for binary row files
+            (see files.convert_json_lines)
         """
-        node = NodeFromFile(filename, parser)
+        node = NodeFromFile(filename, parser, size_hint, workers, ordered, format=format)
         return Graph(tail=node)
 
     @staticmethod
     def graph_from_graph(graph: 'Graph') -> 'Graph':
-        return Graph(tail=graph.tail)
+        return Graph(tail=graph.tail, options=graph.options)
 
-    def map(self, mapper: ops.Mapper) -> 'Graph':
+    def map(self, mapper: ops.Mapper, workers: int = 1, batch_size: int = parallel.BATCH_SIZE,
+            ordered: bool = True, vectorized: bool = False) -> 'Graph':
         """Construct new graph extended with map operation with particular mapper
         :param mapper: mapper to use
+        :param workers: number of processes running the mapper (see operations.Map), mapper has to be picklable
+        :param batch_size: number of rows sent to a process or vectorized mapper at once
+        :param ordered: keep order of rows when workers > 1
+        :param vectorized: apply ops.BatchMapper to whole batches with NumPy
         """
-        node = Node(operation=ops.Map(mapper), parents=[self.tail])
+        node = Node(operation=ops.Map(mapper, workers, batch_size, ordered, vectorized=vectorized),
+                    parents=[self.tail])
         self.tail = node
         return self
 
-    def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str]) -> 'Graph':
+    def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str], strategy: str = 'sort',
+               max_groups: int = ops.DEFAULT_MAX_GROUPS, tmp_dir: tp.Optional[str] = None,
+               max_rows: int = ops.DEFAULT_HASH_REDUCE_ROWS) -> 'Graph':
         """Construct new graph extended with reduce operation with particular reducer
         :param reducer: reducer to use
         :param keys: keys for grouping
+        :param strategy: 'sort' groups runs of equal keys, so input has to be sorted by keys;
+            'hash' groups rows in memory and needs no sort (see operations.HashReduce)
+        :param max_groups: for 'hash' strategy, number of groups kept in memory before spilling to disk
+        :param tmp_dir: for 'hash' strategy, directory for spilled rows, system default if None
+        :param max_rows: for 'hash' strategy, number of rows kept in memory for reducers which are not combinable
         """
-        node = Node(operation=ops.Reduce(reducer, keys), parents=[self.tail])
+        if strategy == 'sort':
+            operation: ops.Operation = ops.Reduce(reducer, keys)
+        elif strategy == 'hash':
+            operation = ops.HashReduce(reducer, keys, max_groups, tmp_dir, max_rows)
+        else:
+            raise ValueError('Unknown reduce strategy: {}'.format(strategy))
+        node = Node(operation=operation, parents=[self.tail])
         self.tail = node
         return self
 
-    def sort(self, keys: tp.Sequence[str]) -> 'Graph':
+    def sort(self, keys: tp.Sequence[str], memory_limit: int = exts.DEFAULT_MEMORY_LIMIT,
+             tmp_dir: tp.Optional[str] = None, chunk_size: int = spill.CHUNK_SIZE,
+             workers: tp.Optional[int] = None) -> 'Graph':
         """Construct new graph extended with sort operation
         :param keys: sorting keys (typical is tuple of strings)
+        :param memory_limit: memory budget of sorting process for one sorted run, in bytes
+        :param tmp_dir: directory for sorted runs spilled to disk, system default if None
+        :param chunk_size: number of rows sent to and from sorting process at once
+        :param workers: number of sorting processes, 'sort_workers' run option is used if None
         """
-        node = Node(operation=exts.ExternalSort(keys), parents=[self.tail])
+        node = Node(operation=exts.ExternalSort(keys, memory_limit, tmp_dir, chunk_size, workers),
+                    parents=[self.tail])
         self.tail = node
         return self
 
-    def join(self, joiner: ops.Joiner, join_graph: 'Graph', keys: tp.Sequence[str]) -> 'Graph':
+    def join(self, joiner: ops.Joiner, join_graph: 'Graph', keys: tp.Sequence[str], strategy: str = 'auto',
+             max_rows: int = ops.DEFAULT_JOIN_ROWS) -> 'Graph':
         """Construct new graph extended with join operation with another graph
         :param joiner: join strategy to use
         :param join_graph: other graph to join with
         :param keys: keys for grouping
+        :param strategy: 'merge', 'hash', 'broadcast' or 'auto' (see operations.Join)
+        :param max_rows: for 'hash' strategy, number of rows of join_graph kept in memory before spilling to disk
         """
-        node = Node(operation=ops.Join(joiner, keys), parents=[self.tail, join_graph.tail])
+        node = Node(operation=ops.Join(joiner, keys, strategy, max_rows), parents=[self.tail, join_graph.tail])
         self.tail = node
         return self
 
+    def run_iter(self, **sources: tp.Any) -> TRowsGenerator:
+        """Start execution; data sources passed as kwargs.
+        The graph is optimized into a run plan first (see planner.optimize). Rows of the result are produced
+        as the returned generator is consumed, so the result is never held in memory as a whole.
+        With 'memory_limit' run option (in bytes) the run is watched by memory_governor.MemoryGovernor,
+        which is passed to operations as 'governor' option."""
+        plan = planner.optimize(self.tail, **self.options)
+        if self.options.get('memory_limit') is None:
+            return plan(sources, **self.options)
+        return self._run_governed(plan, sources)
+
+    def _run_governed(self, plan: TNode, sources: tp.Dict[str, tp.Any]) -> TRowsGenerator:
+        # psutil is needed only for governed runs
+        from .memory_governor import MemoryGovernor
+        governor = MemoryGovernor(self.options['memory_limit'])
+        governor.start()
+        try:
+            yield from plan(sources, governor=governor, **self.options)
+        finally:
+            governor.stop()
+            governor.join()
+
     def run(self, **sources: tp.Any) -> tp.List[ops.TRow]:
-        """Single method to start execution; data sources passed as kwargs"""
-        return list(self.tail(sources))
+        """Run graph and collect the result into list, see run_iter"""
+        return list(self.run_iter(**sources))
+
+    def run_to(self, sink: sinks.Sink, **sources: tp.Any) -> int:
+        """Run graph writing the result into sink, which is closed afterwards; see run_iter
+        :param sink: destination of rows, for example sinks.JsonLinesSink
+        :return: number of rows written
+        """
+        with sink:
+            sink.extend(self.run_iter(**sources))
+        return sink.row_count
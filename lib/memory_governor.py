@@ -0,0 +1,77 @@
+import typing as tp
+
+from collections import Counter
+
+from psutil import NoSuchProcess
+
+from .memory_watchdog import MemoryWatchdog, SELF_PROCESS
+
+PRESSURE_THRESHOLD = 0.8
+SPILL_GROWTH = 0.05
+GOVERNOR_PERIOD = 0.05
+MIN_SORT_BUDGET = 1024 ** 2
+
+
+class MemoryGovernor(MemoryWatchdog):
+    """
+    Memory budget of a graph run, see 'memory_limit' run option of Graph.
+
+    The watchdog thread samples memory of the process and its children (sorting and worker processes) and raises
+    `pressure` when it is over threshold * limit. Buffering operations get the governor as 'governor' run option;
+    they check `pressure` (see spill.should_spill) where they decide whether to keep rows in memory, and spill
+    to disk early instead of waiting for their own size limits. Freed memory is often kept by the process, so usage
+    rarely drops after a spill: the flag is dropped by a spill and raised again only when usage grows by
+    spill_growth * limit over usage at the last spill (or usage falls under threshold and rises over it again),
+    otherwise every buffer would spill every few rows. Sorting processes, which can not see the flag,
+    get memory budget for their runs from the headroom left at their start (see `budget`).
+    Operations act on the flag in the main thread, the watchdog thread never touches their buffers.
+    """
+
+    def __init__(self, limit: int, threshold: float = PRESSURE_THRESHOLD, period: float = GOVERNOR_PERIOD,
+                 spill_growth: float = SPILL_GROWTH) -> None:
+        """
+        @param limit: memory limit of the run, in bytes
+        @param threshold: share of limit from which operations are asked to spill
+        @param period: sampling period, in seconds
+        @param spill_growth: share of limit by which usage has to grow after a spill to ask for the next one
+        """
+        super().__init__(limit, period, report=False)
+        self.threshold = threshold
+        self.spill_growth = spill_growth
+        self.usage = 0
+        self.spill_usage: tp.Optional[int] = None
+        self.pressure = False
+        self.spills: tp.Counter[str] = Counter()
+
+    def memory_usage(self) -> int:
+        usage = SELF_PROCESS.memory_info().rss
+        for child in SELF_PROCESS.children(recursive=True):
+            try:
+                usage += child.memory_info().rss
+            except NoSuchProcess:
+                pass
+        return usage
+
+    def on_sample(self, usage: int) -> None:
+        self.usage = usage
+        if usage < self.threshold * self.limit:
+            self.spill_usage = None
+        self.pressure = usage >= self.threshold * self.limit and (
+            self.spill_usage is None or usage >= self.spill_usage + self.spill_growth * self.limit)
+
+    def start(self) -> None:
+        """Take the first sample synchronously, so the run starts with up to date pressure"""
+        self.on_sample(self.memory_usage())
+        super().start()
+
+    def budget(self, requested: int, minimum: int = MIN_SORT_BUDGET) -> int:
+        """Memory budget for a buffer which can not watch pressure: requested bytes, if they fit into headroom
+        below threshold, otherwise the headroom, but at least minimum bytes"""
+        headroom = int(self.threshold * self.limit) - self.usage
+        return max(minimum, min(requested, headroom))
+
+    def spilled(self, kind: str) -> None:
+        """Record spill of buffer of kind caused by pressure, pressure is dropped until usage grows"""
+        self.spills[kind] += 1
+        self.spill_usage = self.usage
+        self.pressure = False
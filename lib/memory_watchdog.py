@@ -1,7 +1,6 @@
 from os import environ, getpid
 from sys import stderr
 from threading import Thread, Event
-from time import sleep
 
 from psutil import Process
 
@@ -17,11 +16,13 @@ class MemoryWatchdog(Thread):
     Watchdog may be configured using the environment variables above.
     """
 
-    def __init__(self, limit: int) -> None:
+    def __init__(self, limit: int, period: float = SLEEP_PERIOD, report: bool = True) -> None:
         self._stop_event = Event()
         self.maximum_memory_usage = 0
         self.limit = limit
         self.limit_in_kib = limit // 1024
+        self.period = period
+        self.report = report
 
         if VERBOSE:
             # To not interfere with pytest output.
@@ -37,13 +38,22 @@ class MemoryWatchdog(Thread):
 
         super().__init__()
 
+    def memory_usage(self) -> int:
+        """Sampled memory usage, in bytes"""
+        return SELF_PROCESS.memory_info().rss
+
+    def on_sample(self, usage: int) -> None:
+        """Called with every sampled memory usage"""
+        pass
+
     def run(self) -> None:
         while True:
             if self._stop_event.is_set():
                 break
-            usage = SELF_PROCESS.memory_info().rss
+            usage = self.memory_usage()
             usage_in_kib = usage // 1024
             self.maximum_memory_usage = max(self.maximum_memory_usage, usage)
+            self.on_sample(usage)
 
             if VERBOSE:
                 line = str(usage_in_kib).ljust(9) + "|" + "=" * min(WIDTH, usage * WIDTH // self.limit)
@@ -51,9 +61,10 @@ class MemoryWatchdog(Thread):
                     line += min(10, (usage - self.limit) * WIDTH // self.limit) * "X"
                 print(line, file=stderr)
 
-            sleep(SLEEP_PERIOD)
+            self._stop_event.wait(self.period)
 
-        print("Maximum memory usage / limit (in KiB):", self.maximum_memory_usage, "/", self.limit, file=stderr)
+        if self.report:
+            print("Maximum memory usage / limit (in KiB):", self.maximum_memory_usage, "/", self.limit, file=stderr)
 
     def stop(self) -> None:
         self._stop_event.set()
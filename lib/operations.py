@@ -1,6 +1,8 @@
 from abc import abstractmethod, ABC
-from operator import itemgetter
+from operator import itemgetter, is_not
 from collections import defaultdict
+from datetime import datetime
+from functools import partial
 
 import typing as tp
 import itertools
@@ -8,11 +10,66 @@ import re
 from math import radians, cos, sin, asin, sqrt
 import math
 import heapq
-from dateutil import parser
 
-TRow = tp.Dict[str, tp.Any]
-TRowsIterable = tp.Iterable[TRow]
-TRowsGenerator = tp.Generator[TRow, None, None]
+from . import columnar
+from . import parallel
+from . import records
+from . import spill
+from .rows import TRow, TRowsIterable, TRowsGenerator
+
+TOrder = tp.Tuple[str, ...]
+TColumns = tp.Optional[tp.FrozenSet[str]]
+
+DEFAULT_MAX_GROUPS = 100000
+DEFAULT_HASH_REDUCE_ROWS = 100000
+# integers up to this magnitude are exactly representable as floats
+FLOAT_EXACT_INT = 2 ** 53
+HASH_PARTITIONS = 16
+MAX_PARTITIONING_DEPTH = 4
+DEFAULT_COMBINE_GROUPS = 10000
+PARTIAL_STATE_COLUMN = '__partial_state__'
+DEFAULT_JOIN_ROWS = 100000
+JOIN_STRATEGIES = ('auto', 'merge', 'hash', 'broadcast')
+EARTH_RADIUS_KM = 6371  # use 3956 for miles
+COMPACT_DATE_FORMAT = '%Y%m%dT%H%M%S.%f'
+DATE_FORMATS = (COMPACT_DATE_FORMAT, '%Y%m%dT%H%M%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+_MISSING = object()
+_is_row = partial(is_not, None)
+
+
+def key_getter(keys: tp.Sequence[str]) -> tp.Callable[[TRow], tp.Any]:
+    """Compile extraction of keys from row, once per operation.
+    Like operator.itemgetter, the function returns the value for a single key and a tuple of values for several
+    keys: such keys are hashable, compare the same way as lists of values, and are built without Python-level calls.
+    """
+    if not keys:
+        return lambda row: ()
+    return itemgetter(*keys)
+
+
+def key_values(keys: tp.Sequence[str], key: tp.Any) -> tp.Tuple[tp.Any, ...]:
+    """Tuple of values of key made by key_getter(keys)"""
+    return (key,) if len(keys) == 1 else key
+
+
+def untouched_prefix(order: tp.Sequence[str], columns: tp.Container[str]) -> TOrder:
+    """Longest prefix of order which does not contain any of columns"""
+    prefix: tp.List[str] = []
+    for column in order:
+        if column in columns:
+            break
+        prefix.append(column)
+    return tuple(prefix)
+
+
+def kept_prefix(order: tp.Sequence[str], columns: tp.Container[str]) -> TOrder:
+    """Longest prefix of order which consists of columns only"""
+    prefix: tp.List[str] = []
+    for column in order:
+        if column not in columns:
+            break
+        prefix.append(column)
+    return tuple(prefix)
 
 
 class Operation(ABC):
@@ -20,12 +77,42 @@ class Operation(ABC):
     def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
         pass
 
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        """Keys the output is known to be sorted by, given the keys each input is sorted by.
+        Empty tuple means nothing is known about the order.
+        """
+        return ()
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        """Estimated upper bound of number of output rows, given the estimations for inputs; None if unknown"""
+        return None
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        """Columns inputs have to provide so that output rows have the given columns. None stands for all
+        columns: unknown by default, so the planner keeps every column of the input.
+        """
+        return None
+
+
+def union_columns(*columns: TColumns) -> TColumns:
+    """Union of column sets, None (all columns) absorbs everything"""
+    if any(part is None for part in columns):
+        return None
+    return frozenset().union(*columns)  # type: ignore
+
+
+def select_columns(columns: tp.Collection[str], row: TRow) -> TRow:
+    """Row with only the given columns, in their order in row; the ones missing in row are skipped"""
+    return {key: value for key, value in row.items() if key in columns}
+
 
 # Operations
 
 
 class Mapper(ABC):
     """Base class for mappers"""
+    # maximal number of rows yielded for one input row, None if not bounded
+    max_output_rows: tp.Optional[int] = 1
 
     @abstractmethod
     def __call__(self, row: tp.Any) -> TRowsGenerator:
@@ -34,14 +121,233 @@ class Mapper(ABC):
         """
         pass
 
+    def preserved_order(self, order: TOrder) -> TOrder:
+        """Longest prefix of order the mapper keeps: columns of the prefix are passed through untouched,
+        so rows sorted by order stay sorted by the prefix after the mapper.
+        By default mapper is assumed to change anything.
+        """
+        return ()
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        """Columns the mapper reads, None if unknown. Mappers declaring them have to declare preserved_order too:
+        columns it does not keep are taken as written by the mapper (see input_columns).
+        """
+        return None
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        """Columns an input row has to have so that output rows have the given columns, None for all"""
+        used = self.used_columns()
+        if columns is None or used is None:
+            return None
+        return frozenset(column for column in columns if self.preserved_order((column,))) | frozenset(used)
+
+
+class RowMapper(Mapper):
+    """Base class for mappers yielding at most one row for every row.
+    Map and FusedMap call map_row through builtin map, without a generator for every row (see apply_mappers).
+    """
+
+    @abstractmethod
+    def map_row(self, row: tp.Any) -> tp.Optional[TRow]:
+        """
+        :param row: one table row
+        :return: output row, or None if the row is dropped
+        """
+        pass
+
+    def __call__(self, row: tp.Any) -> TRowsGenerator:
+        result = self.map_row(row)
+        if result is not None:
+            yield result
+
+
+class BatchMapper(RowMapper):
+    """Base class for mappers with a vectorized implementation, used in columnar mode (see BatchMap).
+    map_batch computes the same as __call__ for every row of the batch, yielding exactly one row per row.
+    """
+
+    @abstractmethod
+    def map_batch(self, batch: columnar.RowBatch) -> None:
+        """
+        :param batch: batch to update in place with RowBatch.set_column
+        """
+        pass
+
+
+def multiply_columns(columns: tp.Sequence[tp.Any], length: int) -> tp.Any:
+    """Product of arrays of columns, the same values as multiplying them in Python, starting with 1.
+    Float columns are multiplied by NumPy; with any other column values are multiplied as Python objects,
+    as int64 products would silently wrap around."""
+    np = columnar.numpy()
+    exact = not columns or any(values.dtype.kind != 'f' for values in columns)
+    product = np.ones(length, dtype=object if exact else float)
+    for values in columns:
+        product = product * (values.astype(object) if exact else values)
+    return product
+
+
+def log_ratio(numerators: tp.Any, denominators: tp.Any) -> tp.Any:
+    """math.log(numerator / denominator) for arrays: raises where math.log would, instead of giving inf or nan.
+    Integers which do not convert to floats exactly, or values of other types, are computed one by one."""
+    np = columnar.numpy()
+    if not (_exact_floats(numerators) and _exact_floats(denominators)):
+        return np.array([math.log(numerator / denominator)
+                         for numerator, denominator in zip(numerators.tolist(), denominators.tolist())])
+    if (denominators == 0).any():
+        raise ZeroDivisionError('division by zero')
+    ratios = numerators / denominators
+    if (ratios <= 0).any():
+        raise ValueError('math domain error')
+    return np.log(ratios)
+
+
+def _exact_floats(values: tp.Any) -> bool:
+    """Whether array holds floats or integers which convert to floats exactly"""
+    kind = values.dtype.kind
+    if kind in 'iub':
+        return not ((values > FLOAT_EXACT_INT) | (values < -FLOAT_EXACT_INT)).any()
+    return kind == 'f'
+
+
+def map_rows(mapper: Mapper, rows: TRowsIterable) -> tp.List[TRow]:
+    """Apply mapper to batch of rows, used by worker processes of parallel Map"""
+    return list(itertools.chain.from_iterable(map(mapper, rows)))
+
+
+def map_batch_rows(mapper: BatchMapper, rows: tp.List[TRow]) -> tp.List[TRow]:
+    """Apply vectorized mapper to batch of rows"""
+    batch = columnar.RowBatch(rows)
+    mapper.map_batch(batch)
+    return batch.to_rows()
+
+
+def apply_mappers(mappers: tp.Sequence[Mapper], rows: TRowsIterable) -> tp.Iterator[TRow]:
+    """Apply mappers to stream of rows, in order. Stages are connected with builtin map and filter (RowMapper)
+    or chain.from_iterable (other mappers), so no Python generator is resumed between mappers.
+    """
+    stream: tp.Iterator[TRow] = iter(rows)
+    for mapper in mappers:
+        if isinstance(mapper, RowMapper):
+            stream = filter(_is_row, map(mapper.map_row, stream))
+        else:
+            stream = itertools.chain.from_iterable(map(mapper, stream))
+    return stream
+
 
 class Map(Operation):
-    def __init__(self, mapper: Mapper) -> None:
+    """Map operation. With workers > 1 rows are sent in batches of batch_size rows to a pool of worker processes
+    which run the mapper (so it has to be picklable); at most max_pending batches are in flight at once.
+    Unordered parallel Map yields batches as soon as they are ready, so the output order is not preserved.
+    Vectorized Map applies BatchMapper to batches of batch_size rows at once (in the current process or in workers);
+    without NumPy it runs row by row.
+    """
+    def __init__(self, mapper: Mapper, workers: int = 1, batch_size: int = parallel.BATCH_SIZE,
+                 ordered: bool = True, max_pending: tp.Optional[int] = None, vectorized: bool = False) -> None:
+        """
+        @param mapper: mapper to apply to every row
+        @param workers: number of worker processes, 1 runs the mapper in the current process
+        @param batch_size: number of rows sent to a worker or vectorized mapper at once
+        @param ordered: keep order of rows with several workers
+        @param max_pending: maximal number of batches in flight, 2 * workers by default
+        @param vectorized: use BatchMapper.map_batch of mapper
+        """
+        if vectorized and not isinstance(mapper, BatchMapper):
+            raise ValueError('{} has no vectorized implementation'.format(type(mapper).__name__))
         self.mapper = mapper
+        self.workers = workers
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.max_pending = max_pending
+        self.vectorized = vectorized and columnar.available()
+
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        if self.workers > 1 and not self.ordered:
+            return ()
+        return self.mapper.preserved_order(input_orders[0])
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        if input_sizes[0] is None or self.mapper.max_output_rows is None:
+            return None
+        return input_sizes[0] * self.mapper.max_output_rows
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.mapper.input_columns(columns)
 
     def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
-        for row in rows:
-            yield from self.mapper(row)
+        map_batch = partial(map_batch_rows if self.vectorized else map_rows, self.mapper)
+        if self.workers > 1:
+            batches = parallel.map_batches(map_batch, spill.iter_chunks(rows, self.batch_size),
+                                           self.workers, self.ordered, self.max_pending)
+            for batch in batches:
+                yield from batch
+        elif self.vectorized:
+            for chunk in spill.iter_chunks(rows, self.batch_size):
+                yield from map_batch(chunk)
+        else:
+            yield from apply_mappers([self.mapper], rows)
+
+
+class FusedMap(Operation):
+    """Consecutive Map operations run in one pass (see apply_mappers) instead of a node with its own generator
+    for every Map. With operation (Reduce, HashReduce or Combine) mapped rows are fed straight into it.
+    Built by the planner from Map nodes running in the current process.
+    """
+    def __init__(self, mappers: tp.Sequence[Mapper], operation: tp.Optional[Operation] = None) -> None:
+        """
+        @param mappers: mappers to apply, in order
+        @param operation: operation consuming the mapped rows, None to yield them
+        """
+        self.mappers = mappers
+        self.operation = operation
+
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        order = input_orders[0]
+        for mapper in self.mappers:
+            order = mapper.preserved_order(order)
+        return order if self.operation is None else self.operation.output_order(order, *input_orders[1:])
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        size = input_sizes[0]
+        for mapper in self.mappers:
+            size = None if size is None or mapper.max_output_rows is None else size * mapper.max_output_rows
+        return size if self.operation is None else self.operation.output_size(size, *input_sizes[1:])
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        rows = apply_mappers(self.mappers, rows)
+        if self.operation is None:
+            yield from rows
+        else:
+            yield from self.operation(rows, *args, **kwargs)
+
+
+class BatchMap(Operation):
+    """Columnar execution of consecutive Map operations with BatchMapper mappers.
+    Rows are gathered into batches of batch_size rows, the mappers are applied to the whole batch one after
+    another, exchanging columns as NumPy arrays, and the batch is converted back to rows once at the end.
+    """
+    def __init__(self, mappers: tp.Sequence[BatchMapper], batch_size: int = columnar.BATCH_SIZE) -> None:
+        """
+        @param mappers: mappers to apply, in order
+        @param batch_size: number of rows in batch
+        """
+        self.mappers = mappers
+        self.batch_size = batch_size
+
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        order = input_orders[0]
+        for mapper in self.mappers:
+            order = mapper.preserved_order(order)
+        return order
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        for chunk in spill.iter_chunks(rows, self.batch_size):
+            batch = columnar.RowBatch(chunk)
+            for mapper in self.mappers:
+                mapper.map_batch(batch)
+            yield from batch.to_rows()
 
 
 class Reducer(ABC):
@@ -54,6 +360,59 @@ class Reducer(ABC):
         """
         pass
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        """Columns rows of a group have to have so that output rows have the given columns, key columns aside;
+        None for all. Unknown by default.
+        """
+        return None
+
+
+class CombinableReducer(Reducer):
+    """Base class for reducers which can aggregate a group incrementally.
+
+    Group state is created with init, every row is added with update, states of parts of the group are combined
+    with merge (merge must be associative), and finalize turns state into output rows. The engine uses this to
+    pre-aggregate rows before sorting (see Combine and MergeReduce) and to keep only states in HashReduce.
+    States must be picklable. update and merge may modify and return their first argument.
+    """
+
+    @abstractmethod
+    def init(self) -> tp.Any:
+        pass
+
+    @abstractmethod
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        pass
+
+    @abstractmethod
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        pass
+
+    @abstractmethod
+    def finalize(self, state: tp.Any) -> TRowsGenerator:
+        pass
+
+    def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
+        state = self.init()
+        for row in rows:
+            state = self.update(state, row)
+        yield from self.finalize(state)
+
+
+class BatchReducer(CombinableReducer):
+    """Base class for combinable reducers with a vectorized implementation, used in columnar mode
+    (see BatchReduce).
+    """
+
+    @abstractmethod
+    def batch_states(self, batch: columnar.RowBatch, starts: tp.Any) -> tp.List[tp.Any]:
+        """
+        :param batch: rows sorted by grouping keys
+        :param starts: array of indices where groups of the batch begin
+        :return: state of every group, as built by init and update
+        """
+        pass
+
 
 class Reduce(Operation):
     """Reduce object factory"""
@@ -65,6 +424,17 @@ class Reduce(Operation):
         """
         self.reducer = reducer
         self.keys = keys
+        self._key = key_getter(keys)
+
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        """Groups come out in input order and keep their key columns"""
+        return kept_prefix(input_orders[0], self.keys)
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return union_columns(self.reducer.input_columns(columns), frozenset(self.keys))
 
     def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
         """Reduce data by self.keys, applying self.reducer to each group
@@ -72,9 +442,292 @@ class Reduce(Operation):
         @param rows: input data generator
         @return: result generator
         """
-        for group_values, group in itertools.groupby(rows, key=lambda x: [x[key] for key in self.keys]):
+        for group_key, group in itertools.groupby(rows, key=self._key):
+            key_row = dict(zip(self.keys, key_values(self.keys, group_key)))
             for row in self.reducer(group):
-                row.update(dict(zip(self.keys, group_values)))
+                row.update(key_row)
+                yield row
+
+
+class BatchReduce(Reduce):
+    """Columnar Reduce with BatchReducer. Sorted rows are gathered into batches of batch_size rows, group boundaries
+    are found on key columns and states of all groups of the batch are computed at once; a group crossing
+    batch boundary is merged with its state from the previous batch.
+    Pays off only for rows whose columns are cheap to gather, so the planner does not choose it by itself.
+    """
+    def __init__(self, reducer: BatchReducer, keys: tp.Sequence[str], batch_size: int = columnar.BATCH_SIZE) -> None:
+        """
+        @param reducer: vectorized reducer
+        @param keys: keys that will be used for grouping
+        @param batch_size: number of rows in batch
+        """
+        super().__init__(reducer, keys)
+        self.batch_reducer = reducer
+        self.batch_size = batch_size
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        reducer = self.batch_reducer
+        last_key, last_state = _MISSING, None
+        for chunk in spill.iter_chunks(rows, self.batch_size):
+            batch = columnar.RowBatch(chunk)
+            starts = columnar.run_starts([batch.column(key) for key in self.keys], len(batch))
+            for start, state in zip(starts.tolist(), reducer.batch_states(batch, starts)):
+                key = self._key(chunk[start])
+                if last_key is not _MISSING:
+                    if key == last_key:
+                        state = reducer.merge(last_state, state)
+                    else:
+                        yield from self._finalize_group(last_key, last_state)
+                last_key, last_state = key, state
+        if last_key is not _MISSING:
+            yield from self._finalize_group(last_key, last_state)
+
+    def _finalize_group(self, key: tp.Any, state: tp.Any) -> TRowsGenerator:
+        key_row = dict(zip(self.keys, key_values(self.keys, key)))
+        for row in self.batch_reducer.finalize(state):
+            row.update(key_row)
+            yield row
+
+
+class HashReduce(Operation):
+    """Reduce which groups rows in a dict instead of relying on sorted input.
+
+    Groups come out in order of their first row. When there are more than max_groups groups, or memory governor
+    of the run reports pressure, rows are spilled to disk partitioned by hash of the key, and every partition
+    is reduced separately; output order then follows the partitions.
+    Reducers which are not CombinableReducer need whole groups, so their rows are buffered; when more than max_rows
+    rows are buffered (or memory governor reports pressure), the buffered and remaining rows are sorted
+    by keys with external sort and reduced as by Reduce, as partitioning does not help with few big groups.
+    """
+    def __init__(self, reducer: Reducer, keys: tp.Sequence[str], max_groups: int = DEFAULT_MAX_GROUPS,
+                 tmp_dir: tp.Optional[str] = None, max_rows: int = DEFAULT_HASH_REDUCE_ROWS) -> None:
+        """
+        @param reducer: reducer to apply to every group
+        @param keys: keys that will be used for grouping
+        @param max_groups: maximal number of groups kept in memory
+        @param tmp_dir: directory for spilled partitions and sorted runs, system default if None
+        @param max_rows: maximal number of rows kept in memory for reducers which are not CombinableReducer
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.max_groups = max_groups
+        self.tmp_dir = tmp_dir
+        self.max_rows = max_rows
+        self._key = key_getter(keys)
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return union_columns(self.reducer.input_columns(columns), frozenset(self.keys))
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        governor, profiler = kwargs.get('governor'), kwargs.get('profiler')
+        if isinstance(self.reducer, CombinableReducer):
+            get_key = self._key
+            yield from self._reduce_states(((get_key(row), row) for row in rows), self.reducer, 0, governor, profiler)
+        else:
+            yield from self._reduce(iter(rows), 0, governor, profiler)
+
+    def _full(self, groups: int, depth: int, governor: tp.Any) -> bool:
+        """Whether groups in memory have to be partitioned before a new group is added"""
+        if depth >= MAX_PARTITIONING_DEPTH:
+            return False
+        return groups >= self.max_groups or spill.should_spill(governor, groups, 'hash_reduce')
+
+    def _reduce_states(self, items: tp.Iterator[tp.Tuple[tp.Any, tp.Any]],
+                       reducer: CombinableReducer, depth: int, governor: tp.Any,
+                       profiler: tp.Any) -> TRowsGenerator:
+        """Aggregate (key, row) items keeping only group states in memory.
+        After spilling partitions hold (key, state) pairs, so the same items are used for rows and states.
+        """
+        states: tp.Dict[tp.Any, tp.Any] = {}
+        for key, item in items:
+            state = states.get(key, _MISSING)
+            if state is _MISSING:
+                if self._full(len(states), depth, governor):
+                    yield from self._reduce_states_partitioned(states, itertools.chain([(key, item)], items),
+                                                               reducer, depth, governor, profiler)
+                    return
+                state = reducer.init()
+            states[key] = reducer.update(state, item) if depth == 0 else reducer.merge(state, item)
+        if profiler is not None:
+            profiler.peak('buffered_groups', len(states))
+        for key, state in states.items():
+            yield from self._finalize_group(key, reducer.finalize(state))
+
+    def _reduce_states_partitioned(self, states: tp.Dict[tp.Any, tp.Any],
+                                   items: tp.Iterator[tp.Tuple[tp.Any, tp.Any]],
+                                   reducer: CombinableReducer, depth: int, governor: tp.Any,
+                                   profiler: tp.Any) -> TRowsGenerator:
+        if profiler is not None:
+            profiler.peak('buffered_groups', len(states))
+        partitions = [spill.SpillFile(self.tmp_dir) for _ in range(HASH_PARTITIONS)]
+        try:
+            for key, state in states.items():
+                partitions[hash((depth, key)) % HASH_PARTITIONS].write((key, state))
+            states.clear()
+            for key, item in items:
+                if depth == 0:
+                    item = reducer.update(reducer.init(), item)
+                partitions[hash((depth, key)) % HASH_PARTITIONS].write((key, item))
+            for partition in partitions:
+                yield from self._reduce_states(iter(partition), reducer, depth + 1, governor, profiler)
+        finally:
+            for partition in partitions:
+                partition.remove()
+
+    def _reduce(self, rows: tp.Iterator[TRow], depth: int, governor: tp.Any, profiler: tp.Any) -> TRowsGenerator:
+        groups: tp.Dict[tp.Any, tp.List[TRow]] = {}
+        get_key = self._key
+        row_count = 0
+        for row in rows:
+            key = get_key(row)
+            group = groups.get(key)
+            if group is None:
+                if self._full(len(groups), depth, governor):
+                    yield from self._reduce_partitioned(groups, itertools.chain([row], rows), depth, governor,
+                                                        profiler)
+                    return
+                group = groups[key] = []
+            group.append(row)
+            row_count += 1
+            if row_count > self.max_rows or (row_count % spill.PRESSURE_MIN_ROWS == 0
+                                             and spill.should_spill(governor, row_count, 'hash_reduce')):
+                yield from self._reduce_sorted(groups, rows, row_count, governor, profiler)
+                return
+        if profiler is not None:
+            profiler.peak('buffered_rows', sum(map(len, groups.values())))
+        for key, group in groups.items():
+            yield from self._reduce_group(key, group)
+
+    def _reduce_partitioned(self, groups: tp.Dict[tp.Any, tp.List[TRow]],
+                            rows: tp.Iterator[TRow], depth: int, governor: tp.Any,
+                            profiler: tp.Any) -> TRowsGenerator:
+        if profiler is not None:
+            profiler.peak('buffered_rows', sum(map(len, groups.values())))
+        partitions = [spill.SpillFile(self.tmp_dir) for _ in range(HASH_PARTITIONS)]
+        try:
+            for key, group in groups.items():
+                partitions[hash((depth, key)) % HASH_PARTITIONS].extend(group)
+            groups.clear()
+            for row in rows:
+                partitions[hash((depth, self._key(row))) % HASH_PARTITIONS].write(row)
+            for partition in partitions:
+                yield from self._reduce(iter(partition), depth + 1, governor, profiler)
+        finally:
+            for partition in partitions:
+                partition.remove()
+
+    def _reduce_sorted(self, groups: tp.Dict[tp.Any, tp.List[TRow]], rows: tp.Iterator[TRow], row_count: int,
+                       governor: tp.Any, profiler: tp.Any) -> TRowsGenerator:
+        """Reduce buffered groups and the rest of rows by sorting them with external sort"""
+        from . import external_sort  # external_sort imports operations
+
+        if profiler is not None:
+            profiler.peak('buffered_rows', row_count)
+
+        def buffered() -> TRowsGenerator:
+            # groups are released while sort takes their rows; rows of a group keep their order
+            while groups:
+                _, group = groups.popitem()
+                group.reverse()
+                while group:
+                    yield group.pop()
+
+        sorted_rows = external_sort.sort_rows(itertools.chain(buffered(), rows), self.keys, tmp_dir=self.tmp_dir,
+                                              governor=governor)
+        yield from Reduce(self.reducer, self.keys)(sorted_rows)
+
+    def _reduce_group(self, key: tp.Any, group: tp.List[TRow]) -> TRowsGenerator:
+        yield from self._finalize_group(key, self.reducer(group))
+
+    def _finalize_group(self, key: tp.Any, rows: TRowsIterable) -> TRowsGenerator:
+        key_row = dict(zip(self.keys, key_values(self.keys, key)))
+        for row in rows:
+            row.update(key_row)
+            yield row
+
+
+class Combine(Operation):
+    """Map-side partial aggregation for CombinableReducer.
+
+    Rows are aggregated into per-group states in a dict of at most max_groups groups; when the dict is full
+    or memory governor of the run reports pressure, and at the end of input, every state is emitted as a partial
+    row holding group keys and the state in PARTIAL_STATE_COLUMN. Partial rows are sorted and merged by MergeReduce.
+    Rows with unhashable keys (such as lists) are not combined: each of them becomes a partial row of its own.
+    """
+    def __init__(self, reducer: CombinableReducer, keys: tp.Sequence[str],
+                 max_groups: int = DEFAULT_COMBINE_GROUPS) -> None:
+        """
+        @param reducer: reducer to pre-aggregate with
+        @param keys: keys that will be used for grouping
+        @param max_groups: maximal number of groups kept in memory
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.max_groups = max_groups
+        self._key = key_getter(keys)
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        states: tp.Dict[tp.Any, tp.Any] = {}
+        get_key = self._key
+        governor, profiler = kwargs.get('governor'), kwargs.get('profiler')
+        for row in rows:
+            key = get_key(row)
+            try:
+                state = states.get(key, _MISSING)
+            except TypeError:
+                yield self._partial_row(key, self.reducer.update(self.reducer.init(), row))
+                continue
+            if state is _MISSING:
+                if len(states) >= self.max_groups or spill.should_spill(governor, len(states), 'combine'):
+                    yield from self._flush(states, profiler)
+                state = self.reducer.init()
+            states[key] = self.reducer.update(state, row)
+        yield from self._flush(states, profiler)
+
+    def _flush(self, states: tp.Dict[tp.Any, tp.Any], profiler: tp.Any) -> TRowsGenerator:
+        if profiler is not None:
+            profiler.peak('buffered_groups', len(states))
+        for key, state in states.items():
+            yield self._partial_row(key, state)
+        states.clear()
+
+    def _partial_row(self, key: tp.Any, state: tp.Any) -> TRow:
+        partial_row = dict(zip(self.keys, key_values(self.keys, key)))
+        partial_row[PARTIAL_STATE_COLUMN] = state
+        return partial_row
+
+
+class MergeReduce(Operation):
+    """Reduce of partial rows produced by Combine; input has to be sorted by keys like for Reduce"""
+    def __init__(self, reducer: CombinableReducer, keys: tp.Sequence[str]) -> None:
+        """
+        @param reducer: reducer used in Combine
+        @param keys: keys that will be used for grouping
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self._key = key_getter(keys)
+
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        return kept_prefix(input_orders[0], self.keys)
+
+    def output_size(self, *input_sizes: tp.Optional[int]) -> tp.Optional[int]:
+        return input_sizes[0]
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        for group_key, group in itertools.groupby(rows, key=self._key):
+            state = next(group)[PARTIAL_STATE_COLUMN]
+            for partial_row in group:
+                state = self.reducer.merge(state, partial_row[PARTIAL_STATE_COLUMN])
+            key_row = dict(zip(self.keys, key_values(self.keys, group_key)))
+            for row in self.reducer.finalize(state):
+                row.update(key_row)
                 yield row
 
 
@@ -114,14 +767,31 @@ class Joiner(ABC):
             merged[key + suffix] = value
         return merged
 
+    def input_columns(self, columns: tp.FrozenSet[str]) -> tp.FrozenSet[str]:
+        """Columns both tables have to provide so that joined rows have the given columns:
+        the columns themselves and, for suffixed ones, their names without the suffix
+        """
+        return columns | frozenset(column[:-len(suffix)] for column in columns
+                                   for suffix in (self._a_suffix, self._b_suffix)
+                                   if suffix and column.endswith(suffix))
+
     def common_join(self, rows_a: TRowsIterable, rows_b: TRowsIterable, keys: tp.Sequence[str]) -> TRowsGenerator:
         """ Auxiliary method for any type of join. Generally implements InnerJoin.
+        Side passed as a one-shot iterator is streamed against the other one; if both sides are iterators,
+        rows_a is materialized.
 
         @param rows_a: the first data generator
         @param rows_b: the second data generator
         @param keys: keys for join operation
         @return: result generator
         """
+        if isinstance(rows_a, tp.Iterator) and not isinstance(rows_b, tp.Iterator):
+            for a in rows_a:
+                for b in rows_b:
+                    yield self.merge_rows(a, b, keys)
+            return
+        if isinstance(rows_a, tp.Iterator):
+            rows_a = list(rows_a)
         for b in rows_b:
             for a in rows_a:
                 yield self.merge_rows(a, b, keys)
@@ -136,57 +806,283 @@ class Joiner(ABC):
         pass
 
 
+class GroupBuffer:
+    """Rows of one key group kept in a list; over max_rows rows, or under memory pressure, they are moved
+    to a spill file"""
+
+    def __init__(self, max_rows: int, tmp_dir: tp.Optional[str] = None, governor: tp.Any = None,
+                 compact: bool = False) -> None:
+        """
+        @param max_rows: maximal number of rows kept in memory
+        @param tmp_dir: directory for spilled rows, system default if None
+        @param governor: memory governor of the run, see spill.should_spill
+        @param compact: keep rows in memory as records, see records.Record
+        """
+        self.max_rows = max_rows
+        self.tmp_dir = tmp_dir
+        self.governor = governor
+        self.compact = compact
+        self._rows: tp.List[TRow] = []
+        self._spilled: tp.Optional[spill.SpillFile] = None
+
+    def append(self, row: TRow) -> None:
+        if self._spilled is not None:
+            self._spilled.write(row)
+            return
+        self._rows.append(records.compact(row) if self.compact else row)
+        count = len(self._rows)
+        if count >= self.max_rows or (count % spill.PRESSURE_MIN_ROWS == 0
+                                      and spill.should_spill(self.governor, count, 'join_group')):
+            self._spilled = spill.SpillFile(self.tmp_dir)
+            self._spilled.extend(map(records.to_dict, self._rows) if self.compact else self._rows)
+            self._rows = []
+
+    def __len__(self) -> int:
+        return len(self._rows) if self._spilled is None else len(self._spilled)
+
+    def rows(self) -> TRowsIterable:
+        """Buffered rows, may be iterated several times"""
+        if self._spilled is not None:
+            self._spilled.close()
+            return self._spilled
+        return self._rows
+
+    def remove(self) -> None:
+        if self._spilled is not None:
+            self._spilled.remove()
+
+
 class Join(Operation):
-    def __init__(self, joiner: Joiner, keys: tp.Sequence[str]):
+    """Join of two tables by keys.
+
+    Strategies:
+    'merge' - sort-merge join, both tables have to be sorted by keys, output comes in order of keys;
+    'broadcast' - the right table is loaded into in-memory index, the left one is streamed against it in its order;
+    'hash' - like 'broadcast', but if the right table has more than max_rows rows (or memory governor of the run
+    reports pressure while it is loaded), both tables are spilled to disk partitioned by hash of keys and partitions
+    are hash joined one by one (see _hash_join);
+    'auto' - chosen by planner.choose_join_strategies from size hints, 'merge' if not chosen.
+    Rows of the right table which found no pair come after all rows of the left table with 'broadcast', and with
+    'hash' when the right table fits into memory.
+    Merge join buffers only the smaller side of every key group (see _join_groups).
+    With 'compact_rows' run option buffered rows are kept as records (see records.Record), rows come out as dicts.
+    """
+    def __init__(self, joiner: Joiner, keys: tp.Sequence[str], strategy: str = 'merge',
+                 max_rows: int = DEFAULT_JOIN_ROWS, tmp_dir: tp.Optional[str] = None):
+        """
+        @param joiner: join strategy for pair of groups
+        @param keys: join keys
+        @param strategy: one of JOIN_STRATEGIES
+        @param max_rows: for 'hash' strategy, maximal number of rows of the right table kept in memory;
+        for 'merge' strategy, maximal number of rows of one key group kept in memory
+        @param tmp_dir: directory for spilled partitions and groups, system default if None
+        """
+        if strategy not in JOIN_STRATEGIES:
+            raise ValueError('Unknown join strategy: {}'.format(strategy))
         self.keys = keys
         self.joiner = joiner
+        self.strategy = strategy
+        self.max_rows = max_rows
+        self.tmp_dir = tmp_dir
+        self._key = key_getter(keys)
+
+    def output_order(self, *input_orders: TOrder) -> TOrder:
+        """Merge join emits groups in order of join keys. Broadcast join keeps order of the left table,
+        unless unpaired right rows are appended; only join keys are guaranteed to keep their names."""
+        if self.strategy in ('auto', 'merge'):
+            return tuple(self.keys)
+        if self.strategy == 'broadcast' and isinstance(self.joiner, (InnerJoiner, LeftJoiner)):
+            return kept_prefix(input_orders[0], self.keys)
+        return ()
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        """The same columns are required from both tables"""
+        if columns is None:
+            return None
+        return self.joiner.input_columns(columns) | frozenset(self.keys)
 
     def __call__(self, rows: tp.Any, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        governor, profiler = kwargs.get('governor'), kwargs.get('profiler')
+        compact = kwargs.get('compact_rows', False)
+        joined = self._join(rows, args[0], governor, profiler, compact)
+        # joined rows are built as dicts, but joiners pass rows without a pair as they are
+        yield from map(records.to_dict, joined) if compact else joined
+
+    def _join(self, rows: TRowsIterable, join_rows: TRowsIterable, governor: tp.Any, profiler: tp.Any,
+              compact: bool) -> TRowsGenerator:
+        if self.strategy == 'broadcast':
+            index = self._build_index(join_rows, compact)
+            if profiler is not None:
+                profiler.peak('buffered_rows', sum(map(len, index.values())))
+            yield from self._probe(rows, index)
+        elif self.strategy == 'hash':
+            yield from self._hash_join(rows, join_rows, governor, profiler, compact)
+        else:
+            yield from self._merge_join(rows, join_rows, governor, profiler, compact)
+
+    def _build_index(self, rows: TRowsIterable, compact: bool = False) -> tp.Dict[tp.Any, tp.List[TRow]]:
+        index: tp.Dict[tp.Any, tp.List[TRow]] = defaultdict(list)
+        for row in rows:
+            index[self._key(row)].append(records.compact(row) if compact else row)
+        return index
+
+    def _probe(self, rows: TRowsIterable, index: tp.Dict[tp.Any, tp.List[TRow]]) -> TRowsGenerator:
+        """Join streamed left rows with index of right rows"""
+        matched = set()
+        for row in rows:
+            key = self._key(row)
+            group = index.get(key)
+            if group is None:
+                yield from self.joiner(self.keys, [row], [])
+            else:
+                matched.add(key)
+                yield from self.joiner(self.keys, [row], group)
+        for key, group in index.items():
+            if key not in matched:
+                yield from self.joiner(self.keys, [], group)
+
+    def _hash_join(self, rows: TRowsIterable, join_rows: TRowsIterable, governor: tp.Any,
+                   profiler: tp.Any, compact: bool = False, depth: int = 0) -> TRowsGenerator:
+        """Join with in-memory index of the right table, or of its partitions by hash of keys when it has more
+        than max_rows rows. Partitions are joined in the same way, so they are partitioned again if they do not fit;
+        tables which can not be split any more (at MAX_PARTITIONING_DEPTH, or with one key) are sort-merge joined.
+        """
+        index: tp.Dict[tp.Any, tp.List[TRow]] = defaultdict(list)
+        join_rows = iter(join_rows)
+        row_count = 0
+        for row in join_rows:
+            index[self._key(row)].append(records.compact(row) if compact else row)
+            row_count += 1
+            if row_count > self.max_rows or (row_count % spill.PRESSURE_MIN_ROWS == 0
+                                             and spill.should_spill(governor, row_count, 'hash_join')):
+                break
+        else:
+            if profiler is not None:
+                profiler.peak('buffered_rows', row_count)
+            yield from self._probe(rows, index)
+            return
+
+        if profiler is not None:
+            profiler.peak('buffered_rows', row_count)
+        join_rows = itertools.chain(self._drain(index, compact), join_rows)
+        if depth + 1 >= MAX_PARTITIONING_DEPTH or len(index) == 1:
+            yield from self._sort_merge_join(rows, join_rows, governor, profiler, compact)
+            return
+        left_partitions = [spill.SpillFile(self.tmp_dir) for _ in range(HASH_PARTITIONS)]
+        right_partitions = [spill.SpillFile(self.tmp_dir) for _ in range(HASH_PARTITIONS)]
+        try:
+            for row in join_rows:
+                right_partitions[hash((depth, self._key(row))) % HASH_PARTITIONS].write(row)
+            for row in rows:
+                left_partitions[hash((depth, self._key(row))) % HASH_PARTITIONS].write(row)
+            for left_partition, right_partition in zip(left_partitions, right_partitions):
+                yield from self._hash_join(left_partition, right_partition, governor, profiler, compact, depth + 1)
+        finally:
+            for partition in left_partitions + right_partitions:
+                partition.remove()
+
+    @staticmethod
+    def _drain(index: tp.Dict[tp.Any, tp.List[TRow]], compact: bool) -> TRowsGenerator:
+        """Rows of index as dicts, index is emptied as they are taken; rows of one key keep their order"""
+        while index:
+            _, group = index.popitem()
+            group.reverse()
+            while group:
+                row = group.pop()
+                yield records.to_dict(row) if compact else row
+
+    def _sort_merge_join(self, rows: TRowsIterable, join_rows: TRowsIterable, governor: tp.Any,
+                         profiler: tp.Any, compact: bool) -> TRowsGenerator:
+        """Sort both tables by keys with external sort and merge join them, big key groups are spilled
+        by GroupBuffer"""
+        from . import external_sort  # external_sort imports operations
+
+        left, right = [external_sort.sort_rows(table, self.keys, external_sort.IN_PROCESS_MEMORY_LIMIT,
+                                               self.tmp_dir, governor, compact) for table in (rows, join_rows)]
+        yield from self._merge_join(left, right, governor, profiler, compact)
+
+    def _merge_join(self, rows: TRowsIterable, join_rows: TRowsIterable, governor: tp.Any,
+                    profiler: tp.Any, compact: bool = False) -> TRowsGenerator:
         """Groups data for joining them
 
         @param rows: left table
-        @param args: there lies right table
+        @param join_rows: right table
+        @param governor: memory governor of the run, passed to group buffers
+        @param profiler: profiler of the run, gets peak number of buffered rows
+        @param compact: keep buffered rows as records
         @return: generator result of join
         """
-        left_grouper = itertools.groupby(rows, key=lambda x: {key: x[key] for key in self.keys})  # упражнение читателю
-        right_grouper = itertools.groupby(args[0], key=lambda x: {key: x[key] for key in self.keys})
-        left_key, left_group = next(left_grouper, (None, None))
-        right_key, right_group = next(right_grouper, (None, None))
-
-        while left_key is not None and right_key is not None:
-            left_values, right_values = list(left_key.values()), list(right_key.values())
-            if left_values < right_values:
+        end = (_MISSING, None)
+        left_grouper = itertools.groupby(rows, key=self._key)
+        right_grouper = itertools.groupby(join_rows, key=self._key)
+        left_key, left_group = next(left_grouper, end)
+        right_key, right_group = next(right_grouper, end)
+
+        while left_key is not _MISSING and right_key is not _MISSING:
+            if left_key < right_key:
                 yield from self.joiner(self.keys, left_group or [], [])
-                left_key, left_group = next(left_grouper, (None, None))
-                continue
-            if left_values == right_values:
-                yield from self.joiner(self.keys, left_group or [], right_group or [])
-                left_key, left_group = next(left_grouper, (None, None))
-                right_key, right_group = next(right_grouper, (None, None))
-                continue
-            if left_values > right_values:
+                left_key, left_group = next(left_grouper, end)
+            elif left_key == right_key:
+                yield from self._join_groups(left_group, right_group, governor, profiler, compact)
+                left_key, left_group = next(left_grouper, end)
+                right_key, right_group = next(right_grouper, end)
+            else:
                 yield from self.joiner(self.keys, [], right_group or [])
-                right_key, right_group = next(right_grouper, (None, None))
+                right_key, right_group = next(right_grouper, end)
 
-        while left_key is not None:
+        while left_key is not _MISSING:
             yield from self.joiner(self.keys, left_group or [], [])
-            left_key, left_group = next(left_grouper, (None, None))
+            left_key, left_group = next(left_grouper, end)
 
-        while right_key is not None:
+        while right_key is not _MISSING:
             yield from self.joiner(self.keys, [], right_group or [])
-            right_key, right_group = next(right_grouper, (None, None))
+            right_key, right_group = next(right_grouper, end)
+
+    def _join_groups(self, left_group: TRowsIterable, right_group: TRowsIterable,
+                     governor: tp.Any, profiler: tp.Any, compact: bool = False) -> TRowsGenerator:
+        """Join two one-shot groups of rows with equal keys.
+        Groups are read in lockstep until one of them ends, so only the smaller group (and as many rows of the larger
+        one) is buffered, groups over max_rows rows are spilled to disk. The buffered group is passed to joiner
+        as a list or spill file, the rest of the other group is streamed against it.
+        """
+        groups = [iter(left_group), iter(right_group)]
+        buffers = [GroupBuffer(self.max_rows, self.tmp_dir, governor, compact) for _ in range(2)]
+        try:
+            while True:
+                for side in (0, 1):
+                    row = next(groups[side], _MISSING)
+                    if row is _MISSING:
+                        if profiler is not None:
+                            profiler.peak('buffered_rows', len(buffers[0]) + len(buffers[1]))
+                        buffered = buffers[side].rows()
+                        streamed = itertools.chain(buffers[1 - side].rows(), groups[1 - side])
+                        if side == 0:
+                            yield from self.joiner(self.keys, buffered, streamed)
+                        else:
+                            yield from self.joiner(self.keys, streamed, buffered)
+                        return
+                    buffers[side].append(row)
+        finally:
+            for buffer in buffers:
+                buffer.remove()
 
 # Dummy operators
 
 
-class DummyMapper(Mapper):
+class DummyMapper(RowMapper):
     """Yield exactly the row passed"""
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        yield row
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return tuple(order)
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return ()
+
+    def map_row(self, row: TRow) -> TRow:
+        return row
 
 
-class AddField(Mapper):
+class AddField(RowMapper):
     """add useless field column"""
 
     def __init__(self, column: str, def_value: tp.Any = None):
@@ -196,12 +1092,18 @@ class AddField(Mapper):
         self.column = column
         self.def_value = def_value
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return ()
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column] = self.def_value
-        yield row
+        return row
 
 
-class RemoveField(Mapper):
+class RemoveField(RowMapper):
     """add useless field column"""
 
     def __init__(self, column: str):
@@ -210,23 +1112,45 @@ class RemoveField(Mapper):
         """
         self.column = column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row.pop(self.column)
-        yield row
+        return row
 
 
-class FirstReducer(Reducer):
+class FirstReducer(CombinableReducer):
     """Yield only first row from passed ones"""
 
+    def init(self) -> tp.Any:
+        return None
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        return row if state is None else state
+
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        return other if state is None else state
+
+    def finalize(self, state: tp.Any) -> TRowsGenerator:
+        if state is not None:
+            yield state
+
     def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
         for row in rows:
             yield row
             break
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return columns
+
 
 # Mappers
 
-class FilterPunctuation(Mapper):
+class FilterPunctuation(RowMapper):
     """Left only non-punctuation symbols"""
 
     def __init__(self, column: str):
@@ -236,12 +1160,18 @@ class FilterPunctuation(Mapper):
         self.column = column
         self.regexp = re.compile(r'([^\w\s]|_)+')
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column] = re.sub(self.regexp, '',  row[self.column])
-        yield row
+        return row
 
 
-class LowerCase(Mapper):
+class LowerCase(RowMapper):
     """Replace column value with value in lower case"""
 
     def __init__(self, column: str):
@@ -254,13 +1184,20 @@ class LowerCase(Mapper):
     def _lower_case(txt: str) -> str:
         return txt.lower()
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column] = LowerCase._lower_case(row[self.column])
-        yield row
+        return row
 
 
 class Split(Mapper):
     """Split row on multiple rows by separator"""
+    max_output_rows = None
 
     def __init__(self, column: str, separator: tp.Optional[str] = None) -> None:
         """
@@ -270,6 +1207,12 @@ class Split(Mapper):
         self.column = column
         self.separator = separator
 
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.column,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         for value in row[self.column].split(sep=self.separator):
             tmp_row: TRow = row.copy()
@@ -277,7 +1220,7 @@ class Split(Mapper):
             yield tmp_row
 
 
-class Product(Mapper):
+class Product(BatchMapper):
     """Calculates product of multiple columns"""
 
     def __init__(self, columns: tp.Sequence[str], result_column: str = 'product') -> None:
@@ -288,29 +1231,47 @@ class Product(Mapper):
         self.columns = columns
         self.result_column = result_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.result_column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return self.columns
+
+    def map_row(self, row: TRow) -> TRow:
         prod = 1
         for column in self.columns:
             prod *= row[column]
         row[self.result_column] = prod
-        yield row
+        return row
+
+    def map_batch(self, batch: columnar.RowBatch) -> None:
+        batch.set_column(self.result_column, multiply_columns([batch.column(column) for column in self.columns],
+                                                              len(batch)))
 
 
-class Filter(Mapper):
+class Filter(RowMapper):
     """Remove records that don't satisfy some condition"""
 
-    def __init__(self, condition: tp.Callable[[TRow], bool]) -> None:
+    def __init__(self, condition: tp.Callable[[TRow], bool], columns: tp.Optional[tp.Sequence[str]] = None) -> None:
         """
         :param condition: if condition is not true - remove record
+        :param columns: columns condition depends on; declared ones let the planner move the filter
+        closer to the source (see planner.push_down_filters)
         """
         self.condition = condition
+        self.columns = columns
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        if self.condition(row):
-            yield row
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return tuple(order)
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return self.columns
 
+    def map_row(self, row: TRow) -> tp.Optional[TRow]:
+        return row if self.condition(row) else None
 
-class InverseDocumentFrequency(Mapper):
+
+class InverseDocumentFrequency(BatchMapper):
     """Calculate IDF"""
     def __init__(self, row_count_colunm: str, docs_per_word_column: str, idf_column: str = "idf") -> None:
         """
@@ -322,12 +1283,22 @@ class InverseDocumentFrequency(Mapper):
         self.docs_per_word_column = docs_per_word_column
         self.idf_column = idf_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.idf_column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.row_count_column, self.docs_per_word_column)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.idf_column] = math.log(row[self.row_count_column] / row[self.docs_per_word_column])
-        yield row
+        return row
 
+    def map_batch(self, batch: columnar.RowBatch) -> None:
+        batch.set_column(self.idf_column, log_ratio(batch.column(self.row_count_column),
+                                                    batch.column(self.docs_per_word_column)))
 
-class TFIDF(Mapper):
+
+class TFIDF(BatchMapper):
     """Calculate IDF"""
 
     def __init__(self, tf_column: str, idf_column: str, tfidf_column: str = "tfidf") -> None:
@@ -342,12 +1313,22 @@ class TFIDF(Mapper):
         self.idf_column = idf_column
         self.tfidf_column = tfidf_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.tfidf_column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.tf_column, self.idf_column)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.tfidf_column] = row[self.tf_column] * row[self.idf_column]
-        yield row
+        return row
 
+    def map_batch(self, batch: columnar.RowBatch) -> None:
+        batch.set_column(self.tfidf_column, multiply_columns([batch.column(self.tf_column),
+                                                              batch.column(self.idf_column)], len(batch)))
 
-class PMI(Mapper):
+
+class PMI(BatchMapper):
     """Calculate PMI"""
     def __init__(self, tf_column: str, cf_column: str, pmi_column: str = "pmi") -> None:
         """pmi(word_i, doc_i) = log((frequency of word_i in doc_i) / (frequency of word_i in all documents combined))
@@ -360,12 +1341,21 @@ class PMI(Mapper):
         self.cf_column = cf_column
         self.pmi_column = pmi_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.pmi_column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.tf_column, self.cf_column)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.pmi_column] = math.log(row[self.tf_column] / row[self.cf_column])
-        yield row
+        return row
 
+    def map_batch(self, batch: columnar.RowBatch) -> None:
+        batch.set_column(self.pmi_column, log_ratio(batch.column(self.tf_column), batch.column(self.cf_column)))
 
-class Project(Mapper):
+
+class Project(RowMapper):
     """Leave only mentioned columns"""
 
     def __init__(self, columns: tp.Sequence[str]) -> None:
@@ -374,11 +1364,20 @@ class Project(Mapper):
         """
         self.columns = columns
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        yield {column: row[column] for column in self.columns}
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return kept_prefix(order, self.columns)
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return self.columns
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return frozenset(self.columns)
 
+    def map_row(self, row: TRow) -> TRow:
+        return {column: row[column] for column in self.columns}
 
-class StreetLength(Mapper):
+
+class StreetLength(BatchMapper):
     """Compute streets lenght by coordinates"""
 
     def __init__(self, start_column: str, end_column: str, result_column: str = "length") -> None:
@@ -404,20 +1403,54 @@ class StreetLength(Mapper):
         dlat = lat2 - lat1
         a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
         c = 2 * asin(sqrt(a))
-        r = 6371  # Radius of earth in kilometers. Use 3956 for miles
-        return c * r
+        return c * EARTH_RADIUS_KM
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def haversine_batch(self, start: tp.Any, end: tp.Any) -> tp.Any:
+        """Same as haversine for arrays of (lon, lat) points of shape (n, 2), computed with NumPy"""
+        np = columnar.numpy()
+        lon1, lat1 = np.radians(start).T
+        lon2, lat2 = np.radians(end).T
+
+        dlon = lon2 - lon1
+        dlat = lat2 - lat1
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+        c = 2 * np.arcsin(np.sqrt(a))
+        return c * EARTH_RADIUS_KM
+
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.result_column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.start_column, self.end_column)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.result_column] = self.haversine(*row[self.start_column], *row[self.end_column])
-        yield row
+        return row
+
+    def map_batch(self, batch: columnar.RowBatch) -> None:
+        batch.set_column(self.result_column, self.haversine_batch(batch.column(self.start_column),
+                                                                  batch.column(self.end_column)))
+
+
+def parse_compact_date(value: str) -> datetime:
+    """Parse date in COMPACT_DATE_FORMAT ('20171020T112238.723000') by slicing, much faster than strptime.
+    Raises ValueError for strings of other shape.
+    """
+    if not 17 <= len(value) <= 22 or value[8] != 'T' or value[15] != '.' or not value[16:].isdigit():
+        raise ValueError('Not a compact date: {!r}'.format(value))
+    return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]),
+                    int(value[13:15]), int(value[16:].ljust(6, '0')))
 
 
-class ProcessDate(Mapper):
-    """Excract from 2 string in datetime format duration of interval, weekday and hour of start."""
+class ProcessDate(RowMapper):
+    """Excract from 2 string in datetime format duration of interval, weekday and hour of start.
+    Dates are parsed with a fixed format, declared or detected from the first row; values not matching it
+    are parsed with dateutil.
+    """
 
     def __init__(self, enter_time_column: str, leave_time_column: str,
                  week_day_column: str = "week_day", hour_column: str = "hour",
-                 duration_column: str = "duration") -> None:
+                 duration_column: str = "duration", date_format: tp.Optional[str] = None) -> None:
         """
 
         @param enter_time_column: название столбца со временем начала
@@ -425,24 +1458,64 @@ class ProcessDate(Mapper):
         @param week_day_column: название столбца, в который запишется день недели
         @param hour_column: название столбца, в который запишется час
         @param duration_column: название столбца, в который запишется длительность интервала
+        @param date_format: формат дат для datetime.strptime; если None, выбирается из DATE_FORMATS по первой строке,
+        если ни один не подошел — все даты разбирает dateutil
         """
         self.enter_time_column = enter_time_column
         self.leave_time_column = leave_time_column
         self.week_day_column = week_day_column
         self.hour_column = hour_column
         self.duration_column = duration_column
+        self.date_format = date_format
+        self._weekdays: tp.Dict[int, str] = {}
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def preserved_order(self, order: TOrder) -> TOrder:
+        return untouched_prefix(order, {self.week_day_column, self.hour_column, self.duration_column})
+
+    def used_columns(self) -> tp.Optional[tp.Collection[str]]:
+        return (self.enter_time_column, self.leave_time_column)
 
-        start_date = parser.parse(row[self.enter_time_column])
-        end_date = parser.parse(row[self.leave_time_column])
+    def _detect_format(self, value: str) -> str:
+        for date_format in DATE_FORMATS:
+            try:
+                datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+            return date_format
+        return ''
+
+    def _parse(self, value: str) -> datetime:
+        try:
+            if self.date_format == COMPACT_DATE_FORMAT:
+                return parse_compact_date(value)
+            if self.date_format:
+                return datetime.strptime(value, self.date_format)
+        except ValueError:
+            pass
+        # dateutil is imported only for dates of unknown formats
+        from dateutil import parser
+        return parser.parse(value)
+
+    def _weekday(self, date: datetime) -> str:
+        """Weekday name memoized by day"""
+        day = date.toordinal()
+        weekday = self._weekdays.get(day)
+        if weekday is None:
+            weekday = self._weekdays[day] = date.strftime('%a')
+        return weekday
+
+    def map_row(self, row: TRow) -> TRow:
+        if self.date_format is None:
+            self.date_format = self._detect_format(row[self.enter_time_column])
+        start_date = self._parse(row[self.enter_time_column])
+        end_date = self._parse(row[self.leave_time_column])
         row[self.duration_column] = (end_date - start_date).total_seconds() / 3600
-        row[self.week_day_column] = start_date.strftime('%a')
+        row[self.week_day_column] = self._weekday(start_date)
         row[self.hour_column] = start_date.hour
-        yield row
+        return row
 
 
-class ReadFromFile(Mapper):
+class ReadFromFile(RowMapper):
     """Read from filename line-by-line and process every string using parser"""
 
     def __init__(self, parser: tp.Callable[[str], TRow]) -> None:
@@ -451,8 +1524,8 @@ class ReadFromFile(Mapper):
         """
         self.parser = parser
 
-    def __call__(self, row: str) -> TRowsGenerator:
-        yield self.parser(row)
+    def map_row(self, row: str) -> TRow:
+        return self.parser(row)
 
 
 # Reducers
@@ -469,11 +1542,14 @@ class TopN(Reducer):
         self.column_max = column
         self.n = n
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return union_columns(columns, frozenset([self.column_max]))
+
     def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
         yield from heapq.nlargest(self.n, rows, key=itemgetter(self.column_max))
 
 
-class TermFrequency(Reducer):
+class TermFrequency(CombinableReducer):
     """Calculate frequency of values in column"""
 
     def __init__(self, words_column: str, result_column: str = 'tf', by_field: tp.Union[str, None] = None) -> None:
@@ -485,6 +1561,9 @@ class TermFrequency(Reducer):
         self.result_column = result_column
         self.by_field = by_field
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return frozenset([self.words_column] + ([self.by_field] if self.by_field is not None else []))
+
     def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
         dictionary: tp.DefaultDict[str, int] = defaultdict(int)
         cumsum = 0
@@ -497,11 +1576,30 @@ class TermFrequency(Reducer):
                 dictionary[row[self.words_column]] += row[self.by_field]
                 cumsum += row[self.by_field]
 
+        yield from self.finalize([dictionary, cumsum])
+
+    def init(self) -> tp.Any:
+        return [defaultdict(int), 0]
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        increment = 1 if self.by_field is None else row[self.by_field]
+        state[0][row[self.words_column]] += increment
+        state[1] += increment
+        return state
+
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        for key, value in other[0].items():
+            state[0][key] += value
+        state[1] += other[1]
+        return state
+
+    def finalize(self, state: tp.Any) -> TRowsGenerator:
+        dictionary, cumsum = state
         for key, value in dictionary.items():
             yield {self.words_column: key, self.result_column: value / cumsum}
 
 
-class Count(Reducer):
+class Count(CombinableReducer):
     """Count rows passed and yield single row as a result"""
 
     def __init__(self, column: str) -> None:
@@ -510,14 +1608,29 @@ class Count(Reducer):
         """
         self.column = column
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return frozenset()
+
     def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
         cumsum = 0
         for _ in rows:
             cumsum += 1
         yield {self.column: cumsum}
 
+    def init(self) -> tp.Any:
+        return 0
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        return state + 1
+
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        return state + other
 
-class MeanSpeed(Reducer):
+    def finalize(self, state: tp.Any) -> TRowsGenerator:
+        yield {self.column: state}
+
+
+class MeanSpeed(BatchReducer):
     """Compute mean speed at concrete data"""
 
     def __init__(self, duration_column: str, length_column: str, result_column: str, count_column: str) -> None:
@@ -532,6 +1645,9 @@ class MeanSpeed(Reducer):
         self.result_column = result_column
         self.count_column = count_column
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return frozenset([self.duration_column, self.length_column, self.count_column])
+
     def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
         total_time = 0
         total_length = 0
@@ -540,8 +1656,32 @@ class MeanSpeed(Reducer):
             total_length += row[self.length_column] * row[self.count_column]
         yield {self.result_column: total_length / total_time}
 
+    def init(self) -> tp.Any:
+        return [0, 0]
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        state[0] += row[self.duration_column] * row[self.count_column]
+        state[1] += row[self.length_column] * row[self.count_column]
+        return state
+
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        state[0] += other[0]
+        state[1] += other[1]
+        return state
+
+    def finalize(self, state: tp.Any) -> TRowsGenerator:
+        total_time, total_length = state
+        yield {self.result_column: total_length / total_time}
+
+    def batch_states(self, batch: columnar.RowBatch, starts: tp.Any) -> tp.List[tp.Any]:
+        count = batch.column(self.count_column)
+        total_times = columnar.numpy().add.reduceat(batch.column(self.duration_column) * count, starts)
+        total_lengths = columnar.numpy().add.reduceat(batch.column(self.length_column) * count, starts)
+        return [[total_time, total_length] for total_time, total_length in zip(total_times.tolist(),
+                                                                                total_lengths.tolist())]
 
-class Sum(Reducer):
+
+class Sum(BatchReducer):
     """Sum values in column passed and yield single row as a result"""
 
     def __init__(self, column: str, delete_others: bool = True) -> None:
@@ -551,12 +1691,30 @@ class Sum(Reducer):
         self.column = column
         self.delete_others = delete_others
 
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return frozenset([self.column])
+
     def __call__(self, rows: TRowsIterable) -> TRowsGenerator:
         cumsum = 0
         for row in rows:
             cumsum += row[self.column]
         yield {self.column: cumsum}
 
+    def init(self) -> tp.Any:
+        return 0
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        return state + row[self.column]
+
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        return state + other
+
+    def finalize(self, state: tp.Any) -> TRowsGenerator:
+        yield {self.column: state}
+
+    def batch_states(self, batch: columnar.RowBatch, starts: tp.Any) -> tp.List[tp.Any]:
+        return columnar.numpy().add.reduceat(batch.column(self.column), starts).tolist()
+
 # Joiners
 
 
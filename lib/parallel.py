@@ -0,0 +1,119 @@
+import threading
+import typing as tp
+
+from collections import deque
+from queue import Full, Queue
+
+if tp.TYPE_CHECKING:
+    from concurrent.futures import Future
+
+TBatch = tp.List[tp.Any]
+
+BATCH_SIZE = 1024
+PREFETCH_DEPTH = 4
+
+T = tp.TypeVar('T')
+
+# function run by the pool of the current worker process, set by _init_worker
+_worker_function: tp.Optional[tp.Callable[[TBatch], TBatch]] = None
+
+
+def _init_worker(function: tp.Callable[[TBatch], TBatch]) -> None:
+    global _worker_function
+    _worker_function = function
+
+
+def _run_batch(batch: TBatch) -> TBatch:
+    assert _worker_function is not None
+    return _worker_function(batch)
+
+
+def map_batches(function: tp.Callable[[TBatch], TBatch], batches: tp.Iterable[TBatch], workers: int,
+                ordered: bool = True, max_pending: tp.Optional[int] = None) -> tp.Generator[TBatch, None, None]:
+    """Apply function to batches in a pool of worker processes.
+
+    function is pickled once per worker, batches and results cross process boundary pickled.
+    At most max_pending batches are submitted and not yet yielded, so the input is read only as fast as results
+    are consumed and memory stays bounded.
+
+    @param function: picklable function from batch to list of results
+    @param batches: input batches
+    @param workers: number of worker processes
+    @param ordered: yield results in order of batches; otherwise as soon as they are ready
+    @param max_pending: maximal number of batches in flight, 2 * workers by default
+    """
+    # process pool machinery is imported on first use, so that sequential runs do not pay for it
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_pending = max_pending or 2 * workers
+    batches = iter(batches)
+    pending: tp.Deque['Future[TBatch]'] = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(function,)) as executor:
+        try:
+            for batch in batches:
+                pending.append(executor.submit(_run_batch, batch))
+                if len(pending) >= max_pending:
+                    yield from _collect(pending, ordered)
+            while pending:
+                yield from _collect(pending, ordered)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _collect(pending: tp.Deque['Future[TBatch]'], ordered: bool) -> tp.Generator[TBatch, None, None]:
+    """Wait for the oldest batch if ordered, else for any batch, and yield the finished results"""
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    if ordered:
+        yield pending.popleft().result()
+        return
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        yield future.result()
+
+
+_END = object()
+
+
+def prefetch(items: tp.Iterable[T], depth: int = PREFETCH_DEPTH) -> tp.Generator[T, None, None]:
+    """Produce items in a background thread, at most depth items ahead of the consumer.
+    Useful when producing items releases the GIL, as reading files and decompression do, so it overlaps with
+    processing of items in the main thread. Exceptions of the producer are raised in the consumer.
+    """
+    queue: 'Queue[tp.Any]' = Queue(depth)
+    stop = threading.Event()
+
+    def put(value: tp.Any) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(value, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((None, item)):
+                    return
+        except BaseException as error:  # passed to the consumer
+            put((error, None))
+            return
+        put((None, _END))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            error, item = queue.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
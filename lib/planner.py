@@ -0,0 +1,387 @@
+import typing as tp
+
+from collections import Counter
+
+from . import columnar
+from . import external_sort as exts
+from . import graph as gr
+from . import operations as ops
+
+TRule = tp.Callable[['gr.Node', tp.List['gr.TNode']], 'gr.TNode']
+
+
+def rewrite(tail: 'gr.TNode', rule: TRule) -> 'gr.TNode':
+    """Rebuild the graph bottom-up. For every Node rule gets the original node and its rebuilt parents and returns
+    node to use instead. Shared nodes stay shared; input nodes are kept as is.
+    """
+    built: tp.Dict[int, gr.TNode] = {}
+
+    def build(node: 'gr.TNode') -> 'gr.TNode':
+        if id(node) not in built:
+            if isinstance(node, gr.Node):
+                built[id(node)] = rule(node, [build(parent) for parent in node.parents])
+            else:
+                built[id(node)] = node
+        return built[id(node)]
+
+    return build(tail)
+
+
+def count_consumers(tail: 'gr.TNode',
+                    resolve: tp.Callable[['gr.TNode'], 'gr.TNode'] = lambda node: node) -> tp.Counter[int]:
+    """Count consumers of every node of the graph, by node id"""
+    consumers: tp.Counter[int] = Counter()
+    visited: tp.Set[int] = set()
+
+    def count(node: 'gr.TNode') -> None:
+        if id(node) in visited:
+            return
+        visited.add(id(node))
+        for parent in node.parents:
+            parent = resolve(parent)
+            consumers[id(parent)] += 1
+            count(parent)
+
+    count(tail)
+    return consumers
+
+
+def copy_node(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+    return gr.Node(node.operation, parents)
+
+
+def can_push_filter(columns: ops.TOrder, operation: ops.Operation) -> bool:
+    """Whether a filter reading columns gives the same result placed before operation as after it"""
+    if isinstance(operation, ops.Map):
+        return not isinstance(operation.mapper, ops.Filter) and operation.mapper.preserved_order(columns) == columns
+    if isinstance(operation, (exts.ExternalSort, exts.PartialSort)):
+        return True
+    if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.Join)):
+        return set(columns) <= set(operation.keys)
+    return False
+
+
+def push_down_filters(tail: 'gr.TNode') -> 'gr.TNode':
+    """Move filters closer to the sources, so that fewer rows are sorted, reduced and joined.
+
+    Map(Filter) with declared columns goes below its input node, if nothing else consumes that node and the node
+    passes the filter columns through unchanged: Map with a mapper keeping them, sort, Reduce or HashReduce grouping
+    by them, Join by them (the filter then goes to both inputs). Repeated while filters move.
+    """
+    while True:
+        consumers = count_consumers(tail)
+        moved = 0
+
+        def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+            nonlocal moved
+            operation, parent = node.operation, parents[0] if parents else None
+            if isinstance(operation, ops.Map) and isinstance(operation.mapper, ops.Filter) \
+                    and operation.mapper.columns is not None and isinstance(parent, gr.Node) \
+                    and consumers[id(node.parents[0])] == 1 \
+                    and can_push_filter(tuple(operation.mapper.columns), parent.operation):
+                moved += 1
+                return gr.Node(parent.operation, [gr.Node(operation, [grandparent])
+                                                  for grandparent in parent.parents])
+            return copy_node(node, parents)
+
+        tail = rewrite(tail, rule)
+        if not moved:
+            return tail
+
+
+def prune_columns(tail: 'gr.TNode') -> 'gr.TNode':
+    """Read from files only the columns the graph uses.
+
+    Columns each node needs from its inputs come from Operation.input_columns, going from the tail, which needs
+    all columns, to the sources; a node shared by several consumers needs the union of what they need.
+    File input nodes reading the same source get the union over all of them, so they stay one source
+    for deduplicate. Rows of iterator sources belong to the caller and are never projected.
+    """
+    order: tp.List['gr.TNode'] = []
+    visited: tp.Set[int] = set()
+
+    def visit(node: 'gr.TNode') -> None:
+        if id(node) not in visited:
+            visited.add(id(node))
+            for parent in node.parents:
+                visit(parent)
+            order.append(node)
+
+    visit(tail)
+    needed: tp.Dict[int, ops.TColumns] = {id(tail): None}
+    by_source: tp.Dict[tp.Hashable, ops.TColumns] = {}
+    # consumers come before their inputs in reversed post-order, so needed columns of a node are complete
+    # when it is reached
+    for node in reversed(order):
+        columns = needed[id(node)]
+        if isinstance(node, gr.Node):
+            parent_columns = node.operation.input_columns(columns)
+            for parent in node.parents:
+                needed[id(parent)] = ops.union_columns(needed[id(parent)], parent_columns) \
+                    if id(parent) in needed else parent_columns
+        elif isinstance(node, gr.NodeFromFile):
+            key = node.source_key()
+            by_source[key] = ops.union_columns(by_source[key], columns) if key in by_source else columns
+
+    pruned: tp.Dict[int, 'gr.TNode'] = {}
+    for node in order:
+        if isinstance(node, gr.NodeFromFile) and by_source[node.source_key()] is not None:
+            columns = by_source[node.source_key()]
+            if node.columns is not None:
+                columns = columns & node.columns  # type: ignore
+            pruned[id(node)] = gr.NodeFromFile(node.filename, node.parser, node.size_hint, node.workers,
+                                               node.ordered, columns, node.format)
+
+    def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+        return copy_node(node, [pruned.get(id(parent), parent) for parent in parents])
+
+    return rewrite(tail, rule)
+
+
+def remove_redundant_sorts(tail: 'gr.TNode') -> 'gr.TNode':
+    """Drop sorts of streams already sorted by the sorting keys, and replace sorts of streams sorted by a prefix
+    of the sorting keys with PartialSort. Sortedness of streams is taken from Node.sorted_by.
+    """
+    def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+        operation = node.operation
+        if not isinstance(operation, exts.ExternalSort):
+            return copy_node(node, parents)
+        keys, order = tuple(operation.keys), parents[0].sorted_by
+        if order[:len(keys)] == keys:
+            return parents[0]
+        common = 0
+        while common < min(len(keys), len(order)) and keys[common] == order[common]:
+            common += 1
+        if common:
+            partial_sort = exts.PartialSort(keys[:common], keys, min(operation.memory_limit,
+                                                                     exts.IN_PROCESS_MEMORY_LIMIT),
+                                            operation.tmp_dir)
+            return gr.Node(partial_sort, parents)
+        return copy_node(node, parents)
+
+    return rewrite(tail, rule)
+
+
+def combine_before_sort(tail: 'gr.TNode') -> 'gr.TNode':
+    """Pre-aggregate rows before sorts feeding Reduce with CombinableReducer.
+
+    sort(keys) -> Reduce(reducer, keys) becomes Combine(reducer, keys) -> sort(keys) -> MergeReduce(reducer, keys),
+    so only partial states of groups are sorted. Applied only when the sort has no other consumers and sorts by
+    exactly the grouping keys. Floating point aggregates may differ in the last digits, as sums are regrouped.
+    """
+    consumers = count_consumers(tail)
+
+    def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+        operation = node.operation
+        sort_node = parents[0] if parents else None
+        if not isinstance(operation, ops.Reduce) or not isinstance(operation.reducer, ops.CombinableReducer) \
+                or not isinstance(sort_node, gr.Node) or not isinstance(sort_node.operation, exts.ExternalSort) \
+                or consumers[id(node.parents[0])] != 1 or set(sort_node.operation.keys) != set(operation.keys):
+            return copy_node(node, parents)
+        combine = gr.Node(ops.Combine(operation.reducer, operation.keys), sort_node.parents)
+        return gr.Node(ops.MergeReduce(operation.reducer, operation.keys), [gr.Node(sort_node.operation, [combine])])
+
+    return rewrite(tail, rule)
+
+
+def order_dependent(tail: 'gr.TNode') -> tp.Set[int]:
+    """Ids of nodes whose output order is relied on: it is read by Reduce, MergeReduce, PartialSort or
+    sort-merge Join, directly or through operations keeping order of rows (all but sorts, HashReduce, Combine and
+    hash Join). Order of the graph output itself is not counted.
+    """
+    order: tp.List['gr.TNode'] = []
+    visited: tp.Set[int] = set()
+
+    def visit(node: 'gr.TNode') -> None:
+        if id(node) not in visited:
+            visited.add(id(node))
+            for parent in node.parents:
+                visit(parent)
+            order.append(node)
+
+    visit(tail)
+    dependent: tp.Set[int] = set()
+    # consumers come before their inputs in reversed post-order
+    for node in reversed(order):
+        if not isinstance(node, gr.Node):
+            continue
+        operation = node.operation
+        if isinstance(operation, (ops.Reduce, ops.MergeReduce, exts.PartialSort)) \
+                or isinstance(operation, ops.Join) and operation.strategy in ('auto', 'merge'):
+            reads_order = True
+        elif isinstance(operation, (exts.ExternalSort, ops.HashReduce, ops.Combine)) \
+                or isinstance(operation, ops.Join) and operation.strategy == 'hash':
+            reads_order = False
+        else:
+            reads_order = id(node) in dependent
+        if reads_order:
+            dependent.update(id(parent) for parent in node.parents)
+    return dependent
+
+
+def choose_join_strategies(tail: 'gr.TNode', broadcast_limit: int) -> 'gr.TNode':
+    """Choose strategy of joins with strategy 'auto' by size hint of the right table.
+
+    If the right table is expected to have at most broadcast_limit rows, it is broadcast; if it is expected
+    to fit into max_rows of the join, hash join is used. In both cases sorts feeding only this join are dropped,
+    as neither strategy needs sorted input. Joins without a size hint, with a bigger right table or with output
+    order relied on by their consumers (see order_dependent) stay sort-merge.
+    """
+    consumers = count_consumers(tail)
+    dependent = order_dependent(tail)
+
+    def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+        operation = node.operation
+        if not isinstance(operation, ops.Join) or operation.strategy != 'auto' or parents[1].size_hint is None \
+                or id(node) in dependent:
+            return copy_node(node, parents)
+        if parents[1].size_hint <= broadcast_limit:
+            strategy = 'broadcast'
+        elif parents[1].size_hint <= operation.max_rows:
+            strategy = 'hash'
+        else:
+            return copy_node(node, parents)
+        unsorted_parents = []
+        for original, parent in zip(node.parents, parents):
+            if isinstance(parent, gr.Node) and isinstance(parent.operation, exts.ExternalSort) \
+                    and consumers[id(original)] == 1:
+                parent = parent.parents[0]
+            unsorted_parents.append(parent)
+        join = ops.Join(operation.joiner, operation.keys, strategy, operation.max_rows, operation.tmp_dir)
+        return gr.Node(join, unsorted_parents)
+
+    return rewrite(tail, rule)
+
+
+def vectorize(tail: 'gr.TNode', batch_size: int) -> 'gr.TNode':
+    """Switch operations with vectorized implementations to columnar execution.
+
+    Chains of Map nodes with BatchMapper mappers become one BatchMap node, if no node inside the chain has other
+    consumers, so columns computed by one mapper are passed to the next one as arrays. Parallel maps are left
+    as they are. Reduce is not switched to BatchReduce: on dict rows building the arrays costs more than
+    the aggregation saves.
+    """
+    consumers = count_consumers(tail)
+
+    def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+        operation = node.operation
+        if isinstance(operation, ops.Map) and isinstance(operation.mapper, ops.BatchMapper) \
+                and operation.workers == 1:
+            parent = parents[0]
+            if isinstance(parent, gr.Node) and isinstance(parent.operation, ops.BatchMap) \
+                    and consumers[id(node.parents[0])] == 1:
+                return gr.Node(ops.BatchMap(list(parent.operation.mappers) + [operation.mapper], batch_size),
+                               parent.parents)
+            return gr.Node(ops.BatchMap([operation.mapper], batch_size), parents)
+        return copy_node(node, parents)
+
+    return rewrite(tail, rule)
+
+
+def fuse_maps(tail: 'gr.TNode') -> 'gr.TNode':
+    """Run chains of Map nodes in one pass.
+
+    Map nodes running in the current process (not parallel, not vectorized) become FusedMap nodes, and chains
+    of them are merged into one, if no node inside the chain has other consumers. A chain which is the only input
+    of Reduce, HashReduce or Combine is merged into it as well, so mapped rows go straight into the aggregation.
+    """
+    consumers = count_consumers(tail)
+
+    def chain_parent(node: 'gr.Node', parents: tp.List['gr.TNode']) -> tp.Optional['gr.Node']:
+        """Rebuilt parent of node if it is a FusedMap chain node may be merged with"""
+        parent = parents[0] if parents else None
+        if isinstance(parent, gr.Node) and isinstance(parent.operation, ops.FusedMap) \
+                and parent.operation.operation is None and consumers[id(node.parents[0])] == 1:
+            return parent
+        return None
+
+    def rule(node: 'gr.Node', parents: tp.List['gr.TNode']) -> 'gr.TNode':
+        operation = node.operation
+        parent = chain_parent(node, parents)
+        if isinstance(operation, ops.Map) and operation.workers == 1 and not operation.vectorized:
+            if parent is not None:
+                mappers = list(parent.operation.mappers) + [operation.mapper]  # type: ignore
+                return gr.Node(ops.FusedMap(mappers), parent.parents)
+            return gr.Node(ops.FusedMap([operation.mapper]), parents)
+        if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.Combine)) and parent is not None:
+            return gr.Node(ops.FusedMap(parent.operation.mappers, operation), parent.parents)  # type: ignore
+        return copy_node(node, parents)
+
+    return rewrite(tail, rule)
+
+
+def optimize(tail: 'gr.TNode', **options: tp.Any) -> 'gr.TNode':
+    """Build run plan of the graph ending with tail. Run option optimize=False disables rewrites
+    which change operations, only deduplication of shared nodes is done then.
+    Run option columnar=True switches vectorized operations to columnar execution, if NumPy is installed.
+    Filters are pushed down and columns pruned first, while the graph still has the operations it was built of.
+    Maps left after that are fused last, as the other rewrites look for Map and Reduce nodes.
+    """
+    if options.get('optimize', True):
+        tail = push_down_filters(tail)
+        tail = prune_columns(tail)
+        tail = choose_join_strategies(tail, options.get('broadcast_limit', ops.DEFAULT_JOIN_ROWS))
+        tail = remove_redundant_sorts(tail)
+        tail = combine_before_sort(tail)
+    if options.get('columnar', False) and columnar.available():
+        tail = vectorize(tail, options.get('columnar_batch_size', columnar.BATCH_SIZE))
+    if options.get('optimize', True):
+        tail = fuse_maps(tail)
+    return deduplicate(tail)
+
+
+def unify_sources(tail: 'gr.TNode') -> tp.Callable[['gr.TNode'], 'gr.TNode']:
+    """Return function mapping every input node of the graph to the first input node reading the same source"""
+    canonical: tp.Dict[tp.Hashable, gr.TNode] = {}
+    visited: tp.Set[int] = set()
+
+    def visit(node: 'gr.TNode') -> None:
+        if id(node) in visited:
+            return
+        visited.add(id(node))
+        key = node.source_key()
+        if key is not None:
+            canonical.setdefault(key, node)
+        for parent in node.parents:
+            visit(parent)
+
+    visit(tail)
+
+    def resolve(node: 'gr.TNode') -> 'gr.TNode':
+        key = node.source_key()
+        return node if key is None else canonical[key]
+
+    return resolve
+
+
+def deduplicate(tail: 'gr.TNode') -> 'gr.TNode':
+    """Build run plan in which every node is computed once.
+
+    Graph.graph_from_graph reuses nodes, and input nodes of different branches may read the same source,
+    so without a plan a node would be recomputed for each consumer. In the plan input nodes reading the same
+    source are merged, and output of nodes with several consumers is fanned out through TeeNode.
+    The original nodes are left untouched, so the graph may be run again.
+    """
+    resolve = unify_sources(tail)
+    consumers = count_consumers(tail, resolve)
+
+    built: tp.Dict[int, gr.TNode] = {}
+    tees: tp.Dict[int, gr.TeeNode] = {}
+
+    def build(node: 'gr.TNode') -> 'gr.TNode':
+        if id(node) not in built:
+            if isinstance(node, gr.Node):
+                built[id(node)] = gr.Node(node.operation, [consume(parent) for parent in node.parents])
+            else:
+                built[id(node)] = node
+        return built[id(node)]
+
+    def consume(node: 'gr.TNode') -> 'gr.TNode':
+        node = resolve(node)
+        if consumers[id(node)] < 2:
+            return build(node)
+        if id(node) not in tees:
+            tees[id(node)] = gr.TeeNode(build(node), consumers[id(node)])
+        return tees[id(node)].branch()
+
+    return build(tail)
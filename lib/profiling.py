@@ -0,0 +1,147 @@
+import json
+import typing as tp
+
+from time import perf_counter, thread_time
+
+from .rows import TRow
+
+_END = object()
+
+
+class NodeStats:
+    """Statistics of one node of a run plan"""
+
+    def __init__(self, node_id: int, name: str, parents: tp.List[int]) -> None:
+        self.node_id = node_id
+        self.name = name
+        self.parents = parents
+        self.rows_out = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.counters: tp.Dict[str, int] = {}
+        self.peaks: tp.Dict[str, int] = {}
+
+
+class Profiler:
+    """
+    Per-node profile of graph runs, enabled by 'profiler' run option: graph.with_options(profiler=profiler).
+
+    Every node of the run plan wraps its output with `track`. Time is measured around every row a node produces
+    and time of nested nodes (its parents, pulled while the node computes the row) is subtracted, so every node
+    gets wall and CPU time of its own operation. CPU time is time of the main thread, worker processes and
+    background threads are not included.
+    Operations add their own statistics, such as bytes sent to sorting processes (`add`) or peak number of
+    buffered rows (`peak`), to the node which is computing at the moment.
+    Without the option nodes are not wrapped at all.
+    """
+
+    def __init__(self) -> None:
+        self.stats: tp.Dict[int, NodeStats] = {}
+        self._ids: tp.Dict[int, int] = {}
+        self._nodes: tp.List[tp.Any] = []
+        # frames of nodes computing a row: stats, start wall time, start CPU time, nested wall time, nested CPU time
+        self._stack: tp.List[tp.List[tp.Any]] = []
+
+    def node_id(self, node: tp.Any) -> int:
+        """Id of node in the profile, parents are numbered before their children"""
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            parents = [self.node_id(parent) for parent in node.parents]
+            node_id = self._ids[id(node)] = len(self._ids)
+            self._nodes.append(node)  # keeps node alive, so that its id is not reused
+            self.stats[node_id] = NodeStats(node_id, describe(node), parents)
+        return node_id
+
+    def track(self, node: tp.Any, rows: tp.Iterable[TRow]) -> tp.Generator[TRow, None, None]:
+        """Output rows of node, measured"""
+        return self._track(self.stats[self.node_id(node)], iter(rows))
+
+    def _track(self, stats: NodeStats, rows: tp.Iterator[TRow]) -> tp.Generator[TRow, None, None]:
+        stack = self._stack
+        while True:
+            frame = [stats, perf_counter(), thread_time(), 0.0, 0.0]
+            stack.append(frame)
+            try:
+                row = next(rows, _END)
+            finally:
+                wall_time = perf_counter() - frame[1]
+                cpu_time = thread_time() - frame[2]
+                stack.pop()
+                stats.wall_time += wall_time - frame[3]
+                stats.cpu_time += cpu_time - frame[4]
+                if stack:
+                    stack[-1][3] += wall_time
+                    stack[-1][4] += cpu_time
+            if row is _END:
+                return
+            stats.rows_out += 1
+            yield row
+
+    def add(self, name: str, value: int) -> None:
+        """Add value to counter of the node computing at the moment"""
+        if self._stack:
+            counters = self._stack[-1][0].counters
+            counters[name] = counters.get(name, 0) + value
+
+    def peak(self, name: str, value: int) -> None:
+        """Raise peak of the node computing at the moment to value"""
+        if self._stack:
+            peaks = self._stack[-1][0].peaks
+            if value > peaks.get(name, 0):
+                peaks[name] = value
+
+    def rows_in(self, stats: NodeStats) -> int:
+        return sum(self.stats[parent].rows_out for parent in stats.parents)
+
+    def trace(self) -> tp.List[tp.Dict[str, tp.Any]]:
+        """Machine-readable profile: one dict per node"""
+        return [{'id': stats.node_id, 'node': stats.name, 'parents': stats.parents, 'rows_in': self.rows_in(stats),
+                 'rows_out': stats.rows_out, 'wall_time': stats.wall_time, 'cpu_time': stats.cpu_time,
+                 **stats.counters, **{'peak_' + name: value for name, value in stats.peaks.items()}}
+                for stats in self.stats.values()]
+
+    def dump(self, filename: str) -> None:
+        """Write trace to JSON file"""
+        with open(filename, 'w') as file:
+            json.dump(self.trace(), file, indent=1)
+
+    def report(self) -> str:
+        """Profile as a table, nodes in order of wall time"""
+        total = sum(stats.wall_time for stats in self.stats.values()) or 1.0
+        lines = ['{:>3} {:<48} {:>9} {:>11} {:>11} {:>9} {:>9} {:>6}  {}'.format(
+            'id', 'node', 'parents', 'rows in', 'rows out', 'wall, s', 'cpu, s', 'wall%', 'other')]
+        for stats in sorted(self.stats.values(), key=lambda stats: -stats.wall_time):
+            other = ['{}={}'.format(name, value) for name, value in stats.counters.items()]
+            other += ['peak {}={}'.format(name, value) for name, value in stats.peaks.items()]
+            lines.append('{:>3} {:<48} {:>9} {:>11} {:>11} {:>9.3f} {:>9.3f} {:>6.1f}  {}'.format(
+                stats.node_id, stats.name[:48], ','.join(map(str, stats.parents)) or '-', self.rows_in(stats),
+                stats.rows_out, stats.wall_time, stats.cpu_time, 100 * stats.wall_time / total, ' '.join(other)))
+        return '\n'.join(lines)
+
+
+def describe(node: tp.Any) -> str:
+    """Short description of node: its operation with the most telling parameters"""
+    operation = getattr(node, 'operation', None)
+    if operation is None:
+        if hasattr(node, 'filename'):
+            return 'file {}'.format(node.filename)
+        if hasattr(node, 'iterator_name'):
+            return 'iter {}'.format(node.iterator_name)
+        return type(node).__name__
+    return describe_operation(operation)
+
+
+def describe_operation(operation: tp.Any) -> str:
+    name = type(operation).__name__
+    for attribute in ('mapper', 'reducer', 'joiner'):
+        if hasattr(operation, attribute):
+            name += ' ' + type(getattr(operation, attribute)).__name__
+    if hasattr(operation, 'mappers'):
+        name += ' ' + '+'.join(type(mapper).__name__ for mapper in operation.mappers)
+    if getattr(operation, 'keys', None):
+        name += ' by ' + ','.join(operation.keys)
+    if hasattr(operation, 'strategy'):
+        name += ' ({})'.format(operation.strategy)
+    if getattr(operation, 'operation', None) is not None:
+        name += ' > ' + describe_operation(operation.operation)
+    return name
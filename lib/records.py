@@ -0,0 +1,125 @@
+import typing as tp
+
+from collections.abc import Mapping
+
+from .rows import TRow
+
+_get = tuple.__getitem__
+_new = tuple.__new__
+_VALUES = slice(1, None)
+
+
+class Schema:
+    """Column names of records, shared by all records with the same columns in the same order.
+    Schemas are interned (see schema), so records of one stream share one schema.
+    """
+    __slots__ = ('columns', 'index')
+
+    def __init__(self, columns: tp.Tuple[str, ...]) -> None:
+        self.columns = columns
+        # positions in record, the schema itself comes first
+        self.index = {column: position for position, column in enumerate(columns, 1)}
+
+    def __reduce__(self) -> tp.Tuple[tp.Any, ...]:
+        # pickle keeps one copy of a schema per pickled chunk, unpickled schemas are interned again
+        return schema, (self.columns,)
+
+    def __repr__(self) -> str:
+        return 'Schema({!r})'.format(self.columns)
+
+
+_SCHEMAS: tp.Dict[tp.Tuple[str, ...], Schema] = {}
+
+
+def schema(columns: tp.Tuple[str, ...]) -> Schema:
+    """Interned schema of columns"""
+    found = _SCHEMAS.get(columns)
+    if found is None:
+        found = _SCHEMAS[columns] = Schema(columns)
+    return found
+
+
+class Record(tuple):
+    """Compact read-only row: a tuple of its schema followed by values of the columns.
+
+    Record is a Mapping of the same items as the row it was made of (and compares equal to it), so joiners and
+    sort keys read it as any row. It is one object of 64 bytes for two columns against 184 bytes of a dict,
+    and column names are kept once per schema. Reading a column goes through Python code and is slower than
+    with a dict, so operations keep rows as records only while they are buffered, with 'compact_rows' run option
+    (in sorted runs, join indexes and groups), and turn them back into dicts with `to_dict`.
+    `values` and `items` return snapshots, not views; `copy` returns a dict.
+    """
+    __slots__ = ()
+
+    @property
+    def schema(self) -> Schema:
+        return _get(self, 0)  # type: ignore
+
+    def __getitem__(self, column: str) -> tp.Any:  # type: ignore
+        return _get(self, _get(self, 0).index[column])
+
+    def get(self, column: str, default: tp.Any = None) -> tp.Any:
+        position = _get(self, 0).index.get(column)
+        return default if position is None else _get(self, position)
+
+    def __contains__(self, column: object) -> bool:
+        return column in _get(self, 0).index
+
+    def __iter__(self) -> tp.Iterator[str]:  # type: ignore
+        return iter(_get(self, 0).columns)
+
+    def __len__(self) -> int:
+        return tuple.__len__(self) - 1
+
+    def keys(self) -> tp.KeysView[str]:
+        return _get(self, 0).index.keys()  # type: ignore
+
+    def values(self) -> tp.Tuple[tp.Any, ...]:
+        return _get(self, _VALUES)  # type: ignore
+
+    def items(self) -> tp.List[tp.Tuple[str, tp.Any]]:
+        return list(zip(_get(self, 0).columns, _get(self, _VALUES)))
+
+    def to_dict(self) -> TRow:
+        return dict(zip(_get(self, 0).columns, _get(self, _VALUES)))
+
+    copy = to_dict
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Record):
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other: object) -> bool:
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None  # type: ignore
+
+    def __reduce__(self) -> tp.Tuple[tp.Any, ...]:
+        # schema and values are the arguments, so a record pickles about as compact as a dict
+        return _restore, _get(self, slice(None))
+
+    def __repr__(self) -> str:
+        return 'Record({!r})'.format(self.to_dict())
+
+
+Mapping.register(Record)
+
+
+def _restore(*items: tp.Any) -> Record:
+    return _new(Record, items)  # type: ignore
+
+
+def compact(row: TRow) -> Record:
+    """Row as a record, records are returned as is"""
+    if isinstance(row, Record):
+        return row
+    return _new(Record, (schema(tuple(row)), *row.values()))  # type: ignore
+
+
+def to_dict(row: TRow) -> TRow:
+    """Row as a dict, dicts are returned as is"""
+    return row.to_dict() if isinstance(row, Record) else row  # type: ignore
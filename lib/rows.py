@@ -0,0 +1,5 @@
+import typing as tp
+
+TRow = tp.Dict[str, tp.Any]
+TRowsIterable = tp.Iterable[TRow]
+TRowsGenerator = tp.Generator[TRow, None, None]
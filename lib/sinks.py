@@ -0,0 +1,86 @@
+import json
+import typing as tp
+
+from abc import abstractmethod, ABC
+from . import files
+from . import operations as ops
+from . import spill
+
+
+class Sink(ABC):
+    """Destination of rows of a graph run (see Graph.run_to). Rows are written as they are produced,
+    so the result of a graph never has to fit in memory. Sinks are context managers, close flushes buffered rows.
+    """
+    row_count = 0
+
+    @abstractmethod
+    def extend(self, rows: ops.TRowsIterable) -> None:
+        """Write rows, row_count is increased by number of rows"""
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> 'Sink':
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
+
+
+class JsonLinesSink(Sink):
+    """Text file with one row per line, compressed according to suffix of filename (see files.open_output)"""
+
+    def __init__(self, filename: str, formatter: tp.Callable[[ops.TRow], str] = json.dumps,
+                 compression: tp.Optional[str] = 'infer', chunk_size: int = files.ROW_FILE_CHUNK_SIZE) -> None:
+        """
+        @param filename: file to create
+        @param formatter: formatter from row to line without line end
+        @param compression: compression of file, see files.open_output
+        @param chunk_size: number of rows formatted and written at once
+        """
+        self._writer = files.TextFileWriter(filename, formatter, compression, chunk_size)
+
+    def extend(self, rows: ops.TRowsIterable) -> None:
+        self._writer.extend(rows)
+        self.row_count = self._writer.row_count
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class RowFileSink(Sink):
+    """Binary row file, readable by Graph.graph_from_file with format 'rows' (see files.RowFileWriter)"""
+
+    def __init__(self, filename: str, chunk_size: int = files.ROW_FILE_CHUNK_SIZE,
+                 compression: tp.Optional[str] = 'infer') -> None:
+        """
+        @param filename: file to create
+        @param chunk_size: number of rows encoded together
+        @param compression: compression of file, see files.open_output
+        """
+        self._writer = files.RowFileWriter(filename, chunk_size, compression)
+
+    def extend(self, rows: ops.TRowsIterable) -> None:
+        self._writer.extend(rows)
+        self.row_count = self._writer.row_count
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class CallbackSink(Sink):
+    """Passes rows to callback in chunks of chunk_size rows"""
+
+    def __init__(self, callback: tp.Callable[[tp.List[ops.TRow]], tp.Any], chunk_size: int = spill.CHUNK_SIZE) -> None:
+        """
+        @param callback: function called with every chunk of rows
+        @param chunk_size: number of rows passed at once, 1 to pass rows one by one
+        """
+        self.callback = callback
+        self.chunk_size = chunk_size
+
+    def extend(self, rows: ops.TRowsIterable) -> None:
+        for chunk in spill.iter_chunks(rows, self.chunk_size):
+            self.callback(chunk)
+            self.row_count += len(chunk)
@@ -0,0 +1,214 @@
+import itertools
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import typing as tp
+
+from .rows import TRow, TRowsIterable, TRowsGenerator
+
+FRAME_HEADER = struct.Struct('<I')
+CHUNK_SIZE = 1024
+TEE_BUFFER_SIZE = 10000
+# Under memory pressure buffers are spilled when they hold at least so many rows, not to create tiny spill files
+PRESSURE_MIN_ROWS = 1024
+
+
+def write_frame(file: tp.BinaryIO, payload: bytes) -> None:
+    """Write one length-prefixed frame to binary file"""
+    file.write(FRAME_HEADER.pack(len(payload)))
+    file.write(payload)
+
+
+def read_frames(file: tp.BinaryIO) -> tp.Generator[bytes, None, None]:
+    """Read length-prefixed frames from binary file until EOF"""
+    while True:
+        header = file.read(FRAME_HEADER.size)
+        if not header:
+            return
+        (length,) = FRAME_HEADER.unpack(header)
+        yield file.read(length)
+
+
+def should_spill(governor: tp.Any, buffered: int, kind: str) -> bool:
+    """Whether memory governor of the run (see memory_governor.MemoryGovernor, None if there is none) asks buffer
+    of buffered rows to spill; the spill is recorded under kind"""
+    if governor is None or not governor.pressure or buffered < PRESSURE_MIN_ROWS:
+        return False
+    governor.spilled(kind)
+    return True
+
+
+def iter_chunks(rows: TRowsIterable, chunk_size: int) -> tp.Generator[tp.List[TRow], None, None]:
+    """Group rows into lists of chunk_size rows (the last one may be shorter)"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def dump_chunk(rows: tp.List[TRow]) -> bytes:
+    return pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_chunk(payload: bytes) -> tp.List[TRow]:
+    return pickle.loads(payload)
+
+
+class SpillFile:
+    """Temporary file with rows stored as framed pickled chunks.
+
+    Rows are appended with `write` and read back in the same order by iterating the object;
+    the file may be read any number of times after `close`.
+    """
+
+    def __init__(self, directory: tp.Optional[str] = None, chunk_size: int = CHUNK_SIZE) -> None:
+        """
+        @param directory: directory for temporary file, system default if None
+        @param chunk_size: number of rows pickled together in one frame
+        """
+        descriptor, self.path = tempfile.mkstemp(prefix='compgraph-', suffix='.spill', dir=directory)
+        self._file: tp.Optional[tp.BinaryIO] = os.fdopen(descriptor, 'wb')
+        self._chunk: tp.List[TRow] = []
+        self.chunk_size = chunk_size
+        self.row_count = 0
+
+    def write(self, row: TRow) -> None:
+        self._chunk.append(row)
+        self.row_count += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._flush()
+
+    def extend(self, rows: TRowsIterable) -> None:
+        for row in rows:
+            self.write(row)
+
+    def _flush(self) -> None:
+        if self._chunk:
+            assert self._file is not None, 'spill file is already closed'
+            write_frame(self._file, dump_chunk(self._chunk))
+            self._chunk = []
+
+    def close(self) -> None:
+        """Finish writing; the file becomes readable"""
+        if self._file is not None:
+            self._flush()
+            self._file.close()
+            self._file = None
+
+    def __iter__(self) -> TRowsGenerator:
+        self.close()
+        with open(self.path, 'rb') as file:
+            for payload in read_frames(file):
+                yield from load_chunk(payload)
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Tee:
+    """Fan-out of one row stream to several consumers.
+
+    The stream is read once; every consumer iterates its own branch. Rows not yet read by all branches are
+    buffered, when the buffer grows over buffer_size rows (consumers drift far apart), or under memory pressure,
+    it is spilled to disk. Every branch gets its own copies of buffered rows, so consumers may modify them.
+    """
+
+    def __init__(self, rows: TRowsIterable, consumers: int, buffer_size: int,
+                 directory: tp.Optional[str] = None, governor: tp.Any = None, profiler: tp.Any = None) -> None:
+        """
+        @param rows: stream to fan out
+        @param consumers: number of branches
+        @param buffer_size: maximal number of rows kept in memory
+        @param directory: directory for spilled rows, system default if None
+        @param governor: memory governor of the run, see should_spill
+        @param profiler: profiler of the run, gets peak number of rows in memory (see profiling.Profiler)
+        """
+        self._rows = iter(rows)
+        self._exhausted = False
+        self._memory: tp.List[TRow] = []
+        self._memory_start = 0
+        self._segments: tp.List[tp.Tuple[int, SpillFile]] = []
+        self._positions = [0] * consumers
+        self._finished = [False] * consumers
+        self.buffer_size = buffer_size
+        self.directory = directory
+        self.governor = governor
+        self.profiler = profiler
+
+    def branch(self, index: int) -> TRowsGenerator:
+        """Iterate the stream as consumer number index"""
+        position = 0
+        reader: tp.Iterator[TRow] = iter([])
+        reader_end = 0
+        try:
+            while True:
+                if position < self._memory_start:
+                    if position >= reader_end:
+                        start, segment = next((start, segment) for start, segment in self._segments
+                                              if start <= position < start + len(segment))
+                        reader = itertools.islice(iter(segment), position - start, None)
+                        reader_end = start + len(segment)
+                    row = next(reader)
+                elif position < self._memory_start + len(self._memory):
+                    row = self._memory[position - self._memory_start].copy()
+                elif self._pull():
+                    continue
+                else:
+                    return
+                position += 1
+                self._positions[index] = position
+                yield row
+        finally:
+            self._finished[index] = True
+            self._positions[index] = sys.maxsize
+            if all(self._finished):
+                self.close()
+
+    def _pull(self) -> bool:
+        if self._exhausted:
+            return False
+        row = next(self._rows, None)
+        if row is None:
+            self._exhausted = True
+            return False
+        self._memory.append(row)
+        if self.profiler is not None:
+            self.profiler.peak('buffered_rows', len(self._memory))
+        if len(self._memory) > self.buffer_size:
+            self._shrink(False)
+        elif len(self._memory) % PRESSURE_MIN_ROWS == 0 and should_spill(self.governor, len(self._memory), 'tee'):
+            self._shrink(True)
+        return True
+
+    def _shrink(self, pressure: bool) -> None:
+        """Drop rows read by all branches, spill the rest if the buffer is still full or there is memory pressure"""
+        slowest = min(self._positions)
+        consumed = max(0, slowest - self._memory_start)
+        if consumed:
+            del self._memory[:consumed]
+            self._memory_start += consumed
+        if len(self._memory) >= self.buffer_size or (pressure and self._memory):
+            segment = SpillFile(self.directory)
+            segment.extend(self._memory)
+            segment.close()
+            self._segments.append((self._memory_start, segment))
+            self._memory_start += len(self._memory)
+            self._memory = []
+        for start, segment in [item for item in self._segments if item[0] + len(item[1]) <= slowest]:
+            segment.remove()
+            self._segments.remove((start, segment))
+
+    def close(self) -> None:
+        for _, segment in self._segments:
+            segment.remove()
+        self._segments = []
+        self._memory = []
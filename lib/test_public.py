@@ -1,10 +1,20 @@
+import itertools
+import json
+import math
 import typing as tp
 
+from datetime import datetime
+
 from compgraph import graphs
-from compgraph.lib import memory_watchdog
+from compgraph.lib import memory_governor, memory_watchdog
 from operator import itemgetter
-from pytest import approx
+from pytest import approx, raises
 from . import operations as ops
+from . import external_sort as exts
+from . import files
+from . import parallel
+from . import sinks
+from . import spill
 
 
 def test_dummy_map() -> None:
@@ -655,3 +665,406 @@ def test_simple_join_with_collision() -> None:
                       keys=['player_id'])(presorted_games, presorted_players)
 
     assert etalon == sorted(result, key=itemgetter('game_id'))
+
+
+def test_external_sort_spills_runs(tmp_path: tp.Any) -> None:
+    rows: ops.TRowsIterable = [{'key': i * 7 % 10, 'value': i} for i in range(500)]
+
+    result = exts.sort_rows(rows, ['key'], memory_limit=1024, tmp_dir=str(tmp_path))
+
+    assert sorted(rows, key=itemgetter('key')) == list(result)
+
+
+def test_external_sort_operation() -> None:
+    rows: ops.TRowsIterable = [{'a': i % 3, 'b': -i, 'c': str(i)} for i in range(1000)]
+
+    result = exts.ExternalSort(['a', 'b'], memory_limit=4096)(iter(rows))
+
+    assert sorted(rows, key=itemgetter('a', 'b')) == list(result)
+
+
+def test_external_sort_small_chunks() -> None:
+    rows: ops.TRowsIterable = [{'a': i % 5, 'b': i} for i in range(50)]
+
+    result = exts.ExternalSort(['a'], chunk_size=3)(iter(rows))
+
+    assert sorted(rows, key=itemgetter('a')) == list(result)
+    assert [] == list(exts.ExternalSort(['a'], chunk_size=3)(iter([])))
+
+
+def test_external_sort_parallel() -> None:
+    rows: ops.TRowsIterable = [{'a': i % 7, 'b': i % 3, 'c': i} for i in range(3000)]
+
+    result = exts.ExternalSort(['a', 'b'], chunk_size=100, workers=3)(iter(rows))
+
+    assert sorted(rows, key=itemgetter('a', 'b')) == list(result)
+
+
+def test_tee_spills_when_consumers_drift(tmp_path: tp.Any) -> None:
+    rows: ops.TRowsIterable = [{'value': i} for i in range(100)]
+
+    tee = spill.Tee(iter(rows), consumers=2, buffer_size=10, directory=str(tmp_path))
+    first, second = tee.branch(0), tee.branch(1)
+
+    assert rows[:70] == list(itertools.islice(first, 70))
+    assert rows == list(second)
+    assert rows[70:] == list(first)
+    assert [] == list(tmp_path.iterdir())
+
+
+def test_hash_reduce() -> None:
+    rows: ops.TRowsIterable = [{'word': word, 'n': i} for i, word in enumerate('a b a c b a d'.split())]
+
+    etalon: ops.TRowsIterable = [
+        {'word': 'a', 'n': 7},
+        {'word': 'b', 'n': 5},
+        {'word': 'c', 'n': 3},
+        {'word': 'd', 'n': 6}
+    ]
+
+    result = ops.HashReduce(ops.Sum('n'), ['word'])(rows)
+
+    assert etalon == list(result)
+
+
+def test_hash_reduce_spills_partitions(tmp_path: tp.Any) -> None:
+    rows: ops.TRowsIterable = [{'a': i % 50, 'b': i % 7, 'n': 1} for i in range(2000)]
+
+    result = ops.HashReduce(ops.Count('count'), ['a', 'b'], max_groups=10, tmp_dir=str(tmp_path))(rows)
+    etalon = ops.Reduce(ops.Count('count'), ['a', 'b'])(sorted(rows, key=itemgetter('a', 'b')))
+
+    assert list(etalon) == sorted(result, key=itemgetter('a', 'b'))
+    assert [] == list(tmp_path.iterdir())
+
+
+def test_hash_reduce_sorts_when_rows_do_not_fit(tmp_path: tp.Any) -> None:
+    rows: ops.TRowsIterable = [{'a': i % 7, 'n': i % 11} for i in range(2000)]
+
+    result = ops.HashReduce(ops.TopN('n', 3), ['a'], max_rows=100, tmp_dir=str(tmp_path))(iter(rows))
+    etalon = ops.Reduce(ops.TopN('n', 3), ['a'])(sorted(rows, key=itemgetter('a')))
+
+    assert list(etalon) == list(result)
+    assert [] == list(tmp_path.iterdir())
+
+
+def test_combine_and_merge_reduce() -> None:
+    rows: ops.TRowsIterable = [{'doc_id': i // 10 % 4, 'text': 'abcde'[i % 5]} for i in range(100)]
+    reducer = ops.TermFrequency('text')
+
+    partial_rows = list(ops.Combine(reducer, ['doc_id'], max_groups=2)(rows))
+    result = ops.MergeReduce(reducer, ['doc_id'])(sorted(partial_rows, key=itemgetter('doc_id')))
+    etalon = ops.Reduce(reducer, ['doc_id'])(sorted(rows, key=itemgetter('doc_id')))
+
+    assert len(partial_rows) < len(rows)
+    assert list(etalon) == list(result)
+
+
+def test_hash_reduce_combinable_spills_states(tmp_path: tp.Any) -> None:
+    rows: ops.TRowsIterable = [{'a': i % 50, 'n': i} for i in range(2000)]
+
+    result = ops.HashReduce(ops.Sum('n'), ['a'], max_groups=10, tmp_dir=str(tmp_path))(rows)
+    etalon = ops.Reduce(ops.Sum('n'), ['a'])(sorted(rows, key=itemgetter('a')))
+
+    assert list(etalon) == sorted(result, key=itemgetter('a'))
+
+
+def test_hash_and_broadcast_join() -> None:
+    players: ops.TRowsIterable = [
+        {'player_id': 0, 'username': 'root'},
+        {'player_id': 1, 'username': 'XeroX'},
+        {'player_id': 2, 'username': 'jay'}
+    ]
+
+    games: ops.TRowsIterable = [
+        {'game_id': 1, 'player_id': 3, 'score': 0},
+        {'game_id': 2, 'player_id': 1, 'score': 17},
+        {'game_id': 3, 'player_id': 2, 'score': 22},
+        {'game_id': 4, 'player_id': 2, 'score': 41},
+        {'game_id': 5, 'player_id': 1, 'score': 34}
+    ]
+
+    for joiner in [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()]:
+        etalon = ops.Join(joiner, keys=['player_id'])(iter(sorted(games, key=itemgetter('player_id'))),
+                                                      iter(sorted(players, key=itemgetter('player_id'))))
+        etalon_rows = sorted(etalon, key=lambda x: (x.get('game_id', -1), x['player_id']))
+        for strategy, max_rows in [('broadcast', 100), ('hash', 100), ('hash', 1)]:
+            result = ops.Join(joiner, keys=['player_id'], strategy=strategy, max_rows=max_rows)(iter(games),
+                                                                                              iter(players))
+            assert etalon_rows == sorted(result, key=lambda x: (x.get('game_id', -1), x['player_id']))
+
+
+def test_hash_join_repartitions_and_sorts_hot_keys(tmp_path: tp.Any) -> None:
+    left: ops.TRowsIterable = [{'key': 0 if i % 3 else i % 20, 'left': i} for i in range(90)]
+    right: ops.TRowsIterable = [{'key': 0 if i % 2 else i % 25, 'right': i} for i in range(60)]
+
+    def order(row: ops.TRow) -> tp.Tuple[int, int]:
+        return row.get('left', -1), row.get('right', -1)
+
+    etalon = ops.Join(ops.OuterJoiner(), ['key'])(sorted(left, key=itemgetter('key')),
+                                                  sorted(right, key=itemgetter('key')))
+    join = ops.Join(ops.OuterJoiner(), ['key'], strategy='hash', max_rows=10, tmp_dir=str(tmp_path))
+    result = join(iter(left), iter(right))
+
+    assert sorted(etalon, key=order) == sorted(result, key=order)
+    assert [] == list(tmp_path.iterdir())
+
+
+def test_join_by_several_keys() -> None:
+    left: ops.TRowsIterable = [
+        {'a': 1, 'b': 'x', 'left': 0},
+        {'a': 1, 'b': 'y', 'left': 1},
+        {'a': 2, 'b': 'x', 'left': 2}
+    ]
+    right: ops.TRowsIterable = [
+        {'a': 1, 'b': 'y', 'right': 3},
+        {'a': 2, 'b': 'x', 'right': 4},
+        {'a': 2, 'b': 'y', 'right': 5}
+    ]
+
+    assert ops.key_getter(['a', 'b'])(left[0]) == (1, 'x')
+    assert ops.key_values(['a'], ops.key_getter(['a'])(left[0])) == (1,)
+
+    result = ops.Join(ops.OuterJoiner(), keys=['a', 'b'])(iter(left), iter(right))
+    assert list(result) == [
+        {'a': 1, 'b': 'x', 'left': 0},
+        {'a': 1, 'b': 'y', 'left': 1, 'right': 3},
+        {'a': 2, 'b': 'x', 'left': 2, 'right': 4},
+        {'a': 2, 'b': 'y', 'right': 5}
+    ]
+
+
+def test_many_to_many_merge_join(tmp_path: tp.Any) -> None:
+    left = [{'key': key, 'left': i} for i, key in enumerate([1, 1, 1, 2, 3, 3])]
+    right = [{'key': key, 'right': i} for i, key in enumerate([1, 1, 2, 2, 2, 2, 2, 3])]
+    expected = sorted(({'key': a['key'], 'left': a['left'], 'right': b['right']}
+                       for a in left for b in right if a['key'] == b['key']),
+                      key=itemgetter('left', 'right'))
+
+    for max_rows in [100, 2]:
+        result = ops.Join(ops.InnerJoiner(), keys=['key'], max_rows=max_rows, tmp_dir=str(tmp_path))(iter(left),
+                                                                                                   iter(right))
+        assert expected == sorted(result, key=itemgetter('left', 'right'))
+    assert not list(tmp_path.iterdir())
+
+
+def test_parallel_map() -> None:
+    rows = [{'test_id': i, 'text': 'word{} other{}'.format(i, i)} for i in range(1000)]
+    expected = list(ops.Map(ops.Split(column='text'))(row.copy() for row in rows))
+
+    result = ops.Map(ops.Split(column='text'), workers=3, batch_size=64)(row.copy() for row in rows)
+    assert expected == list(result)
+
+    result = ops.Map(ops.Split(column='text'), workers=3, batch_size=64, ordered=False,
+                     max_pending=2)(row.copy() for row in rows)
+    assert sorted(expected, key=itemgetter('test_id', 'text')) == sorted(result, key=itemgetter('test_id', 'text'))
+
+
+def test_process_date_formats() -> None:
+    rows: ops.TRowsIterable = [
+        {'enter_time': '20171020T112237.427000', 'leave_time': '20171020T112238.723'},
+        {'enter_time': '2017-10-11 14:55:51', 'leave_time': '20171011T145553.040000'},
+        {'enter_time': '20171024T144059', 'leave_time': 'Oct 24 2017 14:41:01'}
+    ]
+    etalon = [(0.00036, 'Fri', 11), (0.0005666666666666667, 'Wed', 14), (0.0005555555555555556, 'Tue', 14)]
+
+    for date_format in [None, ops.COMPACT_DATE_FORMAT, '%Y-%m-%d %H:%M:%S']:
+        mapper = ops.ProcessDate('enter_time', 'leave_time', 'weekday', 'hour', 'duration', date_format=date_format)
+        result = ops.Map(mapper)(row.copy() for row in rows)
+        assert etalon == [(row['duration'], row['weekday'], row['hour']) for row in result]
+
+    assert ops.parse_compact_date('20171020T112237.4') == datetime(2017, 10, 20, 11, 22, 37, 400000)
+
+
+def test_columnar_batch_map_and_reduce() -> None:
+    rows = [{'doc': i // 7, 'tf': (i % 5 + 1) / 10, 'count': i % 3 + 1, 'docs': i % 4 + 1, 'total': 10}
+            for i in range(100)]
+    mappers: tp.List[ops.BatchMapper] = [ops.InverseDocumentFrequency('total', 'docs'), ops.TFIDF('tf', 'idf'),
+                                         ops.PMI('tf', 'idf', 'pmi'), ops.Product(['count', 'docs'])]
+
+    expected = [row.copy() for row in rows]
+    for mapper in mappers:
+        expected = list(ops.Map(mapper)(expected))
+    result = list(ops.BatchMap(mappers, batch_size=16)(row.copy() for row in rows))
+    assert [{key: approx(value) for key, value in row.items()} for row in expected] == result
+
+    for reducer in [ops.Sum('count'), ops.MeanSpeed('tf', 'docs', 'speed', 'count')]:
+        expected = list(ops.Reduce(reducer, ['doc'])(row.copy() for row in rows))
+        result = list(ops.BatchReduce(reducer, ['doc'], batch_size=16)(row.copy() for row in rows))
+        assert [{key: approx(value) for key, value in row.items()} for row in expected] == result
+
+    # results and errors are the same as row by row
+    rows = [{'a': 2 ** 40, 'b': 2 ** 40, 'big': 2 ** 70, 'zero': 0, 'one': 1}]
+    for mapper in [ops.Product(['a', 'b']), ops.TFIDF('a', 'b'), ops.InverseDocumentFrequency('big', 'a')]:
+        expected = list(ops.Map(mapper)(row.copy() for row in rows))
+        assert expected == list(ops.BatchMap([mapper])(row.copy() for row in rows))
+    for mapper, error in [(ops.InverseDocumentFrequency('one', 'zero'), ZeroDivisionError),
+                          (ops.PMI('zero', 'one'), ValueError)]:
+        for operation in [ops.Map(mapper), ops.BatchMap([mapper])]:
+            with raises(error):
+                list(operation(row.copy() for row in rows))
+
+
+def test_vectorized_street_length() -> None:
+    rows = [{'start': [37.5 + i / 1000, 55.7 - i / 2000], 'end': [37.5 - i / 3000, 55.7 + i / 700], 'edge_id': i}
+            for i in range(100)]
+    expected = list(ops.Map(ops.StreetLength('start', 'end', 'length'))(row.copy() for row in rows))
+
+    for workers in [1, 2]:
+        result = ops.Map(ops.StreetLength('start', 'end', 'length'), workers=workers, batch_size=16,
+                         vectorized=True)(row.copy() for row in rows)
+        assert [{**row, 'length': approx(row['length'], rel=1e-12)} for row in expected] == list(result)
+
+
+def test_read_text_rows_by_shards(tmp_path: tp.Any) -> None:
+    rows = [{'id': i, 'text': 'line ' * (i % 7)} for i in range(500)]
+    filename = str(tmp_path / 'rows.txt')
+    with open(filename, 'w') as file:
+        file.writelines(json.dumps(row) + '\n' for row in rows)
+
+    assert rows == list(files.read_text_rows(filename))
+    assert rows == list(files.read_text_rows(filename, parser=lambda line: json.loads(line.strip())))
+    for shards in [1, 3, 64, 10000]:
+        result = [row for start, end in files.line_aligned_shards(filename, shards)
+                  for row in files.read_text_rows(filename, start=start, end=end)]
+        assert rows == result
+    lines = [line.encode() for line in open(filename).read().split('\n') if line]
+    assert lines == list(itertools.chain.from_iterable(files.read_line_batches(filename, block_size=7)))
+
+
+def test_read_text_rows_as_json_loads_does(tmp_path: tp.Any) -> None:
+    filename = str(tmp_path / 'rows.txt')
+    with open(filename, 'wb') as file:
+        file.write(b'{"value": 1}\r\n\r\n{"value": NaN}\n\n{"value": 1180591620717411303424}\r\n{"value": -Infinity}\r')
+
+    rows = list(files.read_text_rows(filename))
+    assert [1, 2 ** 70, -float('inf')] == [rows[0]['value'], rows[2]['value'], rows[3]['value']]
+    assert math.isnan(rows[1]['value'])
+    for block_size in [1, 2, 13]:
+        lines = list(itertools.chain.from_iterable(files.read_line_batches(filename, block_size=block_size)))
+        assert [b'{"value": 1}', b'{"value": NaN}'] == lines[:2] and 4 == len(lines)
+
+
+def test_read_files_in_shards(tmp_path: tp.Any) -> None:
+    rows = [{'id': i, 'text': 'line ' * (i % 7)} for i in range(300)]
+    text_file, row_file = str(tmp_path / 'part-0.txt'), str(tmp_path / 'part-1.rows')
+    with open(text_file, 'w') as file:
+        file.writelines(json.dumps(row) + '\n' for row in rows[:100])
+    files.write_row_file(row_file, rows[100:], chunk_size=10)
+
+    row_shards = files.frame_aligned_shards(row_file, shard_size=1)
+    assert 20 == len(row_shards)
+    assert rows[100:] == [row for start, end in row_shards for row in files.read_row_file(row_file, start, end)]
+    shards = files.file_shards([text_file], shard_size=500) + files.file_shards([row_file], 500, format='rows')
+    assert rows == files.read_shards(json.loads, shards)
+    assert rows[:100] == list(files.read_files(text_file))
+    assert rows[100:] == list(files.read_files(row_file, format='rows'))
+    pattern = str(tmp_path / 'part-*.rows')
+    assert rows[100:] == list(files.read_files(pattern, workers=2, shard_size=500, format='rows'))
+    unordered = list(files.read_files(pattern, workers=2, ordered=False, shard_size=500, format='rows'))
+    assert rows[100:] == sorted(unordered, key=lambda row: row['id'])
+
+
+def test_compressed_files(tmp_path: tp.Any) -> None:
+    rows = [{'id': i, 'text': 'line ' * (i % 7)} for i in range(300)]
+    for suffix in ['.gz', '.bz2', '.xz']:
+        text_file, row_file = str(tmp_path / ('rows.txt' + suffix)), str(tmp_path / ('rows.bin' + suffix))
+
+        assert 300 == files.write_text_rows(text_file, rows, chunk_size=100)
+        assert 300 == files.write_row_file(row_file, rows, chunk_size=100)
+        assert files.detect_compression(text_file) == files.COMPRESSION_SUFFIXES[suffix]
+        assert files.is_row_file(row_file) and not files.is_row_file(text_file)
+        assert rows == list(files.read_text_rows(text_file))
+        assert rows == list(files.read_row_file(row_file))
+        lines = list(itertools.chain.from_iterable(files.read_line_batches(text_file, block_size=7)))
+        assert [json.dumps(row).encode() for row in rows] == lines
+        assert rows == list(files.read_files(text_file, workers=2))
+        assert rows == list(files.read_files(row_file, workers=2, format='rows'))
+
+    text_file = str(tmp_path / 'bzh.txt')
+    with open(text_file, 'w') as file:
+        file.write('BZh is a word\nBZh91AY\n')
+    assert files.detect_compression(text_file) is None
+    assert ['BZh is a word', 'BZh91AY'] == list(files.read_files(text_file, parser=str))
+
+
+def test_prefetch() -> None:
+    assert list(range(100)) == list(parallel.prefetch(iter(range(100)), depth=2))
+
+    def failing() -> tp.Generator[int, None, None]:
+        yield 1
+        raise ValueError('broken input')
+
+    with raises(ValueError, match='broken input'):
+        list(parallel.prefetch(failing()))
+    prefetched = parallel.prefetch(itertools.count(), depth=2)
+    assert [0, 1, 2] == list(itertools.islice(prefetched, 3))
+    prefetched.close()
+
+
+def test_sinks(tmp_path: tp.Any) -> None:
+    rows = [{'id': i, 'text': 'line ' * (i % 7)} for i in range(300)]
+    text_file, row_file = str(tmp_path / 'rows.txt.gz'), str(tmp_path / 'rows.bin')
+
+    with sinks.JsonLinesSink(text_file, chunk_size=7) as text_sink, sinks.RowFileSink(row_file) as row_sink:
+        text_sink.extend(rows[:100])
+        text_sink.extend(rows[100:])
+        row_sink.extend(iter(rows))
+    assert 300 == text_sink.row_count == row_sink.row_count
+    assert rows == list(files.read_text_rows(text_file)) == list(files.read_row_file(row_file))
+
+    chunks: tp.List[tp.List[ops.TRow]] = []
+    callback_sink = sinks.CallbackSink(chunks.append, chunk_size=128)
+    callback_sink.extend(iter(rows))
+    assert [128, 128, 44] == [len(chunk) for chunk in chunks]
+    assert rows == list(itertools.chain.from_iterable(chunks))
+
+
+def test_memory_governor_pressure(monkeypatch: tp.Any) -> None:
+    monkeypatch.setattr(spill, 'PRESSURE_MIN_ROWS', 8)
+    governor = memory_governor.MemoryGovernor(limit=1)
+    governor.on_sample(governor.memory_usage())
+    assert governor.pressure
+    assert 1024 ** 2 == governor.budget(64 * 1024 ** 2)
+
+    def grow() -> None:
+        governor.on_sample(governor.usage + 1)
+
+    rows = [{'key': i % 20, 'value': i} for i in range(40)]
+    expected = sorted(ops.HashReduce(ops.Sum('value'), ['key'])(iter(rows)), key=itemgetter('key'))
+    assert 20 == len(list(ops.HashReduce(ops.TopN('value', 1), ['key'])(iter(rows), governor=governor)))
+    grow()
+    result = ops.HashReduce(ops.Sum('value'), ['key'])(iter(rows), governor=governor)
+    assert expected == sorted(result, key=itemgetter('key'))
+    grow()
+    assert rows == list(exts.sort_rows(iter(rows), ['value'], governor=governor))
+
+    grow()
+    join = ops.Join(ops.InnerJoiner(), ['key'], strategy='hash')
+    assert 4 == len(list(join(iter(rows[:2]), iter(rows), governor=governor)))
+    grow()
+    buffer = ops.GroupBuffer(max_rows=100, governor=governor)
+    for row in rows:
+        buffer.append(row)
+    assert isinstance(buffer.rows(), spill.SpillFile) and rows == list(buffer.rows())
+    buffer.remove()
+
+    grow()
+    tee = spill.Tee(iter(rows), 2, buffer_size=100, governor=governor)
+    first, second = tee.branch(0), tee.branch(1)
+    assert rows == list(first) == list(second)
+    assert {'hash_reduce', 'sort', 'hash_join', 'join_group', 'tee'} <= set(governor.spills)
+
+
+def test_memory_governor_waits_for_growth_after_spill() -> None:
+    governor = memory_governor.MemoryGovernor(limit=1000)
+    governor.on_sample(900)
+    assert spill.should_spill(governor, spill.PRESSURE_MIN_ROWS, 'sort')
+    assert not governor.pressure
+    governor.on_sample(920)
+    assert not spill.should_spill(governor, spill.PRESSURE_MIN_ROWS, 'sort')
+    governor.on_sample(950)
+    assert spill.should_spill(governor, spill.PRESSURE_MIN_ROWS, 'sort')
+    governor.on_sample(500)
+    governor.on_sample(820)
+    assert governor.pressure
+    assert 2 == governor.spills['sort']
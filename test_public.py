@@ -1,15 +1,26 @@
+import json
+import multiprocessing
+import os
+import pickle
+import sys
 import typing as tp
 
 from itertools import islice, cycle
 from operator import itemgetter
 
-from pytest import approx
+from pytest import approx, raises
 
 from compgraph import graphs
 from compgraph.lib import memory_watchdog
 from .lib.graph import Graph, Node, NodeFromFile, NodeFromIter
 from .lib import operations
 from .lib import external_sort as exts
+from .lib import files
+from .lib import planner
+from .lib import profiling
+from .lib import records
+from .lib import sinks
+from .lib import spill
 
 
 MiB = 1024 ** 2
@@ -109,6 +120,26 @@ def test_tf_idf() -> None:
     assert expected == sorted(result, key=itemgetter('doc_id', 'text'))
 
 
+def test_tf_idf_reads_source_once() -> None:
+    graph = graphs.inverted_index_graph('texts', doc_column='doc_id', text_column='text', result_column='tf_idf')
+
+    rows = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'little'},
+        {'doc_id': 3, 'text': 'little little little'},
+    ]
+    calls = []
+
+    def source() -> tp.Iterator[tp.Dict[str, tp.Any]]:
+        calls.append(1)
+        return iter(rows)
+
+    result = graph.run(texts=source)
+
+    assert 1 == len(calls)
+    assert 5 == len(result)
+
+
 def test_pmi() -> None:
     graph = graphs.pmi_graph('texts', doc_column='doc_id', text_column='text', result_column='pmi')
 
@@ -194,6 +225,36 @@ def test_yandex_maps() -> None:
     assert expected == sorted(result, key=itemgetter('weekday', 'hour'))
 
 
+def test_word_count_parallel_sort() -> None:
+    graph = graphs.word_count_graph('docs').with_options(sort_workers=3)
+
+    docs = [
+        {'doc_id': 1, 'text': 'hello, my little WORLD'},
+        {'doc_id': 2, 'text': 'Hello, my little little hell'}
+    ]
+
+    expected = [
+        {'count': 1, 'text': 'hell'},
+        {'count': 1, 'text': 'world'},
+        {'count': 2, 'text': 'hello'},
+        {'count': 2, 'text': 'my'},
+        {'count': 3, 'text': 'little'}
+    ]
+
+    assert expected == graph.run(docs=lambda: iter(docs))
+
+
+def test_parallel_map_in_graph() -> None:
+    graph = Graph.graph_from_iter('docs') \
+        .map(operations.FilterPunctuation('text'), workers=2, batch_size=1) \
+        .map(operations.LowerCase('text'), workers=2, ordered=False)
+
+    docs = [{'doc_id': i, 'text': 'Hello, World {}!'.format(i)} for i in range(10)]
+    expected = [{'doc_id': i, 'text': 'hello world {}'.format(i)} for i in range(10)]
+
+    assert expected == sorted(graph.run(docs=lambda: iter(docs)), key=itemgetter('doc_id'))
+
+
 ######### HEAVY TESTS WITH MEMORY TRACKING ##########
 
 
@@ -297,3 +358,374 @@ def test_structure_2() -> None:
     assert len(graph2.tail.parents) == 2 # type: ignore
     assert isinstance(graph2.tail.parents[0].operation, exts.ExternalSort) # type: ignore
     assert graph2.tail.parents[1] == graph1.tail # type: ignore
+
+
+def test_sorted_by() -> None:
+    graph = Graph.graph_from_iter('rows') \
+        .sort(['a', 'b']) \
+        .reduce(operations.Count('count'), ['a', 'b']) \
+        .map(operations.AddField('c', 1))
+
+    assert ('a', 'b') == graph.tail.sorted_by
+    assert ('a',) == graph.map(operations.Project(['a', 'count'])).tail.sorted_by
+
+
+def test_redundant_sort_removed() -> None:
+    graph = Graph.graph_from_iter('rows') \
+        .sort(['a', 'b']) \
+        .reduce(operations.Count('count'), ['a', 'b']) \
+        .sort(['a'])
+
+    plan = planner.remove_redundant_sorts(graph.tail)
+
+    assert isinstance(plan, Node)
+    assert isinstance(plan.operation, operations.Reduce)
+
+    rows = [{'a': i % 3, 'b': i % 2} for i in range(10)]
+    assert graph.with_options(optimize=False).run(rows=lambda: iter(rows)) == graph.run(rows=lambda: iter(rows))
+
+
+def test_sort_weakened_to_partial_sort() -> None:
+    graph = Graph.graph_from_iter('rows') \
+        .sort(['a']) \
+        .sort(['a', 'b'])
+
+    plan = planner.remove_redundant_sorts(graph.tail)
+
+    assert isinstance(plan.operation, exts.PartialSort)  # type: ignore
+
+    rows = [{'a': i % 3, 'b': -i} for i in range(10)]
+    assert sorted(rows, key=itemgetter('a', 'b')) == graph.run(rows=lambda: iter(rows))
+
+
+def test_combine_before_sort() -> None:
+    graph = graphs.word_count_graph('docs')
+
+    plan = planner.combine_before_sort(graph.tail)
+
+    assert isinstance(plan.parents[0].operation, operations.MergeReduce)  # type: ignore
+    assert isinstance(plan.parents[0].parents[0].parents[0].operation, operations.Combine)  # type: ignore
+
+
+def test_join_strategy_from_size_hint() -> None:
+    players = Graph.graph_from_iter('players', size_hint=3).sort(['player_id'])
+    graph = Graph.graph_from_iter('games') \
+        .sort(['player_id']) \
+        .join(operations.InnerJoiner(), players, ['player_id'])
+
+    plan = planner.choose_join_strategies(graph.tail, broadcast_limit=10)
+
+    assert 'broadcast' == plan.operation.strategy  # type: ignore
+    assert all(isinstance(parent, NodeFromIter) for parent in plan.parents)
+
+    players_rows = [{'player_id': 1, 'username': 'XeroX'}, {'player_id': 2, 'username': 'jay'}]
+    games_rows = [{'game_id': 1, 'player_id': 2}, {'game_id': 2, 'player_id': 1}, {'game_id': 3, 'player_id': 2}]
+    expected = [
+        {'game_id': 1, 'player_id': 2, 'username': 'jay'},
+        {'game_id': 2, 'player_id': 1, 'username': 'XeroX'},
+        {'game_id': 3, 'player_id': 2, 'username': 'jay'}
+    ]
+
+    assert expected == graph.run(players=lambda: iter(players_rows), games=lambda: iter(games_rows))
+
+
+def test_columnar_execution() -> None:
+    rows = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'little'},
+        {'doc_id': 3, 'text': 'little little little'},
+        {'doc_id': 4, 'text': 'little? hello little world'},
+        {'doc_id': 5, 'text': 'HELLO HELLO! WORLD...'},
+        {'doc_id': 6, 'text': 'world? world... world!!! WORLD!!! HELLO!!! HELLO!!!!!!!'}
+    ]
+
+    for graph in [graphs.inverted_index_graph('texts'), graphs.pmi_graph('texts'), graphs.word_count_graph('texts')]:
+        expected = graph.run(texts=lambda: iter(rows))
+        result = graph.with_options(columnar=True, columnar_batch_size=4).run(texts=lambda: iter(rows))
+        assert [{key: approx(value) for key, value in row.items()} for row in expected] == result
+
+    plan = planner.vectorize(Graph.graph_from_iter('texts')
+                             .map(operations.TFIDF('tf', 'idf'))
+                             .map(operations.PMI('tf', 'idf')).tail, batch_size=4)
+    assert isinstance(plan.operation, operations.BatchMap)  # type: ignore
+    assert 2 == len(plan.operation.mappers)  # type: ignore
+
+
+def test_word_count_from_row_file(tmp_path: tp.Any) -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, my little WORLD'},
+        {'doc_id': 2, 'text': 'Hello, my little little hell'}
+    ]
+    text_file, row_file = str(tmp_path / 'docs.txt'), str(tmp_path / 'docs.rows')
+    with open(text_file, 'w') as file:
+        file.writelines(json.dumps(doc) + '\n' for doc in docs)
+
+    assert 2 == files.convert_json_lines(text_file, row_file)
+    assert files.is_row_file(row_file) and not files.is_row_file(text_file)
+    assert docs == list(files.read_row_file(row_file))
+
+    expected = graphs.word_count_graph_from_file(text_file).run()
+    graph = Graph.graph_from_file(row_file, format='rows') \
+        .map(operations.FilterPunctuation('text')) \
+        .map(operations.LowerCase('text')) \
+        .map(operations.Split('text')) \
+        .sort(['text']) \
+        .reduce(operations.Count('count'), ['text']) \
+        .sort(['count', 'text'])
+    assert expected == graph.run()
+
+
+def test_row_files_never_run_code(tmp_path: tp.Any) -> None:
+    marker = tmp_path / 'marker'
+
+    class Payload:
+        def __reduce__(self) -> tp.Tuple[tp.Any, ...]:
+            return os.makedirs, (str(marker),)
+
+    # pickled chunk behind row file headers, as written by older versions
+    for magic in [files.ROW_FILE_MAGIC, b'CGROWS\x00\x01']:
+        filename = str(tmp_path / 'rows.bin')
+        with open(filename, 'wb') as file:
+            file.write(magic)
+            spill.write_frame(file, pickle.dumps([Payload()], protocol=pickle.HIGHEST_PROTOCOL))
+        with raises(ValueError):
+            Graph.graph_from_file(filename, format='rows').run()
+        with raises(ValueError):
+            Graph.graph_from_file(filename).run()
+    assert not marker.exists()
+
+
+def test_word_count_from_file_shards(tmp_path: tp.Any) -> None:
+    docs = [{'doc_id': i, 'text': 'hello, my little WORLD ' * (i % 5) + 'hell'} for i in range(2000)]
+    for part in range(2):
+        with open(str(tmp_path / 'docs-{}.txt'.format(part)), 'w') as file:
+            file.writelines(json.dumps(doc) + '\n' for doc in docs[part::2])
+
+    expected = graphs.word_count_graph(input_stream_name='docs').run(docs=lambda: iter(docs))
+    graph = Graph.graph_from_file(str(tmp_path / 'docs-*.txt'), workers=2, ordered=False) \
+        .map(operations.FilterPunctuation('text')) \
+        .map(operations.LowerCase('text')) \
+        .map(operations.Split('text')) \
+        .sort(['text']) \
+        .reduce(operations.Count('count'), ['text']) \
+        .sort(['count', 'text'])
+    assert expected == graph.run()
+
+
+def test_word_count_from_compressed_file(tmp_path: tp.Any) -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, my little WORLD'},
+        {'doc_id': 2, 'text': 'Hello, my little little hell'}
+    ]
+    filename = str(tmp_path / 'docs.txt.gz')
+    files.write_text_rows(filename, docs)
+    expected = graphs.word_count_graph(input_stream_name='docs').run(docs=lambda: iter(docs))
+    assert expected == graphs.word_count_graph_from_file(filename).run()
+
+    result_file = str(tmp_path / 'result.txt.xz')
+    files.write_text_rows(result_file, graphs.word_count_graph_from_file(filename).run())
+    assert expected == list(files.read_text_rows(result_file))
+
+
+def test_run_iter_and_sinks(tmp_path: tp.Any) -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, my little WORLD'},
+        {'doc_id': 2, 'text': 'Hello, my little little hell'}
+    ]
+    graph = graphs.word_count_graph('docs')
+    expected = graph.run(docs=lambda: iter(docs))
+
+    result = graph.run_iter(docs=lambda: iter(docs))
+    assert not isinstance(result, list)
+    assert expected == list(result)
+
+    filename = str(tmp_path / 'result.txt')
+    assert len(expected) == graph.run_to(sinks.JsonLinesSink(filename), docs=lambda: iter(docs))
+    assert expected == list(files.read_text_rows(filename))
+
+
+def test_run_with_memory_limit() -> None:
+    docs = [{'doc_id': i, 'text': 'hello, my little WORLD {}'.format(i % 2000)} for i in range(3000)]
+    graph = graphs.word_count_graph('docs')
+    expected = graph.run(docs=lambda: iter(docs))
+    assert expected == graph.with_options(memory_limit=1).run(docs=lambda: iter(docs))
+    assert expected == graph.with_options(memory_limit=1, optimize=False).run(docs=lambda: iter(docs))
+
+
+def test_run_with_profiler(tmp_path: tp.Any) -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, my little WORLD'},
+        {'doc_id': 2, 'text': 'Hello, my little little hell'}
+    ]
+    graph = graphs.word_count_graph('docs')
+    expected = graph.run(docs=lambda: iter(docs))
+    profiler = profiling.Profiler()
+    assert expected == graph.with_options(profiler=profiler, sort_workers=2).run(docs=lambda: iter(docs))
+
+    trace = profiler.trace()
+    assert ['iter docs'] == [stats['node'] for stats in trace if not stats['parents']]
+    assert 2 == trace[0]['rows_out'] and len(expected) == trace[-1]['rows_out']
+    assert {stats['id'] for stats in trace} - {parent for stats in trace for parent in stats['parents']} == \
+        {trace[-1]['id']}
+    sorts = [stats for stats in trace if stats['node'].startswith('ExternalSort')]
+    assert sorts and all(stats['pipe_bytes_sent'] > 0 and stats['rows_in'] == stats['rows_out'] for stats in sorts)
+    assert all(stats['wall_time'] >= 0 and stats['cpu_time'] >= 0 for stats in trace)
+
+    filename = str(tmp_path / 'profile.json')
+    profiler.dump(filename)
+    with open(filename) as file:
+        assert profiler.trace() == json.load(file)
+    assert 'ExternalSort' in profiler.report()
+
+
+def test_fuse_maps() -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'Little? hello little World'},
+        {'doc_id': 3, 'text': 'HELLO HELLO! WORLD...'}
+    ]
+    plan = planner.fuse_maps(planner.combine_before_sort(graphs.word_count_graph('docs').tail))
+    fused = plan.parents[0].parents[0].parents[0].operation  # type: ignore
+    assert isinstance(fused, operations.FusedMap) and isinstance(fused.operation, operations.Combine)
+    assert [operations.FilterPunctuation, operations.LowerCase, operations.Split] == list(map(type, fused.mappers))
+
+    words = Graph.graph_from_iter('docs').map(operations.Split('text'))
+    graph = Graph.graph_from_graph(words) \
+        .map(operations.LowerCase('text')) \
+        .map(operations.Filter(lambda row: row['text'] != 'hello')) \
+        .join(operations.InnerJoiner(), Graph.graph_from_graph(words).map(operations.Project(['text'])), ['text'])
+    plan = planner.fuse_maps(graph.tail)
+    left, right = plan.parents  # type: ignore
+    assert [operations.LowerCase, operations.Filter] == list(map(type, left.operation.mappers))  # type: ignore
+    assert left.parents[0] is right.parents[0]  # type: ignore
+    assert [operations.Split] == list(map(type, left.parents[0].operation.mappers))  # type: ignore
+
+    for graph in [graph, graphs.word_count_graph('docs'), graphs.inverted_index_graph('docs'),
+                  graphs.pmi_graph('docs')]:
+        assert graph.with_options(optimize=False).run(docs=lambda: iter(docs)) == graph.run(docs=lambda: iter(docs))
+
+
+def test_push_down_filters_and_prune_columns(tmp_path: tp.Any) -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, little world', 'author': 'a'},
+        {'doc_id': 2, 'text': 'Little? hello little World', 'author': 'b'},
+        {'doc_id': 3, 'text': 'HELLO HELLO! WORLD...', 'author': 'c'}
+    ]
+    filename = str(tmp_path / 'docs.txt')
+    files.write_text_rows(filename, docs)
+
+    graph = Graph.graph_from_file(filename) \
+        .map(operations.Split('text')) \
+        .sort(['text']) \
+        .reduce(operations.Count('count'), ['text']) \
+        .map(operations.Filter(lambda row: row['text'] != 'hello', columns=['text']))
+    plan = planner.prune_columns(planner.push_down_filters(graph.tail))
+    assert isinstance(plan.operation, operations.Reduce)  # type: ignore
+    pushed = plan.parents[0].parents[0]  # type: ignore
+    assert isinstance(pushed.operation.mapper, operations.Filter)  # type: ignore
+    assert isinstance(pushed.parents[0].operation.mapper, operations.Split)  # type: ignore
+    source = pushed.parents[0].parents[0]  # type: ignore
+    assert isinstance(source, NodeFromFile) and source.columns == {'text'}
+    assert graph.with_options(optimize=False).run() == graph.run()
+
+    # filters by keys of joins go to both inputs, undeclared columns keep the whole rows
+    words = Graph.graph_from_file(filename).map(operations.Split('text'))
+    graph = Graph.graph_from_graph(words) \
+        .join(operations.InnerJoiner('_a', '_b'), Graph.graph_from_graph(words), ['text']) \
+        .map(operations.Filter(lambda row: len(row['text']) > 5, columns=['text'])) \
+        .map(operations.Project(['text', 'doc_id_a']))
+    plan = planner.prune_columns(planner.push_down_filters(graph.tail))
+    join = plan.parents[0]  # type: ignore
+    assert all(isinstance(parent.operation.mapper, operations.Filter) for parent in join.parents)  # type: ignore
+    columns = join.parents[0].parents[0].parents[0].columns  # type: ignore
+    assert {'text', 'doc_id'} <= columns and 'author' not in columns
+    assert graph.with_options(optimize=False).run() == graph.run()
+
+    graph = Graph.graph_from_file(filename).map(operations.Filter(lambda row: True)).map(operations.Project(['text']))
+    assert planner.prune_columns(graph.tail).parents[0].parents[0].columns is None  # type: ignore
+
+    row = {'doc_id': 1, 'author': 'Pushkin', 'text': 'hello'}
+    assert ['doc_id', 'text'] == list(operations.select_columns(frozenset(['text', 'doc_id', 'year']), row))
+
+
+def test_compact_rows(tmp_path: tp.Any) -> None:
+    row = records.compact({'doc_id': 1, 'text': 'hello world'})
+    assert row == {'doc_id': 1, 'text': 'hello world'} and row != {'doc_id': 1}
+    assert list(row) == ['doc_id', 'text'] and row.get('tf') is None and 'text' in row and len(row) == 2
+    assert row.schema is records.compact({'doc_id': 2, 'text': ''}).schema
+    assert sys.getsizeof(row) < sys.getsizeof({'doc_id': 1, 'text': 'hello world'})
+    assert pickle.loads(pickle.dumps(row)).schema is row.schema
+    assert type(records.to_dict(row)) is dict and records.to_dict(row) == row
+
+    docs = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'Little? hello little World'},
+        {'doc_id': 3, 'text': 'HELLO HELLO! WORLD...'}
+    ]
+    for graph in [graphs.word_count_graph('docs'), graphs.inverted_index_graph('docs'), graphs.pmi_graph('docs')]:
+        result = graph.with_options(compact_rows=True, sort_workers=2).run(docs=lambda: iter(docs))
+        assert all(type(row) is dict for row in result)
+        assert result == graph.run(docs=lambda: iter(docs))
+
+    rows = [{'key': i % 7, 'value': i} for i in range(100)]
+    result = list(exts.sort_rows(iter(rows), ['key'], memory_limit=1024, tmp_dir=str(tmp_path), compact=True))
+    assert result == sorted(rows, key=itemgetter('key')) and all(type(row) is dict for row in result)
+
+    left = [{'key': i % 5, 'left': i} for i in range(20)]
+    right = [{'key': i % 7, 'right': i} for i in range(20)]
+    for strategy, max_rows in [('merge', 2), ('broadcast', 100), ('hash', 100), ('hash', 1)]:
+        join = operations.Join(operations.OuterJoiner(), ['key'], strategy=strategy, max_rows=max_rows,
+                               tmp_dir=str(tmp_path))
+        if strategy == 'merge':
+            left, right = sorted(left, key=itemgetter('key')), sorted(right, key=itemgetter('key'))
+        etalon = list(join(iter(left), iter(right)))
+        result = list(join(iter(left), iter(right), compact_rows=True))
+        assert result == etalon and all(type(row) is dict for row in result)
+
+
+def test_combine_with_unhashable_keys() -> None:
+    rows = [{'k': [1, 2], 'n': 1}, {'k': [3], 'n': 2}, {'k': [1, 2], 'n': 3}]
+    expected = [{'k': [1, 2], 'c': 2}, {'k': [3], 'c': 1}]
+
+    graph = Graph.graph_from_iter('rows').sort(['k']).reduce(operations.Count('c'), ['k'])
+    assert isinstance(planner.combine_before_sort(graph.tail).operation, operations.MergeReduce)  # type: ignore
+    assert expected == graph.run(rows=lambda: iter(rows))
+    assert expected == graph.with_options(optimize=False).run(rows=lambda: iter(rows))
+
+
+def test_sort_processes_stop_when_input_fails() -> None:
+    class Failing(operations.RowMapper):
+        def map_row(self, row: operations.TRow) -> tp.Optional[operations.TRow]:
+            if row['k'] == 500:
+                raise RuntimeError('broken row')
+            return row
+
+    graph = Graph.graph_from_iter('rows').map(Failing()).sort(['k'])
+    for workers in [1, 2]:
+        with raises(RuntimeError, match='broken row'):
+            graph.with_options(sort_workers=workers).run(rows=lambda: ({'k': i} for i in range(1000)))
+        assert [] == multiprocessing.active_children()
+
+
+def test_join_strategy_keeps_order_for_consumers() -> None:
+    left_rows = [{'k': i % 5, 'left': i} for i in range(20)]
+    right_rows = [{'k': i, 'right': i} for i in range(5)]
+    expected = [{'k': k, 'n': 4} for k in range(5)]
+
+    for size_hint in [5, 10 ** 9]:
+        right = Graph.graph_from_iter('right', size_hint=size_hint).sort(['k'])
+        graph = Graph.graph_from_iter('left') \
+            .sort(['k']) \
+            .join(operations.InnerJoiner(), right, ['k']) \
+            .reduce(operations.Count('n'), ['k'])
+
+        assert 'auto' == planner.choose_join_strategies(graph.tail, 10).parents[0].operation.strategy  # type: ignore
+        assert expected == graph.run(left=lambda: iter(left_rows), right=lambda: iter(right_rows))
+
+    # without order-dependent consumers a right table bigger than max_rows of the join is still sort-merged
+    right = Graph.graph_from_iter('right', size_hint=10 ** 9).sort(['k'])
+    graph = Graph.graph_from_iter('left').sort(['k']).join(operations.InnerJoiner(), right, ['k'])
+    assert 'auto' == planner.choose_join_strategies(graph.tail, 10).operation.strategy  # type: ignore
+    right = Graph.graph_from_iter('right', size_hint=50).sort(['k'])
+    graph = Graph.graph_from_iter('left').sort(['k']).join(operations.InnerJoiner(), right, ['k'])
+    assert 'hash' == planner.choose_join_strategies(graph.tail, 10).operation.strategy  # type: ignore